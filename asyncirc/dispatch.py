@@ -0,0 +1,295 @@
+"""
+Signal dispatch for the hot path.
+
+Looking a blinker signal up by name takes a lock on the namespace, and every
+send walks the signal's weak references again. The Dispatcher remembers the
+receivers of each signal it has sent and only works them out again when a
+receiver connects or disconnects (or is garbage collected). Receivers are
+still connected with blinker, so signal(...).connect works as it always has.
+
+Receivers can also be coroutine functions. Each call is scheduled as a task,
+with a limit on how many run at once for each connection and for each signal
+on that connection. CPU-heavy receivers can be moved off the event loop
+entirely with offload.
+
+Every send is counted, per signal, in Dispatcher.signal_stats, and one send
+in every timing_interval is timed.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import importlib
+import inspect
+import logging
+import time
+import weakref
+from blinker import signal, ANY
+from asyncirc.parser import RFC1459Message
+
+logger = logging.getLogger("asyncirc.dispatch")
+
+def connection_of(sender):
+    """
+    Work out which connection a signal was sent on behalf of. Messages carry
+    their client, and wrappers are unwrapped to the protocol they hold.
+    """
+    client = getattr(sender, "client", sender)
+    return getattr(client, "protocol", client)
+
+class HandlerTasks:
+    """
+    Coroutine handlers running on behalf of one connection. At most `limit`
+    of them run at the same time, and at most `event_limit` for any one
+    signal; the rest wait their turn.
+    """
+    def __init__(self, limit, event_limit):
+        self.limit = limit
+        self.event_limit = event_limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.event_semaphores = {}
+        self.tasks = set()
+        self.in_flight = collections.Counter()
+        self.completed = 0
+        self.failed = 0
+
+    def spawn(self, name, receiver, sender, kwargs):
+        task = asyncio.ensure_future(self._run(name, receiver, sender, kwargs))
+        self.tasks.add(task)
+        self.in_flight[name] += 1
+        task.add_done_callback(lambda task: self._done(name, receiver, sender, task))
+        return task
+
+    async def _run(self, name, receiver, sender, kwargs):
+        if name not in self.event_semaphores:
+            self.event_semaphores[name] = asyncio.Semaphore(self.event_limit)
+        async with self.event_semaphores[name]:
+            async with self.semaphore:
+                await receiver(sender, **kwargs)
+
+    def _done(self, name, receiver, sender, task):
+        self.tasks.discard(task)
+        self.in_flight[name] -= 1
+        if not self.in_flight[name]:
+            del self.in_flight[name]
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is None:
+            self.completed += 1
+            return
+        self.failed += 1
+        logger.error("Handler {} for {} failed".format(getattr(receiver, "__qualname__", receiver), name),
+                     exc_info=(type(exc), exc, exc.__traceback__))
+        dispatcher.send("handler-error", sender, event=name, receiver=receiver, exception=exc)
+
+    def cancel(self):
+        """
+        Cancel every handler that is still running or waiting to run.
+        """
+        for task in list(self.tasks):
+            task.cancel()
+
+    def stats(self):
+        return {
+            "in_flight": len(self.tasks),
+            "by_event": dict(self.in_flight),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+class Dispatcher:
+    # limits for coroutine handlers, per connection and per signal
+    task_limit = 64
+    event_task_limit = 16
+    # time one send of each signal in this many (a power of two); timing
+    # every send would cost about as much as a cheap receiver
+    timing_interval = 16
+
+    def __init__(self):
+        self.signals = {}
+        self.receivers = {}
+        self.handler_tasks = weakref.WeakKeyDictionary()
+        self.orphan_tasks = None
+        # name -> [sends, sends timed, seconds spent in the timed sends]
+        self.signal_stats = {}
+
+    def signal(self, name):
+        """
+        Return the blinker signal called name, and start watching it for
+        receivers connecting and disconnecting.
+        """
+        try:
+            return self.signals[name]
+        except KeyError:
+            pass
+        sig = self.signals[name] = signal(name)
+        def changed(*args, **kwargs):
+            self.invalidate(name)
+        sig.receiver_connected.connect(changed, weak=False)
+        sig.receiver_disconnected.connect(changed, weak=False)
+        return sig
+
+    def invalidate(self, name):
+        self.receivers.pop(name, None)
+
+    def _ref(self, name, receiver):
+        def collected(ref):
+            self.invalidate(name)
+        try:
+            if inspect.ismethod(receiver):
+                ref = weakref.WeakMethod(receiver, collected)
+            else:
+                ref = weakref.ref(receiver, collected)
+        except TypeError:
+            ref = lambda: receiver
+        return ref, inspect.iscoroutinefunction(receiver)
+
+    def _resolve(self, name):
+        sig = self.signal(name)
+        live = list(sig.receivers_for(ANY))
+        if len(live) != len(sig.receivers):
+            # some receivers only listen to particular senders; let blinker
+            # work out who gets what
+            refs = None
+        else:
+            refs = tuple(self._ref(name, receiver) for receiver in live)
+        # the stats ride along with the receivers, so send looks both up at once
+        if name not in self.signal_stats:
+            self.signal_stats[name] = [0, 0, 0.0]
+        entry = self.receivers[name] = (refs, self.signal_stats[name])
+        return entry
+
+    def tasks_for(self, sender):
+        """
+        Return the HandlerTasks for the connection sender belongs to.
+        """
+        connection = connection_of(sender)
+        try:
+            return self.handler_tasks[connection]
+        except KeyError:
+            tasks = self.handler_tasks[connection] = HandlerTasks(self.task_limit, self.event_task_limit)
+        except TypeError:
+            # not something we can key on; share one set of limits
+            if self.orphan_tasks is None:
+                self.orphan_tasks = HandlerTasks(self.task_limit, self.event_task_limit)
+            tasks = self.orphan_tasks
+        return tasks
+
+    def cancel_tasks(self, sender):
+        """
+        Cancel the coroutine handlers running for sender's connection.
+        """
+        tasks = self.handler_tasks.get(connection_of(sender))
+        if tasks is not None:
+            tasks.cancel()
+
+    def _call(self, name, receiver, sender, kwargs):
+        if inspect.iscoroutinefunction(receiver):
+            self.tasks_for(sender).spawn(name, receiver, sender, kwargs)
+        else:
+            receiver(sender, **kwargs)
+
+    def has_receivers(self, name):
+        """
+        Return True if anything would receive the signal called name.
+        """
+        try:
+            refs = self.receivers[name][0]
+        except KeyError:
+            refs = self._resolve(name)[0]
+        return refs is None or bool(refs)
+
+    def send(self, name, sender, **kwargs):
+        """
+        Send the signal called name, exactly like signal(name).send would.
+        """
+        try:
+            refs, stats = self.receivers[name]
+        except KeyError:
+            refs, stats = self._resolve(name)
+        stats[0] += 1
+        start = None if stats[0] & (self.timing_interval - 1) else time.perf_counter()
+        if refs is None:
+            for receiver in self.signals[name].receivers_for(sender):
+                self._call(name, receiver, sender, kwargs)
+        else:
+            for ref, is_coroutine in refs:
+                receiver = ref()
+                if receiver is None:
+                    continue
+                if is_coroutine:
+                    self.tasks_for(sender).spawn(name, receiver, sender, kwargs)
+                else:
+                    receiver(sender, **kwargs)
+        if start is not None:
+            stats[1] += 1
+            stats[2] += time.perf_counter() - start
+
+dispatcher = Dispatcher()
+
+def _call_offloaded(module, qualname, sender, **kwargs):
+    """
+    Look a handler up by name and call it. This is what actually runs in a
+    process pool, since the handler itself has been replaced by its wrapper
+    in its module.
+    """
+    f = importlib.import_module(module)
+    for name in qualname.split("."):
+        f = getattr(f, name)
+    f = getattr(f, "__wrapped__", f)
+    return f(sender, **kwargs)
+
+def _deliver(client, name, f, future):
+    if future.cancelled():
+        return
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Offloaded handler {} for {} failed".format(f.__qualname__, name),
+                     exc_info=(type(exc), exc, exc.__traceback__))
+        dispatcher.send("handler-error", client, event=name, receiver=f, exception=exc)
+        return
+    result = future.result()
+    if result is None:
+        return
+    if isinstance(result, (str, bytes, RFC1459Message)):
+        result = [result]
+    for line in result:
+        client.writeln(line)
+
+def offload(executor, name=None):
+    """
+    Decorator that makes a handler run in executor, a thread or process pool
+    from concurrent.futures, instead of on the event loop. Whatever the
+    handler returns (a line, or a list of lines, in any form writeln accepts)
+    is written to the connection the signal came from.
+
+    Handlers run in a process pool get a snapshot of the message, without its
+    client, and must be defined at module level so the worker can find them.
+    """
+    def decorator(f):
+        in_process = isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+        if in_process:
+            if "<locals>" in f.__qualname__:
+                raise ValueError("{} can't be run in a process pool, it isn't defined at module level".format(f.__qualname__))
+            call = functools.partial(_call_offloaded, f.__module__, f.__qualname__)
+        else:
+            call = f
+
+        @functools.wraps(f)
+        def handler(sender, **kwargs):
+            client = getattr(sender, "client", sender)
+            # write the result to the wrapper, which survives reconnects
+            client = getattr(client, "wrapper", None) or client
+            if in_process and isinstance(sender, RFC1459Message):
+                sender = sender.snapshot()
+            future = asyncio.get_event_loop().run_in_executor(
+                executor, functools.partial(call, sender, **kwargs))
+            future.add_done_callback(functools.partial(_deliver, client, name or f.__qualname__, f))
+        return handler
+    return decorator
+
+def _connection_lost(client_wrapper):
+    dispatcher.cancel_tasks(client_wrapper)
+
+signal("connection-lost").connect(_connection_lost)
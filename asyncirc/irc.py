@@ -1,14 +1,20 @@
 import asyncio
 import collections
+import functools
 import importlib
 import logging
 import random
 import ssl
+import time
 from blinker import signal
+from asyncirc.dispatch import dispatcher, offload
+from asyncirc.keepalive import Keepalive
+from asyncirc.metrics import Histogram, receive_buckets
+from asyncirc.parser import RFC1459Message, decode_line
+from asyncirc.reconnect import ReconnectSupervisor
+from asyncirc.throttle import SendQueue, TokenBucket, CONTROL, INTERACTIVE, BULK
 loop = asyncio.get_event_loop()
 
-connections = {}
-
 plugins = []
 def plugin_registered_handler(plugin_name):
     plugins.append(plugin_name)
@@ -24,21 +30,109 @@ class User:
     """
     Represents a user on IRC, with their nickname, username, and hostname.
     """
-    def __init__(self, nick, user, host):
+    __slots__ = ("nick", "user", "host", "hostmask", "_register_wait")
+
+    def __init__(self, nick, user, host, hostmask=None):
         self.nick = nick
         self.user = user
         self.host = host
-        self.hostmask = "{}!{}@{}".format(nick, user, host)
+        self.hostmask = hostmask or "{}!{}@{}".format(nick, user, host)
         self._register_wait = 0
 
     @classmethod
     def from_hostmask(self, hostmask):
-        if "!" in hostmask and "@" in hostmask:
-            nick, userhost = hostmask.split("!", maxsplit=1)
-            user, host = userhost.split("@", maxsplit=1)
-            return self(nick, user, host)
+        nick, user, host = parse_hostmask(hostmask)
+        if user is not None:
+            return self(nick, user, host, hostmask)
         return self(None, None, hostmask)
 
+@functools.lru_cache(maxsize=8192)
+def parse_hostmask(hostmask):
+    """
+    Split a nick!user@host hostmask into a (nick, user, host) tuple. If it
+    isn't a full hostmask (a server name, or just a nick), user and host are
+    None. The same few hundred hostmasks show up over and over again, so the
+    results are kept in an LRU cache.
+    """
+    nick, _, userhost = hostmask.partition("!")
+    user, sep, host = userhost.partition("@")
+    if not sep:
+        return hostmask, None, None
+    return nick, user, host
+
+class LineBuffer:
+    """
+    Incremental framer for data received from the server. Raw bytes are
+    accumulated in a bytearray, split into lines in bulk, and each line is
+    decoded on its own.
+
+    Lines longer than max_line_length bytes are dropped, so a broken server
+    can't make the buffer grow without bound.
+    """
+    # 8191 bytes of IRCv3 tags plus a 512 byte RFC1459 line
+    max_line_length = 8703
+
+    def __init__(self, max_line_length=None):
+        self.buf = bytearray()
+        if max_line_length is not None:
+            self.max_line_length = max_line_length
+        self.overflow = False
+        self.dropped = 0
+
+    def feed(self, data):
+        """
+        Add received bytes to the buffer and return a list of all the lines
+        that are now complete.
+        """
+        buf = self.buf
+        buf += data
+        end = buf.rfind(b"\n")
+        if end == -1:
+            if len(buf) > self.max_line_length:
+                self._discard()
+            return []
+
+        raw_lines = bytes(buf[:end]).split(b"\n")
+        del buf[:end + 1]
+        if self.overflow:
+            # tail end of a line we already gave up on
+            raw_lines[0] = b""
+            self.overflow = False
+        if len(buf) > self.max_line_length:
+            self._discard()
+
+        lines = []
+        for line in raw_lines:
+            line = line.strip()
+            if not line:
+                continue
+            if len(line) > self.max_line_length:
+                self.dropped += 1
+                continue
+            lines.append(decode_line(line))
+        return lines
+
+    def _discard(self):
+        """
+        Throw away a partial line that has already grown too long, along with
+        the rest of it when it arrives.
+        """
+        del self.buf[:]
+        if not self.overflow:
+            self.dropped += 1
+        self.overflow = True
+
+def encode_line(line):
+    """
+    Turn a line passed to writeln (an RFC1459Message, str, or bytes) into the
+    bytes that go on the wire, minus the CRLF.
+    """
+    if isinstance(line, RFC1459Message):
+        return line.to_bytes()
+    if isinstance(line, str):
+        return line.encode("utf-8")
+    return line
+
 class IRCProtocolWrapper:
     """
     Wraps an IRCProtocol object to allow for automatic reconnection. Only used
@@ -46,6 +140,7 @@ class IRCProtocolWrapper:
     """
     def __init__(self, protocol):
         self.protocol = protocol
+        self.supervisor = ReconnectSupervisor(self)
 
     def __getattr__(self, attr):
         if attr in self.__dict__:
@@ -58,91 +153,275 @@ class IRCProtocolWrapper:
         else:
             setattr(self.protocol, attr, val)
 
+class ConnectionManager:
+    """
+    Keeps track of our connections, by netid. You can look them up with
+    connections[netid] or find(server), iterate over them, and close them
+    all with shutdown().
+    """
+    def __init__(self):
+        self.connections = collections.OrderedDict()
+
+    def add(self, client):
+        self.connections[client.netid] = client
+
+    def remove(self, netid):
+        return self.connections.pop(netid, None)
+
+    def get(self, netid, default=None):
+        return self.connections.get(netid, default)
+
+    def find(self, server):
+        """
+        Every connection to the server with the given hostname.
+        """
+        return [client for client in self if client.server_info["host"] == server]
+
+    def __getitem__(self, netid):
+        return self.connections[netid]
+
+    def __contains__(self, netid):
+        return netid in self.connections
+
+    def __iter__(self):
+        return iter(list(self.connections.values()))
+
+    def __len__(self):
+        return len(self.connections)
+
+    def shutdown(self, message="Shutting down"):
+        """
+        QUIT and close every connection, without reconnecting.
+        """
+        for client in self:
+            client.close(message)
+
+connections = ConnectionManager()
+
 class IRCProtocol(asyncio.Protocol):
     """
     Represents a connection to IRC.
     """
 
+    def __init__(self, netid=None, server_info=None):
+        """
+        The netid and server_info can be given up front, so the lines that
+        arrive as soon as we're connected are already dispatched with them.
+        """
+        self.netid = netid
+        self.server_info = server_info
+        self.wrapper = None
+
     def connection_made(self, transport):
         self.work = True
+        self.loop = asyncio.get_event_loop()
         self.transport = transport
-        self.wrapper = None
         self.logger = logging.getLogger("asyncirc.IRCProtocol")
         self.last_ping = float('inf')
         self.last_pong = 0
         self.lag = 0
-        self.buf = ""
+        self.keepalive = Keepalive(self)
+        self.linebuffer = LineBuffer()
+        self.bytes_received = 0
+        self.lines_received = 0
+        self.receive_time = Histogram(receive_buckets)
         self.old_nickname = None
         self.nickname = ""
         self.server_supports = collections.defaultdict(lambda *_: None)
-        self.queue = []
-        self.queue_timer = 1.5
+        self.queue = SendQueue(clock=self.loop.time)
+        self.throttle = TokenBucket(clock=self.loop.time)
+        self._queue_handle = None
+        # the send queue of the connection we replaced, if this is a reconnect
+        self.backlog = None
+        self.writing_paused = False
+        self.pauses = 0
+        self.bytes_sent = 0
+        self.lines_sent = 0
+        self.writes = 0
         self.caps = set()
         self.registration_complete = False
+        # set when it's time to register but register() hasn't been called
+        self.registration_due = False
         self.channels_to_join = []
         self.autoreconnect = True
 
-        signal("connected").send(self)
+        dispatcher.send("connected", self)
         self.logger.info("Connection success.")
-        self.process_queue()
 
     def data_received(self, data):
         if not self.work: return
-        try:
-            data = data.decode('utf-8')
-        except:
-            data = data.decode('latin-1')
-
-        self.buf += data
-        while "\n" in self.buf:
-            index = self.buf.index("\n")
-            line_received = self.buf[:index].strip()
-            self.buf = self.buf[index + 1:]
-            self.logger.debug(line_received)
-            signal("raw").send(self, text=line_received)
+        start = time.perf_counter()
+        self.bytes_received += len(data)
+        lines = self.linebuffer.feed(data)
+        self.lines_received += len(lines)
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for line_received in lines:
+            if debug:
+                self.logger.debug(line_received)
+            dispatcher.send("raw", self, text=line_received)
+        self.receive_time.observe(time.perf_counter() - start)
 
     def connection_lost(self, exc):
         if not self.work: return
+        if self._queue_handle is not None:
+            self._queue_handle.cancel()
+            self._queue_handle = None
+        self.keepalive.stop()
         self.logger.critical("Connection lost.")
-        signal("connection-lost").send(self.wrapper)
+        dispatcher.send("connection-lost", self.wrapper)
+
+    def resume_backlog(self):
+        """
+        Queue the lines that were still waiting to be sent when the previous
+        connection was lost. Called once registration is complete.
+        """
+        if self.backlog is None:
+            return
+        self.queue.transfer(self.backlog)
+        self.backlog = None
+        if self.queue and self._queue_handle is None and not self.writing_paused:
+            self._queue_handle = self.loop.call_soon(self.process_queue)
+
+    def close(self, message="Shutting down"):
+        """
+        Send a QUIT straight to the server, bypassing the send queue, and
+        close the connection. We won't try to reconnect, but the usual
+        teardown (connection-lost, then disconnected) still runs.
+        """
+        self.autoreconnect = False
+        if not self.work:
+            connections.remove(self.netid)
+            return
+        self.transport.write(encode_line(RFC1459Message.from_data("QUIT", [message])) + b"\r\n")
+        self.transport.close()
+        self.connection_lost(None)
+
+    def pause_writing(self):
+        """
+        Called by the transport when its write buffer is over the high-water
+        mark. Stop draining the send queue until resume_writing is called.
+        """
+        self.writing_paused = True
+        self.pauses += 1
+        self.logger.debug("Transport buffer full, pausing the send queue.")
+
+    def resume_writing(self):
+        """
+        Called by the transport once its write buffer has drained below the
+        low-water mark.
+        """
+        self.writing_paused = False
+        if self.queue and self._queue_handle is None:
+            self._queue_handle = self.loop.call_soon(self.process_queue)
 
     ## Core helper functions
 
     def process_queue(self):
         """
-        Pull data from the pending messages queue and send it. Schedule ourself
-        to be executed again later.
+        Send as many lines from the pending messages queue as the flood limiter
+        allows right now, in a single write. If anything is left over, schedule
+        ourself to run again as soon as the next line can go out.
         """
-        if not self.work: return
-        if self.queue:
-            self._writeln(self.queue.pop(0))
-        loop.call_later(self.queue_timer, self.process_queue)
-
-    def on(self, event):
+        self._queue_handle = None
+        if not self.work or self.writing_paused: return
+        batch = []
+        while self.queue:
+            line = self.queue.peek()
+            try:
+                data = encode_line(line)
+            except ValueError as e:
+                # a line we can't send would otherwise block the queue for good
+                self.queue.pop()
+                self.logger.error("Dropping unsendable line {!r}: {}".format(line, e))
+                continue
+            cost = self.throttle.cost(len(data) + 2)
+            delay = self.throttle.delay(cost)
+            if delay:
+                self._queue_handle = self.loop.call_later(delay, self.process_queue)
+                break
+            self.throttle.consume(cost)
+            self.queue.pop()
+            batch.append((line, data))
+        if batch:
+            self._write_batch(batch)
+
+    def on(self, event, executor=None):
         def process(f):
             """
-            Register an event with Blinker. Convienence function.
+            Register an event with Blinker. Convienence function. f can be a
+            coroutine function, in which case it runs as a task. If an
+            executor is given, f runs there instead of on the event loop (see
+            asyncirc.dispatch.offload).
             """
             self.logger.debug("Registering function for event {}".format(event))
-            signal(event).connect(f)
+            if executor is not None:
+                signal(event).connect(offload(executor, event)(f), weak=False)
+            else:
+                signal(event).connect(f)
             return f
         return process
 
-    def _writeln(self, line):
+    def _writeln(self, line, data=None):
         """
         Send a raw message to IRC immediately.
         """
-        if not isinstance(line, bytes):
-            line = line.encode("utf-8")
-        self.logger.debug(line)
-        self.transport.write(line + b"\r\n")
-        signal("irc-send").send(line.decode())
+        if data is None:
+            data = encode_line(line)
+        self._write_batch([(line, data)])
 
-    def writeln(self, line):
+    def _write_batch(self, batch):
+        """
+        Send a list of (line, encoded line) pairs to IRC with one call to the
+        transport.
+        """
+        chunks = []
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        for line, data in batch:
+            if debug:
+                self.logger.debug(data)
+            chunks.append(data)
+            chunks.append(b"\r\n")
+        payload = b"".join(chunks)
+        self.transport.write(payload)
+        self.writes += 1
+        self.lines_sent += len(batch)
+        self.bytes_sent += len(payload)
+        for line, data in batch:
+            dispatcher.send("irc-send", line)
+
+    def send_stats(self):
+        """
+        Return a dict describing what we've written to the transport, and how
+        much of it is still sitting in the transport's buffer.
+        """
+        return {
+            "bytes_sent": self.bytes_sent,
+            "lines_sent": self.lines_sent,
+            "writes": self.writes,
+            "buffered_bytes": self.transport.get_write_buffer_size(),
+            "paused": self.writing_paused,
+            "pauses": self.pauses,
+        }
+
+    def lag_stats(self):
+        """
+        Return a dict with the latest lag, the p50 and p99 lag over recent
+        keepalive PINGs, and the PONG timeout currently in use.
+        """
+        stats = self.keepalive.histogram.stats()
+        stats.update(lag=self.lag, timeout=self.keepalive.timeout(), timeouts=self.keepalive.timeouts)
+        return stats
+
+    def writeln(self, line, priority=None):
         """
         Queue a message for sending to the currently connected IRC server.
+        The line can be an RFC1459Message, a str, or already encoded bytes.
+        priority is one of CONTROL, INTERACTIVE or BULK; by default it's picked
+        from the verb.
         """
-        self.queue.append(line)
+        self.queue.push(line, priority)
+        if self._queue_handle is None and not self.writing_paused:
+            self._queue_handle = self.loop.call_soon(self.process_queue)
         return self
 
     def register(self, nick, user, realname, mode="+i", password=None):
@@ -155,37 +434,59 @@ class IRCProtocol(asyncio.Protocol):
         self.realname = realname
         self.mode = mode
         self.password = password
+        if self.registration_due:
+            self._register()
         return self
 
     def _register(self):
         """
         Send registration messages to IRC.
         """
+        if not self.work:
+            return
+        if not hasattr(self, "nick"):
+            self.registration_due = True
+            return
+        self.registration_due = False
         if self.password:
-            self.writeln("PASS {}".format(self.password))
-        self.writeln("USER {0} {1} {0} :{2}".format(self.user, self.mode, self.realname))
-        self.writeln("NICK {}".format(self.nick))
+            self.writeln(RFC1459Message.from_data("PASS", [self.password]))
+        self.writeln(RFC1459Message.from_data("USER", [self.user, self.mode, self.user, self.realname]))
+        self.writeln(RFC1459Message.from_data("NICK", [self.nick]))
         self.logger.debug("Sent registration information")
-        signal("registration-complete").send(self)
+        dispatcher.send("registration-complete", self)
         self.nickname = self.nick
 
     ## protocol abstractions
 
-    def join(self, channels):
+    def join(self, channels, keys=None):
         """
         Join channels. Pass a list to join all the channels, or a string to
-        join a single channel. If registration with the server is not yet
+        join a single channel. A channel's key can follow its name after a
+        space ("#secret hunter2"), or keys can be given as a list in the same
+        order as channels. If registration with the server is not yet
         complete, this will queue channels to join when registration is done.
         """
         if not isinstance(channels, list):
             channels = [channels]
-        channels_str = ",".join(channels)
+        keys = keys or []
+        keyed, unkeyed = [], []
+        for i, channel in enumerate(channels):
+            name, _, key = channel.strip().partition(" ")
+            key = key.strip() or (keys[i] if i < len(keys) else None)
+            if key:
+                keyed.append((name, key))
+            else:
+                unkeyed.append(name)
 
         if not self.registration_complete:
-            self.channels_to_join.append(channels_str)
-        else:
-            self.writeln("JOIN {}".format(channels_str))
-
+            self.channels_to_join.append(["{} {}".format(name, key) for name, key in keyed] + unkeyed)
+            return self
+
+        # keys go with the first channels in the list, so keyed ones come first
+        params = [",".join([name for name, _ in keyed] + unkeyed)]
+        if keyed:
+            params.append(",".join(key for _, key in keyed))
+        self.writeln(RFC1459Message.from_data("JOIN", params))
         return self
 
     def part(self, channels):
@@ -197,9 +498,9 @@ class IRCProtocol(asyncio.Protocol):
         if not isinstance(channels, list):
             channels = [channels]
         channels_str = ",".join(channels)
-        self.writeln("PART {}".format(channels_str))
+        self.writeln(RFC1459Message.from_data("PART", [channels_str]))
 
-    def say(self, target_str, message):
+    def say(self, target_str, message, priority=None):
         """
         Send a PRIVMSG to IRC.
         Carriage returns and line feeds are stripped to prevent bugs.
@@ -207,7 +508,7 @@ class IRCProtocol(asyncio.Protocol):
         message = message.replace("\n", "").replace("\r", "")
 
         while message:
-            self.writeln("PRIVMSG {} :{}".format(target_str, message[:400]))
+            self.writeln(RFC1459Message.from_data("PRIVMSG", [target_str, message[:400]]), priority)
             message = message[400:]
 
     def nick_in_use_handler(self):
@@ -231,50 +532,63 @@ class IRCProtocol(asyncio.Protocol):
     #     return _send_command
 
 def get_user(hostmask):
-    if "!" not in hostmask or "@" not in hostmask:
-        return User(hostmask, hostmask, hostmask)
-    return User.from_hostmask(hostmask)
+    nick, user, host = parse_hostmask(hostmask)
+    if user is None:
+        return User(hostmask, hostmask, hostmask, hostmask)
+    return User(nick, user, host, hostmask)
 
-def connect(server, port=6697, use_ssl=True):
+async def connect_async(server, port=6697, use_ssl=True, timeout=None):
     """
-    Connect to an IRC server. Returns a proxy to an IRCProtocol object.
+    Connect to an IRC server from inside a running event loop. Returns a
+    proxy to an IRCProtocol object. Raises asyncio.TimeoutError if the
+    connection (including the TLS handshake) takes longer than timeout
+    seconds.
     """
-    connector = loop.create_connection(IRCProtocol, host=server, port=port, ssl=use_ssl)
-    transport, protocol = loop.run_until_complete(connector)
-    protocol.wrapper = IRCProtocolWrapper(protocol)
-    protocol.server_info = {"host": server, "port": port, "ssl": use_ssl}
-    protocol.netid = "{}:{}:{}{}".format(id(protocol), server, port, "+" if use_ssl else "-")
-    signal("netid-available").send(protocol)
-    connections[protocol.netid] = protocol.wrapper
+    def create_protocol():
+        # everything data_received needs is set before connection_made
+        protocol = IRCProtocol(server_info={"host": server, "port": port, "ssl": use_ssl})
+        protocol.netid = "{}:{}:{}{}".format(id(protocol), server, port, "+" if use_ssl else "-")
+        protocol.wrapper = IRCProtocolWrapper(protocol)
+        return protocol
+
+    connector = asyncio.get_event_loop().create_connection(create_protocol, host=server, port=port, ssl=use_ssl)
+    transport, protocol = await asyncio.wait_for(connector, timeout)
+    dispatcher.send("netid-available", protocol)
+    connections.add(protocol.wrapper)
     return protocol.wrapper
 
+async def connect_many(servers, timeout=30):
+    """
+    Connect to several IRC servers at once. servers is a list of (server,
+    port, use_ssl) tuples; port and use_ssl can be left out. Returns a list
+    with, for each server in order, either a proxy to its IRCProtocol object
+    or the exception we got trying to connect.
+    """
+    attempts = [connect_async(*server, timeout=timeout) for server in servers]
+    return await asyncio.gather(*attempts, return_exceptions=True)
+
+def connect(server, port=6697, use_ssl=True, timeout=None):
+    """
+    Connect to an IRC server, blocking until the connection is made. Returns
+    a proxy to an IRCProtocol object. Use connect_async or connect_many if
+    the event loop is already running.
+    """
+    return loop.run_until_complete(connect_async(server, port, use_ssl, timeout))
+
 def disconnected(client_wrapper):
     """
-    Either reconnect the IRCProtocol object, or exit, depending on
-    configuration. Called by IRCProtocol when we lose the connection.
+    Hand the connection to its ReconnectSupervisor, or drop it if it
+    shouldn't reconnect. Called by IRCProtocol when we lose the connection.
     """
     client_wrapper.protocol.work = False
-    client_wrapper.logger.critical("Disconnected from {}. Attempting to reconnect...".format(client_wrapper.netid))
-    signal("disconnected").send(client_wrapper.protocol)
+    dispatcher.send("disconnected", client_wrapper.protocol)
     if not client_wrapper.protocol.autoreconnect:
-        import sys
-        sys.exit(2)
-
-    connector = loop.create_connection(IRCProtocol, **client_wrapper.server_info)
-    def reconnected(f):
-        """
-        Callback function for a successful reconnection.
-        """
-        client_wrapper.logger.critical("Reconnected! {}".format(client_wrapper.netid))
-        _, protocol = f.result()
-        protocol.register(client_wrapper.nick, client_wrapper.user, client_wrapper.realname, client_wrapper.mode, client_wrapper.password)
-        protocol.channels_to_join = client_wrapper.channels_to_join
-        protocol.server_info = client_wrapper.server_info
-        protocol.netid = client_wrapper.netid
-        protocol.wrapper = client_wrapper
-        signal("netid-available").send(protocol)
-        client_wrapper.protocol = protocol
-    asyncio.async(connector).add_done_callback(reconnected)
+        client_wrapper.logger.critical("Disconnected from {}.".format(client_wrapper.netid))
+        connections.remove(client_wrapper.netid)
+        return
+
+    client_wrapper.logger.critical("Disconnected from {}. Attempting to reconnect...".format(client_wrapper.netid))
+    client_wrapper.supervisor.start()
 
 signal("connection-lost").connect(disconnected)
 
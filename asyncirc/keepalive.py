@@ -0,0 +1,143 @@
+"""
+Keepalive PINGs and lag measurement for a connection.
+"""
+import bisect
+import collections
+import itertools
+import logging
+from asyncirc.parser import RFC1459Message
+
+logger = logging.getLogger("asyncirc.keepalive")
+
+class LagHistogram:
+    """
+    Round trip times of our PINGs. Percentiles are taken over the last
+    `window` samples, so they follow the server's current lag; the bucket
+    counts, sum and count cover every sample since the connection was made.
+    """
+    buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+    def __init__(self, window=128):
+        self.samples = collections.deque(maxlen=window)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, lag):
+        self.samples.append(lag)
+        self.counts[bisect.bisect_left(self.buckets, lag)] += 1
+        self.count += 1
+        self.sum += lag
+
+    def percentile(self, p):
+        """
+        The p-th percentile (0-100) of the recent samples, or None if there
+        aren't any yet.
+        """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def cumulative(self):
+        """
+        (upper bound, samples at or under it) pairs, like a Prometheus
+        histogram's buckets.
+        """
+        return list(zip(self.buckets, itertools.accumulate(self.counts)))
+
+    def stats(self):
+        return {
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+class Keepalive:
+    """
+    Sends a PING with its own token every `interval` seconds once we're
+    registered, and matches the PONGs to them to measure lag. A PING that
+    hasn't been answered after `timeout()` seconds means the connection is
+    dead, and it's aborted so it can be reconnected.
+
+    The timeout adapts to the server: it's `multiplier` times the p99 lag,
+    kept between min_timeout and max_timeout.
+    """
+    def __init__(self, client, interval=60.0, min_timeout=15.0, max_timeout=240.0, multiplier=10.0, window=128):
+        self.client = client
+        self.interval = interval
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.multiplier = multiplier
+        self.histogram = LagHistogram(window)
+        # token -> time the PING was queued
+        self.pending = collections.OrderedDict()
+        self.tokens = itertools.count(1)
+        self.timeouts = 0
+        self._ping_handle = None
+        self._timeout_handles = {}
+
+    @property
+    def running(self):
+        return self._ping_handle is not None
+
+    def timeout(self):
+        p99 = self.histogram.percentile(99)
+        if p99 is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.multiplier))
+
+    def start(self):
+        """
+        Start pinging, straight away. Called when registration completes.
+        """
+        self.stop()
+        self._ping_handle = self.client.loop.call_soon(self.ping)
+
+    def stop(self):
+        if self._ping_handle is not None:
+            self._ping_handle.cancel()
+            self._ping_handle = None
+        for handle in self._timeout_handles.values():
+            handle.cancel()
+        self._timeout_handles.clear()
+        self.pending.clear()
+
+    def ping(self):
+        loop = self.client.loop
+        token = "ka{}".format(next(self.tokens))
+        self.pending[token] = loop.time()
+        self._timeout_handles[token] = loop.call_later(self.timeout(), self.expire, token)
+        self._ping_handle = loop.call_later(self.interval, self.ping)
+        self.client.writeln(RFC1459Message.from_data("PING", [token]))
+
+    def pong(self, token):
+        """
+        Record the reply to one of our PINGs. Returns the lag, or None if
+        the token isn't one we're waiting for.
+        """
+        sent = self.pending.pop(token, None)
+        if sent is None:
+            return None
+        # a PONG also answers every PING sent before it
+        for older in [t for t, time_sent in self.pending.items() if time_sent <= sent]:
+            del self.pending[older]
+            self._timeout_handles.pop(older).cancel()
+        self._timeout_handles.pop(token).cancel()
+        lag = self.client.loop.time() - sent
+        self.histogram.add(lag)
+        return lag
+
+    def expire(self, token):
+        self._timeout_handles.pop(token, None)
+        if self.pending.pop(token, None) is None:
+            return
+        self.timeouts += 1
+        logger.warning("No PONG from {} to {}, dropping the connection".format(
+            getattr(self.client, "netid", self.client), token))
+        self.stop()
+        self.client.transport.abort()
@@ -0,0 +1,255 @@
+"""
+Metrics in the Prometheus text format.
+
+Connections keep plain counters as they go (bytes and lines in and out, how
+long it took to handle each chunk of data received) and the dispatcher
+counts every signal it sends. Timing a call costs about as much as a cheap
+signal receiver, so signal sends and parses are only timed one in sixteen.
+Nothing is formatted until something asks for it: render() walks the open
+connections and builds the exposition, and serve() answers Prometheus
+scrapes with it over HTTP.
+
+Per-connection metrics are labeled with the connection's netid. Signal and
+parse metrics are shared by every connection in the process.
+"""
+import asyncio
+import bisect
+import collections
+import itertools
+import logging
+from asyncirc.dispatch import dispatcher, connection_of
+
+logger = logging.getLogger("asyncirc.metrics")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class Histogram:
+    """
+    Bucketed observations with their count and sum, like a Prometheus
+    histogram. observe() is a bisect and three additions, so it's cheap
+    enough to call for every line.
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        (upper bound, observations at or under it) pairs.
+        """
+        return list(zip(self.buckets, itertools.accumulate(self.counts)))
+
+# how long handling a chunk of received data takes, every line in it parsed
+# and dispatched
+receive_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1.0)
+# how long RFC1459Message.from_message takes
+parse_buckets = (0.000002, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.001)
+
+parse_time = Histogram(parse_buckets)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Exposition:
+    """
+    Samples grouped into metric families, which render() writes out in the
+    order they were first added.
+    """
+    def __init__(self):
+        self.families = collections.OrderedDict()
+
+    def add(self, name, kind, help, value, labels=None, sample=None):
+        """
+        Add a sample to the family called name. sample is the sample's own
+        name, if it differs from the family's (histogram buckets, sums and
+        counts).
+        """
+        if name not in self.families:
+            self.families[name] = (kind, help, [])
+        self.families[name][2].append((sample or name, labels or {}, value))
+
+    def histogram(self, name, help, histogram, labels=None):
+        """
+        Add every bucket of a Histogram (or anything else with cumulative(),
+        count and sum, like a LagHistogram).
+        """
+        labels = labels or {}
+        for bound, count in histogram.cumulative():
+            self.add(name, "histogram", help, count, dict(labels, le=format_value(bound)), name + "_bucket")
+        self.add(name, "histogram", help, histogram.sum, labels, name + "_sum")
+        self.add(name, "histogram", help, histogram.count, labels, name + "_count")
+
+    def render(self):
+        out = []
+        for name, (kind, help, samples) in self.families.items():
+            out.append("# HELP {} {}".format(name, help.replace("\\", "\\\\").replace("\n", "\\n")))
+            out.append("# TYPE {} {}".format(name, kind))
+            for sample, labels, value in samples:
+                if labels:
+                    label_str = ",".join('{}="{}"'.format(k, escape_label(v)) for k, v in labels.items())
+                    out.append("{}{{{}}} {}".format(sample, label_str, format_value(value)))
+                else:
+                    out.append("{} {}".format(sample, format_value(value)))
+        return "\n".join(out) + "\n"
+
+# (name, type, help, function of a connection) for the simple per-connection
+# metrics
+connection_metrics = [
+    ("asyncirc_received_bytes_total", "counter", "Bytes received from the server.",
+     lambda client: client.bytes_received),
+    ("asyncirc_received_lines_total", "counter", "Lines received from the server.",
+     lambda client: client.lines_received),
+    ("asyncirc_dropped_lines_total", "counter", "Received lines dropped for being too long.",
+     lambda client: client.linebuffer.dropped),
+    ("asyncirc_sent_bytes_total", "counter", "Bytes written to the transport.",
+     lambda client: client.bytes_sent),
+    ("asyncirc_sent_lines_total", "counter", "Lines written to the transport.",
+     lambda client: client.lines_sent),
+    ("asyncirc_writes_total", "counter", "Writes to the transport.",
+     lambda client: client.writes),
+    ("asyncirc_transport_buffered_bytes", "gauge", "Bytes waiting in the transport's write buffer.",
+     lambda client: client.transport.get_write_buffer_size()),
+    ("asyncirc_send_queue_depth", "gauge", "Lines waiting in the send queue.",
+     lambda client: client.queue.depth),
+    ("asyncirc_send_queue_wait_seconds_total", "counter", "Time lines spent in the send queue.",
+     lambda client: client.queue.total_wait),
+    ("asyncirc_send_queue_wait_max_seconds", "gauge", "Longest time a line spent in the send queue.",
+     lambda client: client.queue.max_wait),
+    ("asyncirc_lag_seconds", "gauge", "Round trip time of the last keepalive PING.",
+     lambda client: client.lag),
+    ("asyncirc_ping_timeouts_total", "counter", "Keepalive PINGs that went unanswered.",
+     lambda client: client.keepalive.timeouts),
+    ("asyncirc_registered", "gauge", "Whether registration with the server is complete.",
+     lambda client: client.registration_complete),
+]
+
+# keys of ReconnectSupervisor.stats() and HandlerTasks.stats()
+reconnect_metrics = [
+    ("asyncirc_reconnects_total", "counter", "Successful reconnects.", "reconnects"),
+    ("asyncirc_reconnect_attempts_total", "counter", "Reconnect attempts.", "total_attempts"),
+    ("asyncirc_reconnect_failures_total", "counter", "Failed reconnect attempts.", "failures"),
+    ("asyncirc_disconnected_seconds_total", "counter", "Time spent reconnecting.", "downtime"),
+]
+handler_metrics = [
+    ("asyncirc_handler_tasks", "gauge", "Coroutine handlers running or waiting to run.", "in_flight"),
+    ("asyncirc_handler_tasks_completed_total", "counter", "Coroutine handlers that finished.", "completed"),
+    ("asyncirc_handler_tasks_failed_total", "counter", "Coroutine handlers that raised.", "failed"),
+]
+
+def collect_connection(exposition, client):
+    labels = {"netid": client.netid}
+    for name, kind, help, get in connection_metrics:
+        exposition.add(name, kind, help, get(client), labels)
+    for priority, depth in enumerate(client.queue.stats()["depth_by_priority"]):
+        exposition.add("asyncirc_send_queue_lane_depth", "gauge", "Lines waiting in each send queue lane.",
+                       depth, dict(labels, priority=priority))
+    exposition.add("asyncirc_send_queue_sent_total", "counter", "Lines taken off the send queue.",
+                   client.queue.sent, labels)
+    exposition.histogram("asyncirc_receive_seconds", "Time spent handling each chunk of data received.",
+                         client.receive_time, labels)
+    exposition.histogram("asyncirc_lag_histogram_seconds", "Round trip times of keepalive PINGs.",
+                         client.keepalive.histogram, labels)
+
+    supervisor = getattr(client, "supervisor", None)
+    if supervisor is not None:
+        stats = supervisor.stats()
+        for name, kind, help, key in reconnect_metrics:
+            exposition.add(name, kind, help, stats[key], labels)
+
+    tasks = dispatcher.handler_tasks.get(connection_of(client))
+    if tasks is not None:
+        stats = tasks.stats()
+        for name, kind, help, key in handler_metrics:
+            exposition.add(name, kind, help, stats[key], labels)
+
+    registry = getattr(client, "tracking_registry", None)
+    if registry is not None:
+        exposition.add("asyncirc_tracked_users", "gauge", "Users in the tracking registry.",
+                       len(registry.users), labels)
+        exposition.add("asyncirc_tracked_channels", "gauge", "Channels in the tracking registry.",
+                       len(registry.channels), labels)
+        exposition.add("asyncirc_tracked_memberships", "gauge", "Channel memberships in the tracking registry.",
+                       sum(map(len, registry.channel_users.values())), labels)
+
+def collect(clients=None):
+    """
+    Gather the metrics of every connection in clients (by default, every
+    open connection) and the process-wide ones into an Exposition.
+    """
+    if clients is None:
+        from asyncirc.irc import connections
+        clients = connections
+    exposition = Exposition()
+    exposition.add("asyncirc_connections", "gauge", "Open connections.", len(clients))
+    for client in clients:
+        collect_connection(exposition, client)
+    for name, (count, timed, seconds) in sorted(dispatcher.signal_stats.items()):
+        labels = {"signal": name}
+        exposition.add("asyncirc_signals_total", "counter", "Signals sent through the dispatcher.",
+                       count, labels)
+        help = "Time spent in a sample of signal sends, including signals their receivers sent."
+        exposition.add("asyncirc_signal_seconds", "summary", help, seconds, labels, "asyncirc_signal_seconds_sum")
+        exposition.add("asyncirc_signal_seconds", "summary", help, timed, labels, "asyncirc_signal_seconds_count")
+    exposition.histogram("asyncirc_parse_seconds", "Time spent parsing a sample of received lines.", parse_time)
+    return exposition
+
+def render(clients=None):
+    """
+    The metrics as Prometheus text.
+    """
+    return collect(clients).render()
+
+async def _handle_scrape(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 10)
+        while True:
+            header = await asyncio.wait_for(reader.readline(), 10)
+            if header in (b"\r\n", b"\n", b""):
+                break
+    except (asyncio.TimeoutError, ConnectionError):
+        writer.close()
+        return
+    parts = request.split()
+    if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] in (b"/", b"/metrics"):
+        try:
+            status, body, content_type = "200 OK", render().encode("utf-8"), CONTENT_TYPE
+        except Exception:
+            logger.exception("Couldn't collect metrics")
+            status, body, content_type = "500 Internal Server Error", b"", "text/plain"
+    else:
+        status, body, content_type = "404 Not Found", b"", "text/plain"
+    writer.write("HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+        status, content_type, len(body)).encode("ascii") + body)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+async def serve_async(port=9105, host="127.0.0.1"):
+    """
+    Serve the metrics over HTTP from inside the event loop, at /metrics.
+    Only listens on localhost unless you say otherwise. Returns the
+    asyncio Server.
+    """
+    return await asyncio.start_server(_handle_scrape, host, port)
+
+def serve(port=9105, host="127.0.0.1"):
+    """
+    Start serving the metrics over HTTP, blocking until we're listening.
+    """
+    return asyncio.get_event_loop().run_until_complete(serve_async(port, host))
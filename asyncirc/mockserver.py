@@ -0,0 +1,566 @@
+"""
+A small IRC server that runs on the event loop, for end-to-end tests and
+load tests that shouldn't need a network.
+
+It speaks just enough of the protocol for asyncirc's own connection path:
+registration, CAP LS/REQ/ACK/END, SASL PLAIN, JOIN/PART/NAMES/WHO (and
+WHOX), MODE queries, PING/PONG, PRIVMSG/NOTICE between connections, and
+ircd-style excess flood disconnects. Channels can be filled with thousands
+of simulated users, who can be made to talk, and the server can add latency
+to what it sends and drop lines on the way out.
+
+    server = MockServer(caps={"sasl", "multi-prefix"}, accounts={"bot": "hunter2"})
+    server.populate(users=5000, channels=200, members=100)
+    await server.start()
+    conn = await irc.connect_async("127.0.0.1", server.port, use_ssl=False)
+"""
+import asyncio
+import base64
+import collections
+import logging
+import random
+from asyncirc.parser import RFC1459Message, decode_line
+from asyncirc.throttle import TokenBucket
+
+logger = logging.getLogger("asyncirc.mockserver")
+
+def fold(name):
+    return name.lower().translate(_rfc1459)
+
+_rfc1459 = str.maketrans("[]\\~", "{}|^")
+
+class MockUser:
+    """
+    Someone on the mock network: one of the simulated users, or a real
+    connection once it's registered.
+    """
+    __slots__ = ("nick", "ident", "host", "realname", "account", "connection", "channels")
+
+    def __init__(self, nick, ident, host, realname, account=None, connection=None):
+        self.nick = nick
+        self.ident = ident
+        self.host = host
+        self.realname = realname
+        self.account = account
+        self.connection = connection
+        self.channels = set()
+
+    @property
+    def hostmask(self):
+        return "{}!{}@{}".format(self.nick, self.ident, self.host)
+
+class MockChannel:
+    __slots__ = ("name", "topic", "modes", "members", "connections")
+
+    def __init__(self, name, topic=None):
+        self.name = name
+        self.topic = topic
+        self.modes = "+nt"
+        # folded nick -> (MockUser, prefix symbols)
+        self.members = collections.OrderedDict()
+        # real connections in the channel, who get to hear what happens in it
+        self.connections = set()
+
+class MockConnection(asyncio.Protocol):
+    """
+    One client connected to the MockServer.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buf = bytearray()
+        self.user = None
+        self.nick = None
+        self.ident = None
+        self.realname = None
+        self.account = None
+        self.caps = set()
+        self.negotiating = False
+        self.registered = False
+        self.closed = False
+        self.lines_received = 0
+        self.lines_sent = 0
+        self.dropped = 0
+        self.flood = TokenBucket(server.flood_burst, server.flood_interval)
+        self._outbox = None
+        self._queue = None
+        self._last_due = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.server.connections.discard(self)
+        if self._outbox is not None:
+            self._outbox.cancel()
+        if self.user is not None:
+            self.server.quit(self.user, "Connection closed")
+
+    def data_received(self, data):
+        self.buf += data
+        *lines, rest = self.buf.split(b"\n")
+        self.buf = bytearray(rest)
+        for line in lines:
+            line = line.strip()
+            if not line or self.closed:
+                continue
+            self.lines_received += 1
+            if self.server.flood_burst and self.flood.delay():
+                self.error("Excess Flood")
+                return
+            self.flood.consume()
+            self.handle(RFC1459Message.from_message(decode_line(line)))
+
+    ## sending
+
+    def send(self, verb, params, source=None):
+        """
+        Send a line to this client, after the server's latency and unless
+        it's dropped.
+        """
+        if self.closed or self.transport.is_closing():
+            return
+        server = self.server
+        if server.drop_rate and server.rng.random() < server.drop_rate:
+            self.dropped += 1
+            return
+        data = RFC1459Message.from_data(verb, params, source or server.name).to_bytes() + b"\r\n"
+        self.lines_sent += 1
+        if not server.latency and not server.jitter:
+            self.transport.write(data)
+            return
+        loop = asyncio.get_event_loop()
+        # lines keep their order, however the jitter falls
+        due = max(self._last_due, loop.time() + server.latency + server.rng.uniform(0, server.jitter))
+        self._last_due = due
+        if self._outbox is None:
+            self._queue = asyncio.Queue()
+            self._outbox = asyncio.ensure_future(self._deliver())
+        self._queue.put_nowait((due, data))
+
+    async def _deliver(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            due, data = await self._queue.get()
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+            if self.closed or self.transport.is_closing():
+                return
+            self.transport.write(data)
+
+    def numeric(self, number, *params):
+        self.send(number, [self.nick or "*"] + list(params))
+
+    def error(self, reason):
+        """
+        Close the link, like a server does when it's had enough of us.
+        """
+        self.transport.write("ERROR :Closing Link: {} ({})\r\n".format(
+            self.nick or "*", reason).encode("utf-8"))
+        self.closed = True
+        self.transport.close()
+
+    ## commands
+
+    def handle(self, message):
+        verb = message.verb.upper()
+        handler = getattr(self, "on_" + verb.lower(), None)
+        if handler is None:
+            if self.registered:
+                self.numeric("421", verb, "Unknown command")
+            return
+        if not self.registered and verb not in self.unregistered_verbs:
+            self.numeric("451", "You have not registered")
+            return
+        try:
+            handler(message.params)
+        except IndexError:
+            self.numeric("461", verb, "Not enough parameters")
+
+    unregistered_verbs = {"CAP", "AUTHENTICATE", "PASS", "NICK", "USER", "PING", "PONG", "QUIT"}
+
+    def on_cap(self, params):
+        subcommand = params[0].upper()
+        if subcommand == "LS":
+            if not self.registered:
+                self.negotiating = True
+            self.send("CAP", [self.nick or "*", "LS", " ".join(sorted(self.server.caps))])
+        elif subcommand == "REQ":
+            requested = set(params[1].split())
+            if requested <= self.server.caps:
+                self.caps |= requested
+                self.send("CAP", [self.nick or "*", "ACK", params[1]])
+            else:
+                self.send("CAP", [self.nick or "*", "NAK", params[1]])
+        elif subcommand == "END":
+            self.negotiating = False
+            self.try_register()
+
+    def on_authenticate(self, params):
+        if "sasl" not in self.caps:
+            self.numeric("904", "SASL authentication failed")
+        elif params[0].upper() == "PLAIN":
+            self.send("AUTHENTICATE", ["+"])
+        else:
+            try:
+                authzid, authcid, password = base64.b64decode(params[0]).decode("utf-8").split("\x00")
+            except ValueError:
+                self.numeric("904", "SASL authentication failed")
+                return
+            if self.server.accounts.get(authcid) != password:
+                self.numeric("904", "SASL authentication failed")
+                return
+            self.account = authcid
+            self.numeric("900", "{}!{}@{}".format(self.nick or "*", self.ident or "*", self.server.host),
+                         authcid, "You are now logged in as {}".format(authcid))
+            self.numeric("903", "SASL authentication successful")
+
+    def on_pass(self, params):
+        pass
+
+    def on_nick(self, params):
+        nick = params[0]
+        holder = self.server.users.get(fold(nick))
+        if holder is not None and holder is not self.user:
+            self.numeric("433", nick, "Nickname is already in use")
+            return
+        if self.user is not None:
+            self.server.rename(self.user, nick)
+        self.nick = nick
+        self.try_register()
+
+    def on_user(self, params):
+        self.ident, self.realname = params[0], params[3]
+        self.try_register()
+
+    def try_register(self):
+        if self.registered or self.negotiating or not (self.nick and self.ident):
+            return
+        server = self.server
+        if fold(self.nick) in server.users:
+            self.numeric("433", self.nick, "Nickname is already in use")
+            self.nick = None
+            return
+        self.registered = True
+        self.user = MockUser(self.nick, "~" + self.ident, server.host, self.realname, self.account, self)
+        server.users[fold(self.nick)] = self.user
+        self.numeric("001", "Welcome to the {} IRC Network {}".format(server.network, self.user.hostmask))
+        self.numeric("002", "Your host is {}, running asyncirc-mockserver".format(server.name))
+        self.numeric("003", "This server was created just now")
+        self.numeric("004", server.name, "asyncirc-mockserver", "iosw", "biklmnopstv")
+        isupport = ["{}={}".format(k, v) if v is not None else k for k, v in server.isupport.items()]
+        for i in range(0, len(isupport), 12):
+            self.numeric("005", *(isupport[i:i + 12] + ["are supported by this server"]))
+        self.numeric("422", "MOTD File is missing")
+
+    def on_ping(self, params):
+        self.send("PONG", [self.server.name, params[0]])
+
+    def on_pong(self, params):
+        pass
+
+    def on_quit(self, params):
+        self.error("Quit: {}".format(params[0] if params else ""))
+
+    def on_join(self, params):
+        for name in params[0].split(","):
+            if not name.startswith("#"):
+                self.numeric("403", name, "No such channel")
+                continue
+            self.server.join(self.user, name)
+
+    def on_part(self, params):
+        for name in params[0].split(","):
+            self.server.part(self.user, name, params[1] if len(params) > 1 else None)
+
+    def on_names(self, params):
+        for name in params[0].split(","):
+            self.send_names(self.server.channels.get(fold(name)), name)
+
+    def send_names(self, channel, name):
+        if channel is not None:
+            multi = "multi-prefix" in self.caps
+            names = []
+            for user, prefix in channel.members.values():
+                names.append((prefix if multi else prefix[:1]) + user.nick)
+            for i in range(0, len(names), self.server.names_per_line):
+                self.numeric("353", "=", channel.name, " ".join(names[i:i + self.server.names_per_line]))
+        self.numeric("366", name, "End of /NAMES list.")
+
+    def on_who(self, params):
+        target = params[0]
+        whox = len(params) > 1 and params[1].startswith("%")
+        for name in target.split(","):
+            channel = self.server.channels.get(fold(name))
+            if channel is None:
+                continue
+            for user, prefix in channel.members.values():
+                if whox:
+                    self.numeric("354", channel.name, user.ident, user.host, user.nick, user.account or "0")
+                else:
+                    self.numeric("352", channel.name, user.ident, user.host, self.server.name, user.nick,
+                                 "H" + prefix[:1], "0 {}".format(user.realname))
+        self.numeric("315", target, "End of /WHO list.")
+
+    def on_mode(self, params):
+        channel = self.server.channels.get(fold(params[0]))
+        if channel is None:
+            if fold(params[0]) == fold(self.nick):
+                self.send("MODE", [self.nick] + params[1:], self.user.hostmask)
+            else:
+                self.numeric("403", params[0], "No such channel")
+            return
+        if len(params) == 1:
+            self.numeric("324", channel.name, channel.modes)
+        else:
+            self.server.broadcast(channel, "MODE", [channel.name] + params[1:], self.user.hostmask)
+
+    def on_topic(self, params):
+        channel = self.server.channels.get(fold(params[0]))
+        if channel is None:
+            self.numeric("403", params[0], "No such channel")
+        elif len(params) == 1:
+            if channel.topic:
+                self.numeric("332", channel.name, channel.topic)
+            else:
+                self.numeric("331", channel.name, "No topic is set")
+        else:
+            channel.topic = params[1]
+            self.server.broadcast(channel, "TOPIC", [channel.name, params[1]], self.user.hostmask)
+
+    def on_privmsg(self, params, verb="PRIVMSG"):
+        for target in params[0].split(","):
+            self.server.message(self.user, verb, target, params[1])
+
+    def on_notice(self, params):
+        self.on_privmsg(params, "NOTICE")
+
+class MockServer:
+    """
+    The mock IRC server. Listens on localhost on a free port by default.
+
+    latency and jitter (seconds) delay every line the server sends; drop_rate
+    is the chance that a line is lost on the way out. A client that sends
+    more than flood_burst lines in one go, or keeps up more than one line
+    every flood_interval seconds after that, is disconnected for excess
+    flood (flood_burst=0 turns that off).
+    """
+    names_per_line = 20
+
+    def __init__(self, name="irc.mock.invalid", network="Mock", caps=("sasl", "multi-prefix", "extended-join"),
+                 accounts=None, latency=0.0, jitter=0.0, drop_rate=0.0, flood_burst=20, flood_interval=0.5,
+                 seed=None):
+        self.name = name
+        self.host = "mock.invalid"
+        self.network = network
+        self.caps = set(caps)
+        self.accounts = dict(accounts or {})
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.flood_burst = flood_burst
+        self.flood_interval = flood_interval
+        self.rng = random.Random(seed)
+        self.isupport = collections.OrderedDict([
+            ("NETWORK", network), ("CASEMAPPING", "rfc1459"), ("CHANTYPES", "#"),
+            ("PREFIX", "(ov)@+"), ("CHANMODES", "b,k,l,imnpst"), ("WHOX", None),
+            ("TARGMAX", "NAMES:1,WHO:4,PRIVMSG:4,NOTICE:4,JOIN:"),
+        ])
+        self.users = {}
+        self.channels = {}
+        self.connections = set()
+        self.server = None
+        self.port = None
+        self._chatter = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.get_event_loop().create_server(lambda: MockConnection(self), host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def close(self):
+        """
+        Stop listening and close every connection.
+        """
+        self.stop_chatter()
+        if self.server is not None:
+            self.server.close()
+        for connection in list(self.connections):
+            connection.transport.close()
+
+    def kill(self, connection, reason="Killed"):
+        """
+        Drop one client's connection, to test reconnecting.
+        """
+        connection.error(reason)
+
+    ## the simulated network
+
+    def populate(self, users=1000, channels=100, members=50, seed=0):
+        """
+        Create users simulated users and channels channels with members of
+        them in each, some with op or voice. Returns the channel names.
+        """
+        rng = random.Random(seed)
+        start = len(self.users)
+        simulated = []
+        for i in range(start, start + users):
+            nick = "user{}".format(i)
+            user = MockUser(nick, "~u{}".format(i), "sim{}.{}".format(i % 256, self.host),
+                            "Simulated user {}".format(i), "acct{}".format(i) if i % 3 else None)
+            self.users[fold(nick)] = user
+            simulated.append(user)
+        names = []
+        for i in range(channels):
+            name = "#chan{}".format(len(self.channels))
+            channel = self.channels[fold(name)] = MockChannel(name, "Topic of {}".format(name))
+            for j, user in enumerate(rng.sample(simulated, min(members, len(simulated)))):
+                prefix = "@" if j % 25 == 0 else "+" if j % 5 == 0 else ""
+                channel.members[fold(user.nick)] = (user, prefix)
+                user.channels.add(fold(name))
+            names.append(name)
+        return names
+
+    def broadcast(self, channel, verb, params, source, exclude=None):
+        for connection in channel.connections:
+            if connection is not exclude:
+                connection.send(verb, params, source)
+
+    def join(self, user, name):
+        key = fold(name)
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = MockChannel(name)
+        if fold(user.nick) in channel.members:
+            return
+        first = not channel.members
+        channel.members[fold(user.nick)] = (user, "@" if first else "")
+        user.channels.add(key)
+        if user.connection is not None:
+            channel.connections.add(user.connection)
+        for connection in channel.connections:
+            if "extended-join" in connection.caps:
+                connection.send("JOIN", [channel.name, user.account or "*", user.realname], user.hostmask)
+            else:
+                connection.send("JOIN", [channel.name], user.hostmask)
+        if user.connection is not None:
+            if channel.topic:
+                user.connection.numeric("332", channel.name, channel.topic)
+            user.connection.send_names(channel, channel.name)
+
+    def part(self, user, name, reason=None):
+        channel = self.channels.get(fold(name))
+        if channel is None or fold(user.nick) not in channel.members:
+            if user.connection is not None:
+                user.connection.numeric("442", name, "You're not on that channel")
+            return
+        self.broadcast(channel, "PART", [channel.name] + ([reason] if reason else []), user.hostmask)
+        del channel.members[fold(user.nick)]
+        channel.connections.discard(user.connection)
+        user.channels.discard(fold(name))
+
+    def quit(self, user, reason):
+        """
+        Take user off the network, telling everyone who shares a channel
+        with them.
+        """
+        told = set()
+        for key in user.channels:
+            channel = self.channels[key]
+            del channel.members[fold(user.nick)]
+            channel.connections.discard(user.connection)
+            told |= channel.connections
+        user.channels.clear()
+        for connection in told:
+            connection.send("QUIT", [reason], user.hostmask)
+        if self.users.get(fold(user.nick)) is user:
+            del self.users[fold(user.nick)]
+
+    def rename(self, user, nick):
+        old, new = fold(user.nick), fold(nick)
+        hostmask = user.hostmask
+        told = {user.connection} if user.connection is not None else set()
+        for key in user.channels:
+            channel = self.channels[key]
+            members = channel.members
+            members[new] = (user, members.pop(old)[1])
+            told |= channel.connections
+        del self.users[old]
+        self.users[new] = user
+        user.nick = nick
+        for connection in told:
+            connection.send("NICK", [nick], hostmask)
+
+    def message(self, user, verb, target, text):
+        if target.startswith("#"):
+            channel = self.channels.get(fold(target))
+            if channel is None:
+                if user.connection is not None:
+                    user.connection.numeric("401", target, "No such nick/channel")
+                return
+            self.broadcast(channel, verb, [channel.name, text], user.hostmask, exclude=user.connection)
+            return
+        recipient = self.users.get(fold(target))
+        if recipient is None:
+            if user.connection is not None:
+                user.connection.numeric("401", target, "No such nick/channel")
+        elif recipient.connection is not None:
+            recipient.connection.send(verb, [recipient.nick, text], user.hostmask)
+
+    ## making the simulated users do things
+
+    def simulated_members(self, channel):
+        return [user for user, _ in channel.members.values() if user.connection is None]
+
+    def chatter(self, count=1):
+        """
+        Have simulated users say something in count random channels that
+        a real connection is in.
+        """
+        channels = [channel for channel in self.channels.values() if channel.connections]
+        for _ in range(count if channels else 0):
+            channel = self.rng.choice(channels)
+            members = self.simulated_members(channel)
+            if members:
+                words = " ".join("word{}".format(self.rng.randrange(1000)) for _ in range(self.rng.randint(1, 12)))
+                self.message(self.rng.choice(members), "PRIVMSG", channel.name, words)
+
+    def start_chatter(self, rate):
+        """
+        Keep simulated users talking, rate lines per second in total.
+        """
+        self.stop_chatter()
+        loop = asyncio.get_event_loop()
+        # a tick every 10ms at most, saying as many lines as have come due
+        interval = max(0.01, 1.0 / rate)
+        per_tick = max(1, int(rate * interval))
+
+        def tick():
+            self.chatter(per_tick)
+            self._chatter = loop.call_later(interval, tick)
+        self._chatter = loop.call_soon(tick)
+
+    def stop_chatter(self):
+        if self._chatter is not None:
+            self._chatter.cancel()
+            self._chatter = None
+
+    def netsplit(self, share=0.5, reason="*.net *.split"):
+        """
+        QUIT a share of the simulated users, and return them so they can
+        come back with netjoin.
+        """
+        simulated = [user for user in self.users.values() if user.connection is None]
+        gone = self.rng.sample(simulated, int(len(simulated) * share))
+        returning = [(user, [self.channels[key].name for key in user.channels]) for user in gone]
+        for user in gone:
+            self.quit(user, reason)
+        return returning
+
+    def netjoin(self, returning):
+        for user, channels in returning:
+            self.users[fold(user.nick)] = user
+            for name in channels:
+                self.join(user, name)
@@ -17,10 +17,81 @@ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
+def decode_line(line):
+    """
+    Decode a single line received from IRC. UTF-8 is tried first; anything
+    that isn't valid UTF-8 is assumed to be latin-1.
+    """
+    try:
+        return line.decode("utf-8")
+    except UnicodeDecodeError:
+        return line.decode("latin-1")
+
+TAG_UNESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+TAG_ESCAPES = str.maketrans({v: "\\" + k for k, v in TAG_UNESCAPES.items()})
+
+def escape_tag_value(value):
+    """
+    Apply IRCv3 message tag value escaping.
+    """
+    return value.translate(TAG_ESCAPES)
+
+def unescape_tag_value(value):
+    """
+    Undo IRCv3 message tag value escaping.
+    """
+    if "\\" not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for c in chars:
+        if c == "\\":
+            # a lone backslash at the end of the value is dropped
+            c = next(chars, "")
+            c = TAG_UNESCAPES.get(c, c)
+        out.append(c)
+    return "".join(out)
+
+def parse_tags(tag_str):
+    """
+    Parse the tag section of a message (without the leading @) into a dict.
+    Tags without a value are given an empty string as their value.
+    """
+    tags = {}
+    for tag in tag_str.split(";"):
+        if tag:
+            key, _, value = tag.partition("=")
+            tags[key] = unescape_tag_value(value)
+    return tags
+
 class RFC1459Message(object):
     """
     Represents an IRC message.
     """
+    __slots__ = ("verb", "params", "source", "client", "_tags", "_raw_tags")
+
+    def __init__(self, verb=None, params=None, source=None, tags=None):
+        self.verb = verb
+        self.params = params if params is not None else []
+        self.source = source
+        self.client = None
+        self._tags = dict(tags) if tags else None
+        self._raw_tags = None
+
+    @property
+    def tags(self):
+        """
+        The message's IRCv3 tags. Tags are only parsed and unescaped the first
+        time they're looked at.
+        """
+        if self._tags is None:
+            self._tags = parse_tags(self._raw_tags) if self._raw_tags else {}
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
+        self._raw_tags = None
 
     @classmethod
     def from_data(cls, verb, params=None, source=None, tags=None):
@@ -28,61 +99,97 @@ class RFC1459Message(object):
         Create a new RFC1459Message from the given verb, parameters, and source
         having the given tags.
         """
-        o = cls()
-        o.verb = verb
-        o.tags = dict()
-        o.source = None
-        o.params = list()
-
-        if params:
-            o.params = params
-
-        if source:
-            o.source = source
-
-        if tags:
-            o.tags.update(**tags)
-
-        return o
+        return cls(verb, params, source, tags)
 
     @classmethod
     def from_message(cls, message):
         """
-        Create a new RFC1459Message from an unparsed IRC line.
+        Create a new RFC1459Message from an unparsed IRC line, given either as
+        str or as bytes.
         """
-        if isinstance(message, bytes):
-            message = message.decode('UTF-8', 'replace')
+        if isinstance(message, (bytes, bytearray)):
+            message = decode_line(message)
 
-        s = message.split(' ')
+        raw_tags = None
+        if message.startswith("@"):
+            raw_tags, _, message = message[1:].partition(" ")
+            message = message.lstrip(" ")
 
-        tags = None
-        if s[0].startswith('@'):
-            tag_str = s[0][1:].split(';')
-            s = s[1:]
-            tags = {}
+        source = None
+        if message.startswith(":"):
+            source, _, message = message[1:].partition(" ")
+            message = message.lstrip(" ")
+
+        message, has_trailing, trailing = message.partition(" :")
+        # only spaces separate parameters; str.split() would also split on
+        # unicode whitespace and the formatting characters \x1c-\x1f
+        params = [param for param in message.split(" ") if param]
+        if has_trailing:
+            params.append(trailing)
+
+        o = cls.__new__(cls)
+        o.verb = params.pop(0).upper() if params else ""
+        o.params = params
+        o.source = source
+        o.client = None
+        o._tags = None
+        o._raw_tags = raw_tags
+        return o
+
+    def snapshot(self):
+        """
+        Return a copy of this message without its client, which can be
+        pickled and handed to another process.
+        """
+        o = self.__class__.__new__(self.__class__)
+        o.verb = self.verb
+        o.params = list(self.params)
+        o.source = self.source
+        o.client = None
+        o._tags = dict(self._tags) if self._tags is not None else None
+        o._raw_tags = self._raw_tags
+        return o
 
-            for tag in tag_str:
-                k, v = tag.split('=', 1)
-                tags[k] = v
+    def to_message(self):
+        """
+        Serialize this message to an IRC line (without the trailing CRLF).
+        The last parameter is sent as a trailing parameter when it needs to
+        be. Raises ValueError if the message can't be represented on the wire.
+        """
+        parts = []
+        if self._tags:
+            parts.append("@" + ";".join(
+                k + "=" + escape_tag_value(v) if v else k for k, v in self._tags.items()))
+        elif self._tags is None and self._raw_tags:
+            parts.append("@" + self._raw_tags)
+        if self.source:
+            parts.append(":" + self.source)
+        parts.append(self.verb)
+
+        params = self.params
+        if params:
+            for param in params[:-1]:
+                if not param or " " in param or param[0] == ":":
+                    raise ValueError("invalid middle parameter {!r}".format(param))
+            parts.extend(params[:-1])
+            last = params[-1]
+            if not last or " " in last or last[0] == ":":
+                last = ":" + last
+            parts.append(last)
+
+        line = " ".join(parts)
+        if "\r" in line or "\n" in line:
+            raise ValueError("line breaks are not allowed in IRC messages")
+        return line
+
+    def to_bytes(self):
+        """
+        Serialize this message to UTF-8 encoded bytes (without the trailing
+        CRLF).
+        """
+        return self.to_message().encode("utf-8")
 
-        source = None
-        if s[0].startswith(':'):
-            source = s[0][1:]
-            s = s[1:]
-
-        verb = s[0].upper()
-        params = s[1:]
-
-        for param in params:
-            if param.startswith(':'):
-                idx = params.index(param)
-                arg = ' '.join(params[idx:])
-                arg = arg[1:]
-                params = params[:idx]
-                params.append(arg)
-                break
-
-        return cls.from_data(verb, params, source, tags)
+    __bytes__ = to_bytes
 
     def __str__(self):
         return 'RFC1459Message: verb={}, params={}, source={}'.format(self.verb, self.params, self.source)
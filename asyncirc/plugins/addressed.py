@@ -1,18 +1,168 @@
 from blinker import signal
+from asyncirc.dispatch import dispatcher
+import functools
+import re
 
 command_character_registry = []
 
+# compiled trigger patterns, by nickname
+_triggers = {}
+_max_triggers = 64
+
 def register_command_character(c):
     command_character_registry.append(c)
+    _triggers.clear()
+
+def compile_triggers(nickname):
+    """
+    Build the pattern that matches the start of a message addressed to
+    nickname: "nickname: ", "nickname, ", "nickname " or one of the
+    registered command characters, tried in that order.
+    """
+    triggers = ["{}: ", "{}, ", "{} "]
+    triggers = [i.format(nickname) for i in triggers] + command_character_registry
+    return re.compile("|".join(re.escape(trigger) for trigger in triggers))
+
+def triggers_for(nickname):
+    """
+    Return the compiled triggers for nickname. They're only compiled again
+    when the nickname or the command characters change.
+    """
+    try:
+        return _triggers[nickname]
+    except KeyError:
+        if len(_triggers) >= _max_triggers:
+            _triggers.clear()
+        pattern = _triggers[nickname] = compile_triggers(nickname)
+        return pattern
 
 def handle_public_messages(message, user, target, text):
-    prefix = message.client.nickname
-    triggers = [i.format(prefix) for i in ["{}: ", "{}, ", "{} "] + command_character_registry]
-    for trigger in triggers:
-        if text.startswith(trigger):
-            text = text[len(trigger):]
-            signal("addressed").send(message, user=user, target=target, text=text)
+    match = triggers_for(message.client.nickname).match(text)
+    if match is not None:
+        dispatcher.send("addressed", message, user=user, target=target, text=text[match.end():])
+
+class CommandTrie:
+    """
+    Command names by prefix, for working out which command an abbreviation
+    stands for. Each node remembers every name below it.
+    """
+    def __init__(self):
+        self.root = ({}, set())
+
+    def add(self, name):
+        children, names = self.root
+        names.add(name)
+        for c in name:
+            children, names = children.setdefault(c, ({}, set()))
+            names.add(name)
+
+    def remove(self, name):
+        children, names = self.root
+        names.discard(name)
+        for c in name:
+            if c not in children:
+                return
+            child = children[c]
+            child[1].discard(name)
+            if not child[1]:
+                del children[c]
+                return
+            children = child[0]
+
+    def candidates(self, prefix):
+        """
+        Return the set of names that start with prefix.
+        """
+        children, names = self.root
+        for c in prefix:
+            try:
+                children, names = children[c]
+            except KeyError:
+                return set()
+        return names
+
+def split_args(text):
+    return tuple(text.split())
+
+class Command:
+    """
+    A registered command. parser turns the text after the command name into
+    the arguments handlers get; its results are cached (up to cache_size
+    different texts), so it has to return something immutable, like a tuple.
+    """
+    def __init__(self, name, parser=split_args, cache_size=256):
+        self.name = name
+        self.signal = "command-" + name
+        self.parser = parser
+        self.parse = functools.lru_cache(maxsize=cache_size)(parser) if cache_size else parser
+
+class CommandRouter:
+    """
+    Routes addressed messages like "bot: roll 2d6" to handlers of the command
+    they name, as the command-<name> signal. Names are matched without
+    regard to case, and a unique prefix of a name (like "ro") works too
+    unless abbreviations is False. A prefix that could stand for more than
+    one command sends command-ambiguous instead.
+    """
+    def __init__(self, abbreviations=True):
+        self.abbreviations = abbreviations
+        self.commands = {}
+        self.trie = CommandTrie()
+
+    def register(self, name, parser=split_args, cache_size=256):
+        name = name.lower()
+        command = self.commands[name] = Command(name, parser, cache_size)
+        self.trie.add(name)
+        return command
+
+    def unregister(self, name):
+        name = name.lower()
+        if self.commands.pop(name, None) is not None:
+            self.trie.remove(name)
+
+    def command(self, name, parser=split_args, cache_size=256):
+        """
+        Decorator that registers the command and connects f to its signal.
+        f gets called with message, user, target and args.
+        """
+        command = self.register(name, parser, cache_size)
+        def decorator(f):
+            signal(command.signal).connect(f)
+            return f
+        return decorator
+
+    def resolve(self, name):
+        """
+        Return the Command that name refers to, a set of candidate names if
+        it's an ambiguous abbreviation, or None.
+        """
+        name = name.lower()
+        command = self.commands.get(name)
+        if command is not None or not self.abbreviations or not name:
+            return command
+        candidates = self.trie.candidates(name)
+        if len(candidates) == 1:
+            return self.commands[next(iter(candidates))]
+        return set(candidates) or None
+
+    def route(self, message, user, target, text):
+        if not self.commands:
             return
+        name, _, rest = text.lstrip().partition(" ")
+        if not name:
+            return
+        command = self.resolve(name)
+        if command is None:
+            return
+        if isinstance(command, set):
+            dispatcher.send("command-ambiguous", message, user=user, target=target, command=name,
+                            candidates=sorted(command))
+            return
+        dispatcher.send(command.signal, message, user=user, target=target, args=command.parse(rest))
+
+router = CommandRouter()
+command = router.command
 
 signal("public-message").connect(handle_public_messages)
-signal("plugin-registered").send("asyncirc.plugins.addressed")
+signal("addressed").connect(router.route)
+dispatcher.send("plugin-registered", "asyncirc.plugins.addressed")
@@ -1,4 +1,6 @@
 from blinker import signal
+from asyncirc.dispatch import dispatcher
+from asyncirc.parser import RFC1459Message
 
 import logging
 logger = logging.getLogger("asyncirc.plugins.cap")
@@ -6,6 +8,8 @@ logger = logging.getLogger("asyncirc.plugins.cap")
 capabilities_requested = {}
 capabilities_available = {}
 capabilities_pending = {}
+# the caps in the latest CAP ACK, by netid
+capabilities_acknowledged = {}
 registration_state = {}
 
 def request_capability(netid, cap):
@@ -14,19 +18,30 @@ def request_capability(netid, cap):
     capabilities_requested[netid].add(cap)
 
 def request_capabilities(client, caps):
-    if len(registration_state[client.netid]) >= 2:
-        client.writeln("CAP REQ :{}".format(" ".join(list(caps))))
+    if len(registration_state.get(client.netid, ())) >= 2:
+        pending = capabilities_pending.get(client.netid)
+        if pending:
+            # don't wait on caps the server doesn't have
+            pending &= capabilities_available.get(client.netid, set())
+        if not caps:
+            # nothing we want, so don't hold up registration
+            check_all_caps_done(client)
+            return
+        client.writeln(RFC1459Message.from_data("CAP", ["REQ", " ".join(caps)]))
         client.caps |= caps
 
 def registration_complete(client):
-    registration_state[client.netid].add("registered")
-    request_capabilities(client, capabilities_available[client.netid] & capabilities_requested[client.netid])
+    # connections made before this plugin was imported never got a CAP LS
+    registration_state.setdefault(client.netid, set()).add("registered")
+    request_capabilities(client, capabilities_available.get(client.netid, set()) &
+                         capabilities_requested.get(client.netid, set()))
 
 def handle_client_create(client):
-    capabilities_available[client.netid] = set()
-    registration_state[client.netid] = set()
-    capabilities_pending[client.netid] = set()
-    client.writeln("CAP LS")
+    # keep anything a CAP LS that beat netid-available already told us
+    capabilities_available.setdefault(client.netid, set())
+    registration_state.setdefault(client.netid, set())
+    capabilities_pending.setdefault(client.netid, set())
+    client.writeln(RFC1459Message.from_data("CAP", ["LS"]))
 
 def handle_client_death(client):
     capabilities_available[client.netid] = set()
@@ -35,10 +50,10 @@ def handle_client_death(client):
 
 def check_all_caps_done(client):
     if client.netid not in capabilities_pending or not capabilities_pending[client.netid]:
-        client.writeln("CAP END")
+        client.writeln(RFC1459Message.from_data("CAP", ["END"]))
 
 def cap_done(client, cap):
-    capabilities_pending[client.netid].remove(cap)
+    capabilities_pending.get(client.netid, set()).discard(cap)
     check_all_caps_done(client)
 
 def cap_wait(netid, cap):
@@ -59,11 +74,20 @@ def handle_irc_cap(message):
         if message.client.netid not in registration_state:
             registration_state[message.client.netid] = set()
         registration_state[message.client.netid].add("caps-known")
-        request_capabilities(message.client, capabilities_available[message.client.netid] & capabilities_requested[message.client.netid])
+        request_capabilities(message.client, capabilities_available[message.client.netid] &
+                             capabilities_requested.get(message.client.netid, set()))
 
     if message.params[1] == "ACK":
         logger.debug("ACK received from server, ending capability negotiation. {}".format(message.client.caps))
-        signal("caps-acknowledged").send(message.client)
+        capabilities_acknowledged[message.client.netid] = set(message.params[2].split())
+        dispatcher.send("caps-acknowledged", message.client)
+        check_all_caps_done(message.client)
+
+    if message.params[1] == "NAK":
+        logger.debug("Server refused capabilities {}".format(message.params[2]))
+        for cap in message.params[2].split():
+            message.client.caps.discard(cap)
+            capabilities_pending.get(message.client.netid, set()).discard(cap)
         check_all_caps_done(message.client)
 
 signal("registration-complete").connect(registration_complete)
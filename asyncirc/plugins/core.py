@@ -1,25 +1,41 @@
 from blinker import signal
-from asyncirc.irc import get_user
+from asyncirc.dispatch import dispatcher
+from asyncirc.irc import get_user, parse_hostmask
+from asyncirc.metrics import parse_time
 from asyncirc.parser import RFC1459Message
 
 import asyncio
+import itertools
 import logging
 import time
 logger = logging.getLogger("asyncirc.plugins.core")
 
-ping_clients = []
+_observe_parse = parse_time.observe
+# time one parse in this many
+_parse_sample = itertools.cycle([True] + [False] * 15)
 
 def _pong(message):
-    message.client.writeln("PONG {}".format(message.params[0]))
+    message.client.writeln(RFC1459Message.from_data("PONG", [message.params[0]]))
+
+_message_signals = {
+    mtype: (mtype, "private-" + mtype, "public-" + mtype) for mtype in ("message", "notice")
+}
 
 def _redispatch_message_common(message, mtype):
-    target, text = message.params[0], message.params[1]
+    any_signal, private_signal, public_signal = _message_signals[mtype]
+    target = message.params[0]
+    specific_signal = private_signal if target == message.client.nickname else public_signal
+    send_any = dispatcher.has_receivers(any_signal)
+    send_specific = dispatcher.has_receivers(specific_signal)
+    if not (send_any or send_specific):
+        return
+
+    text = message.params[1]
     user = get_user(message.source)
-    signal(mtype).send(message, user=user, target=target, text=text)
-    if target == message.client.nickname:
-        signal("private-{}".format(mtype)).send(message, user=user, target=target, text=text)
-    else:
-        signal("public-{}".format(mtype)).send(message, user=user, target=target, text=text)
+    if send_any:
+        dispatcher.send(any_signal, message, user=user, target=target, text=text)
+    if send_specific:
+        dispatcher.send(specific_signal, message, user=user, target=target, text=text)
 
 def _redispatch_privmsg(message):
     _redispatch_message_common(message, "message")
@@ -28,29 +44,37 @@ def _redispatch_notice(message):
     _redispatch_message_common(message, "notice")
 
 def _redispatch_join(message):
-    signal("join").send(message, user=get_user(message.source), channel=message.params[0])
+    if dispatcher.has_receivers("join"):
+        dispatcher.send("join", message, user=get_user(message.source), channel=message.params[0])
 
 def _redispatch_part(message):
+    if not dispatcher.has_receivers("part"):
+        return
     user = get_user(message.source)
     channel, reason = message.params[0], None
     if len(message.params) > 1:
         reason = message.params[1]
-    signal("part").send(message, user=user, channel=channel, reason=reason)
+    dispatcher.send("part", message, user=user, channel=channel, reason=reason)
 
 def _redispatch_quit(message):
-    signal("quit").send(message, user=get_user(message.source), reason=message.params[0])
+    if dispatcher.has_receivers("quit"):
+        dispatcher.send("quit", message, user=get_user(message.source), reason=message.params[0])
 
 def _redispatch_kick(message):
+    if not dispatcher.has_receivers("kick"):
+        return
+    # the kickee is only a nickname, there's no hostmask to go with it
     kicker = get_user(message.source)
-    channel, kickee, reason = message.params[0], get_user(message.params[1]), message.params[2]
-    signal("kick").send(message, kicker=kicker, kickee=kickee, channel=channel, reason=reason)
+    channel, kickee = message.params[0], message.params[1]
+    reason = message.params[2] if len(message.params) > 2 else None
+    dispatcher.send("kick", message, kicker=kicker, kickee=kickee, channel=channel, reason=reason)
 
 def _redispatch_nick(message):
-    old_user = get_user(message.source)
     new_nick = message.params[0]
-    if old_user.nick == message.client.nickname:
+    if parse_hostmask(message.source)[0] == message.client.nickname:
         message.client.nickname = new_nick
-    signal("nick").send(message, user=old_user, new_nick=new_nick)
+    if dispatcher.has_receivers("nick"):
+        dispatcher.send("nick", message, user=get_user(message.source), new_nick=new_nick)
 
 def _parse_mode(message):
     # :ChanServ!ChanServ@services. MODE ##fwilson +o fwilson
@@ -59,8 +83,7 @@ def _parse_mode(message):
         argument_modes += message.client.server_supports["PREFIX"].split(")")[0][1:]
     else:
         argument_modes = "beIqaohvlk"
-    print("argument_modes are", argument_modes)
-    user = get_user(message.source)
+    user = None
     channel = message.params[0]
     modes = message.params[1]
     args = message.params[2:]
@@ -73,60 +96,76 @@ def _parse_mode(message):
             arg = args.pop(0)
         else:
             arg = None
-        signal("{}mode".format(flag)).send(message, mode=mode, arg=arg, user=user, channel=channel)
-        signal("mode {}{}".format(flag, mode)).send(message, arg=arg, user=user, channel=channel)
+        flag_signal, mode_signal = flag + "mode", "mode " + flag + mode
+        send_flag = dispatcher.has_receivers(flag_signal)
+        send_mode = dispatcher.has_receivers(mode_signal)
+        if not (send_flag or send_mode):
+            continue
+        if user is None:
+            user = get_user(message.source)
+        if send_flag:
+            dispatcher.send(flag_signal, message, mode=mode, arg=arg, user=user, channel=channel)
+        if send_mode:
+            dispatcher.send(mode_signal, message, arg=arg, user=user, channel=channel)
 
 def _server_supports(message):
     supports = message.params[1:-1]  # No need for "Are supported by this server" or bot's nickname
     logging.debug("Server supports {}".format(supports))
     for feature in supports:
         if "=" in feature:
-            k, v = feature.split("=")
+            k, v = feature.split("=", 1)
             message.client.server_supports[k] = v
         else:
             message.client.server_supports[feature] = True
+    dispatcher.send("server-supports", message)
 
 def _nick_in_use(message):
     message.client.old_nickname = message.client.nickname
     s = message.client.nick_in_use_handler()
     def callback():
         message.client.nickname = s
-        message.client.writeln("NICK {}".format(s))
-    loop.call_later(5, callback)
-
-def _ping_servers():
-    for client in ping_clients:
-        if client.last_pong != 0 and time.time() - client.last_pong > 90:
-            client.connection_lost(Exception())
-        client.writeln("PING :GNIP")
-        client.last_ping = time.time()
-    asyncio.get_event_loop().call_later(60, _ping_servers)
+        message.client.writeln(RFC1459Message.from_data("NICK", [s]))
+    asyncio.get_event_loop().call_later(5, callback)
 
 def _catch_pong(message):
-    message.client.last_pong = time.time()
-    message.client.lag = message.client.last_pong - message.client.last_ping
+    lag = message.client.keepalive.pong(message.params[-1])
+    if lag is not None:
+        message.client.last_pong = time.time()
+        message.client.last_ping = message.client.last_pong - lag
+        message.client.lag = lag
+
+_verb_signals = {}
 
 def _redispatch_irc(message):
-    signal("irc-{}".format(message.verb.lower())).send(message)
+    try:
+        name = _verb_signals[message.verb]
+    except KeyError:
+        name = _verb_signals[message.verb] = "irc-" + message.verb.lower()
+    dispatcher.send(name, message)
 
 def _redispatch_raw(client, text):
-    message = RFC1459Message.from_message(text)
+    if next(_parse_sample):
+        start = time.perf_counter()
+        message = RFC1459Message.from_message(text)
+        _observe_parse(time.perf_counter() - start)
+    else:
+        message = RFC1459Message.from_message(text)
     message.client = client
-    signal("irc").send(message)
+    dispatcher.send("irc", message)
 
 def _register_client(client):
     logger.debug("Sending real registration message")
     asyncio.get_event_loop().call_later(1, client._register)
 
-def _queue_ping(client):
-    ping_clients.append(client)
-    _ping_servers()
-
 def _connection_registered(message):
     message.client.registration_complete = True
-    _queue_ping(message.client)
+    message.client.keepalive.start()
+    supervisor = getattr(message.client.wrapper, "supervisor", None)
+    if supervisor is not None:
+        supervisor.registered()
     for channel in message.client.channels_to_join:
         message.client.join(channel)
+    message.client.resume_backlog()
 
 signal("raw").connect(_redispatch_raw)
 signal("irc").connect(_redispatch_irc)
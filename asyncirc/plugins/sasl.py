@@ -1,4 +1,6 @@
 from blinker import signal
+from asyncirc.dispatch import dispatcher
+from asyncirc.parser import RFC1459Message
 import base64
 
 import logging
@@ -23,8 +25,11 @@ def caps_acknowledged(client):
     Internal method automatically called when the server sends CAP ACK, used to
     request authentication.
     """
-    if client.netid in authentication_info:
-        client.writeln("AUTHENTICATE PLAIN")
+    acknowledged = asyncirc.plugins.cap.capabilities_acknowledged.get(client.netid, ())
+    if client.netid in authentication_info and "sasl" in acknowledged:
+        # the pending caps are reset when we reconnect, so wait for SASL again
+        asyncirc.plugins.cap.cap_wait(client.netid, "sasl")
+        client.writeln(RFC1459Message.from_data("AUTHENTICATE", ["PLAIN"]))
 
 def handle_authenticate(message):
     """
@@ -35,15 +40,15 @@ def handle_authenticate(message):
         logger.debug("Authentication request acknowledged, sending username/password")
         authinfo = authentication_info[message.client.netid]
         authdata = base64.b64encode("{0}\x00{0}\x00{1}".format(*authinfo).encode())
-        message.client.writeln("AUTHENTICATE {}".format(authdata.decode()))
+        message.client.writeln(RFC1459Message.from_data("AUTHENTICATE", [authdata.decode()]))
 
 def handle_900(message):
     """
     Handle numeric 900 ("SASL authentication successful").
     """
     logger.debug("SASL authentication complete.")
-    signal("sasl-auth-complete").send(message)
-    signal("auth-complete").send(message)
+    dispatcher.send("sasl-auth-complete", message)
+    dispatcher.send("auth-complete", message)
     asyncirc.plugins.cap.cap_done(message.client, "sasl")
 
 def handle_failure(message):
@@ -1,36 +1,411 @@
 from blinker import signal
+from asyncirc.dispatch import dispatcher
+from asyncirc.irc import parse_hostmask
 from asyncirc.parser import RFC1459Message
-from collections import defaultdict
+from asyncirc.throttle import BULK
+from collections import defaultdict, OrderedDict
+import asyncio
+import logging
+import mmap
+import os
+import string
+import struct
+import sys
+import time
+logger = logging.getLogger("asyncirc.plugins.tracking")
+
+def _casemapping(upper, lower):
+    return str.maketrans(string.ascii_uppercase + upper, string.ascii_lowercase + lower)
+
+# str.translate tables for the CASEMAPPING values servers advertise
+casemappings = {
+    "ascii": _casemapping("", ""),
+    "rfc1459": _casemapping("[]\\~", "{}|^"),
+    "strict-rfc1459": _casemapping("[]\\", "{}|"),
+}
 
 class Registry:
+    """
+    Everything we know about the users and channels on one network. users,
+    channels and the membership indexes are keyed by names folded according
+    to the server's CASEMAPPING, so Foo and foo are the same user.
+
+    Channel members are stored as a dict of nick -> bitmask of the prefix
+    modes (op, voice, ...) they hold. Bit 0 is the highest ranked mode in the
+    server's PREFIX, bit 1 the next one, and so on.
+    """
+    # how many folded names to remember before starting over
+    fold_cache_size = 65536
+
     def __init__(self):
-        self.mappings = set()
-        # mappings contains two-tuples (user, channel)
         self.users = {}
         self.channels = {}
+        # channel membership, indexed both ways: nick -> set of channels and
+        # channel -> {nick: prefix bitmask}
+        self.user_channels = {}
+        self.channel_users = {}
+        self.casemapping = "rfc1459"
+        self.fold_table = casemappings["rfc1459"]
+        self.folded = {}
+        self.set_prefixes("(ov)@+")
+        # nicks listed so far in a NAMES reply, by channel
+        self.names_seen = {}
+
+    def fold(self, name):
+        """
+        Return the folded form of a nick or channel name, which is what the
+        registry uses as its keys. Folded names are interned and cached, so
+        looking up a name we've seen before doesn't allocate anything.
+        """
+        try:
+            return self.folded[name]
+        except KeyError:
+            pass
+        if len(self.folded) >= self.fold_cache_size:
+            self.folded.clear()
+        folded = self.folded[name] = sys.intern(name.translate(self.fold_table))
+        return folded
+
+    def set_casemapping(self, casemapping):
+        """
+        Switch to another CASEMAPPING, refolding every key we already have.
+        """
+        if casemapping not in casemappings:
+            logger.debug("Unknown CASEMAPPING {}, keeping {}".format(casemapping, self.casemapping))
+            return
+        if casemapping == self.casemapping:
+            return
+        self.casemapping = casemapping
+        self.fold_table = casemappings[casemapping]
+        self.folded = {}
+
+        users, channels = self.users, self.channels
+        self.users = {self.fold(user.nick): user for user in users.values()}
+        self.channels = {self.fold(channel.channel): channel for channel in channels.values()}
+        display_nicks = {key: user.nick for key, user in users.items()}
+        display_channels = {key: channel.channel for key, channel in channels.items()}
+        memberships = [(display_nicks.get(nick, nick), display_channels.get(channel, channel), mask)
+                       for channel, members in self.channel_users.items() for nick, mask in members.items()]
+        self.user_channels, self.channel_users = {}, {}
+        for nick, channel, mask in memberships:
+            self.add_membership(nick, channel, mask)
+        self.names_seen = {self.fold(display_channels.get(channel, channel)):
+                           {self.fold(display_nicks.get(nick, nick)) for nick in seen}
+                           for channel, seen in self.names_seen.items()}
+
+    def set_prefixes(self, prefix):
+        """
+        Take the prefix modes and their ranking from an ISUPPORT PREFIX value
+        like (qaohv)~&@%+. Existing bitmasks are carried over to the new order.
+        """
+        modes, _, symbols = prefix[1:].partition(")")
+        if not modes or len(modes) != len(symbols):
+            return
+        old_modes = getattr(self, "prefix_modes", modes)
+        self.prefix_modes = modes
+        self.prefix_symbols = symbols
+        self.mode_bits = {mode: 1 << i for i, mode in enumerate(modes)}
+        self.symbol_bits = {symbol: 1 << i for i, symbol in enumerate(symbols)}
+        # o and everything ranked above it (~ and & on most networks)
+        self.op_mask = (self.mode_bits["o"] << 1) - 1 if "o" in self.mode_bits else 0
+        if old_modes == modes:
+            return
+        remap = [self.mode_bits.get(mode, 0) for mode in old_modes]
+        for members in self.channel_users.values():
+            for nick, mask in members.items():
+                members[nick] = sum(bit for i, bit in enumerate(remap) if mask & (1 << i))
+
+    def _get_mappings(self):
+        """
+        All memberships as a set of (nick, channel) two-tuples.
+        """
+        return {(nick, channel) for nick, channels in self.user_channels.items() for channel in channels}
+
+    mappings = property(_get_mappings)
+
+    def channels_of(self, nick):
+        """
+        The folded names of the channels nick is in.
+        """
+        return self.user_channels.get(self.fold(nick), ())
+
+    def users_in(self, channel):
+        """
+        The members of channel, as a dict of folded nick -> prefix bitmask.
+        """
+        return self.channel_users.get(self.fold(channel), {})
+
+    def add_membership(self, nick, channel, mask=0):
+        """
+        Record nick as being in channel, adding the prefix modes in mask to
+        any it already holds there.
+        """
+        nick, channel = self.fold(nick), self.fold(channel)
+        self.user_channels.setdefault(nick, set()).add(channel)
+        members = self.channel_users.setdefault(channel, {})
+        members[nick] = members.get(nick, 0) | mask
+
+    def set_membership(self, nick, channel, mask):
+        """
+        Record nick as being in channel, holding exactly the prefix modes in
+        mask (as listed in a NAMES reply).
+        """
+        nick, channel = self.fold(nick), self.fold(channel)
+        self.user_channels.setdefault(nick, set()).add(channel)
+        self.channel_users.setdefault(channel, {})[nick] = mask
+
+    def remove_prefix(self, nick, channel, mask):
+        members = self.channel_users.get(self.fold(channel))
+        nick = self.fold(nick)
+        if members is not None and nick in members:
+            members[nick] &= ~mask
+
+    def remove_membership(self, nick, channel):
+        nick, channel = self.fold(nick), self.fold(channel)
+        channels = self.user_channels.get(nick)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.user_channels[nick]
+        members = self.channel_users.get(channel)
+        if members is not None:
+            members.pop(nick, None)
+            if not members:
+                del self.channel_users[channel]
+
+    def remove_user(self, nick):
+        """
+        Remove nick from every channel it is in. Returns the folded names of
+        those channels.
+        """
+        nick = self.fold(nick)
+        channels = self.user_channels.pop(nick, set())
+        for channel in channels:
+            members = self.channel_users[channel]
+            members.pop(nick, None)
+            if not members:
+                del self.channel_users[channel]
+        return channels
+
+    def rename_user(self, old_nick, new_nick):
+        """
+        Move old_nick's channel memberships over to new_nick.
+        """
+        old_nick, new_nick = self.fold(old_nick), self.fold(new_nick)
+        if old_nick == new_nick:
+            return
+        channels = self.user_channels.pop(old_nick, None)
+        if channels is None:
+            return
+        for channel in channels:
+            members = self.channel_users[channel]
+            members[new_nick] = members.pop(old_nick, 0)
+        self.user_channels.setdefault(new_nick, set()).update(channels)
+
+    def highest_prefix(self, mask):
+        """
+        The symbol of the highest ranked prefix mode in mask, or "".
+        """
+        if not mask:
+            return ""
+        return self.prefix_symbols[(mask & -mask).bit_length() - 1]
+
+    def dump(self, own_nick=None):
+        """
+        Serialize the registry to a snapshot (see snapshot_header). If
+        own_nick is given, only channels it is in are included.
+        """
+        strings = {}
+        def index(value):
+            if value is None:
+                return 0
+            if value not in strings:
+                strings[value] = len(strings) + 1
+            return strings[value]
+
+        header = [index(self.casemapping), index("({}){}".format(self.prefix_modes, self.prefix_symbols))]
+        users = b"".join(snapshot_user.pack(index(key), index(user.nick), index(user.user),
+                                            index(user.host), index(user.account))
+                         for key, user in self.users.items())
+        own_nick = self.fold(own_nick) if own_nick is not None else None
+        channels = []
+        channel_count = 0
+        for key, channel in self.channels.items():
+            members = self.channel_users.get(key, {})
+            if own_nick is not None and own_nick not in members:
+                continue
+            channel_count += 1
+            channels.append(snapshot_channel.pack(index(key), index(channel.channel), index(channel.mode),
+                                                  index(channel.topic), channel.synced, len(members)))
+            channels.extend(snapshot_member.pack(index(nick), mask) for nick, mask in members.items())
+
+        table = "\0".join(strings).encode("utf-8", "surrogateescape")
+        return b"".join([snapshot_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(table),
+                                              len(self.users), *header),
+                         table, users, struct.pack("<I", channel_count)] + channels)
+
+    @classmethod
+    def load(cls, buffer, netid=None):
+        """
+        Build a registry from a snapshot made by dump(). buffer can be
+        anything that supports the buffer protocol, like an mmap. Raises
+        ValueError if it isn't a snapshot we can read.
+        """
+        magic, version, table_size, user_count, casemapping, prefix = snapshot_header.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("not a version {} registry snapshot".format(SNAPSHOT_VERSION))
+        offset = snapshot_header.size
+        strings = bytes(buffer[offset:offset + table_size]).decode("utf-8", "surrogateescape").split("\0")
+        strings = [None] + [sys.intern(s) for s in strings]
+        offset += table_size
+
+        registry = cls()
+        registry.casemapping = strings[casemapping]
+        registry.fold_table = casemappings[registry.casemapping]
+        registry.set_prefixes(strings[prefix])
+        end = offset + user_count * snapshot_user.size
+        for key, nick, ident, host, account in snapshot_user.iter_unpack(buffer[offset:end]):
+            user = registry.users[strings[key]] = User(strings[nick], strings[ident], strings[host], netid)
+            user.account = strings[account]
+        offset = end
+
+        channel_count, = struct.unpack_from("<I", buffer, offset)
+        offset += 4
+        user_channels = registry.user_channels
+        for _ in range(channel_count):
+            key, name, mode, topic, synced, member_count = snapshot_channel.unpack_from(buffer, offset)
+            offset += snapshot_channel.size
+            key = strings[key]
+            channel = registry.channels[key] = Channel(strings[name], netid)
+            channel.mode, channel.topic, channel.synced = strings[mode], strings[topic], synced
+            members = registry.channel_users[key] = {}
+            end = offset + member_count * snapshot_member.size
+            for nick, mask in snapshot_member.iter_unpack(buffer[offset:end]):
+                nick = strings[nick]
+                members[nick] = mask
+                user_channels.setdefault(nick, set()).add(key)
+            offset = end
+        return registry
+
+# Registry snapshots are a header, then every string in the snapshot in one
+# NUL-separated UTF-8 block, then fixed-size user records, then each channel
+# record followed by its members. Records refer to strings by their index in
+# the block, counting from 1; 0 stands for None.
+SNAPSHOT_MAGIC = b"AIRS"
+SNAPSHOT_VERSION = 1
+# magic, version, string block size, user count, casemapping, PREFIX
+snapshot_header = struct.Struct("<4sHIIII")
+# folded nick, nick, ident, host, account
+snapshot_user = struct.Struct("<IIIII")
+# folded name, name, mode, topic, time of the last WHO, member count
+snapshot_channel = struct.Struct("<IIIIdI")
+# folded nick, prefix bitmask
+snapshot_member = struct.Struct("<IQ")
 
 registries = {}
+# where registry snapshots are kept, and how old a channel's state can get
+# before we WHO it again after a reconnect (see enable_snapshots)
+snapshot_directory = None
+snapshot_max_age = 600
+
+def enable_snapshots(directory, max_age=600):
+    """
+    Save each network's registry to a snapshot in directory when we're
+    disconnected, and restore it when we connect to the same server again.
+    Channels we had a WHO reply for in the last max_age seconds aren't
+    synced again when we rejoin them; the NAMES reply that comes with the
+    JOIN is enough to bring their membership up to date.
+    """
+    global snapshot_directory, snapshot_max_age
+    snapshot_directory = directory
+    snapshot_max_age = max_age
+
+def snapshot_path(client):
+    return os.path.join(snapshot_directory, "{host}_{port}.snapshot".format(**client.server_info))
+
+def save_snapshot(client):
+    """
+    Write client's registry to its snapshot file, if snapshots are enabled.
+    """
+    if snapshot_directory is None or client.netid not in registries:
+        return
+    path = snapshot_path(client)
+    with open(path + ".tmp", "wb") as f:
+        f.write(registries[client.netid].dump(client.nickname))
+    os.replace(path + ".tmp", path)
+
+def load_snapshot(client):
+    """
+    The registry saved in client's snapshot file, or None if there isn't a
+    usable one.
+    """
+    if snapshot_directory is None:
+        return None
+    path = snapshot_path(client)
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return Registry.load(buffer, client.netid)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, IndexError, struct.error) as e:
+        logger.warning("Ignoring unreadable registry snapshot {}: {}".format(path, e))
+        return None
 
 def create_registry(client):
-    registries[client.netid] = Registry()
+    registries[client.netid] = load_snapshot(client) or Registry()
     client.tracking_registry = registries[client.netid]
+    client.sync_scheduler = SyncScheduler(client)
+
+def stop_syncing(client):
+    scheduler = getattr(client, "sync_scheduler", None)
+    if scheduler is not None:
+        scheduler.stop()
 
 signal("netid-available").connect(create_registry)
+signal("disconnected").connect(save_snapshot)
+signal("disconnected").connect(stop_syncing)
+
+def handle_server_supports(message):
+    casemapping = message.client.server_supports.get("CASEMAPPING")
+    if casemapping:
+        message.client.tracking_registry.set_casemapping(casemapping)
+    prefix = message.client.server_supports.get("PREFIX")
+    if prefix:
+        message.client.tracking_registry.set_prefixes(prefix)
+
+signal("server-supports").connect(handle_server_supports)
+
+def _intern(value):
+    """
+    Intern an ident, hostname or account name. Lots of users share the same
+    few of each, and keeping one copy adds up on big networks.
+    """
+    return sys.intern(value) if value is not None else None
 
 class User:
+    __slots__ = ("nick", "user", "host", "account", "netid", "previous_nicks")
+    # how many of a user's previous nicknames to remember
+    nick_history = 8
+
     def __init__(self, nick, user, host, netid=None):
-        self.nick = nick
-        self.user = user
-        self.host = host
+        self.nick = _intern(nick)
+        self.user = _intern(user)
+        self.host = _intern(host)
         self.account = None
         self.netid = netid
-        self.previous_nicks = []
+        self.previous_nicks = ()
+
+    def rename(self, new_nick):
+        self.previous_nicks = (self.previous_nicks + (self.nick,))[-self.nick_history:]
+        self.nick = _intern(new_nick)
 
     def hostmask(self):
         return "{}!{}@{}".format(self.nick, self.user, self.host)
 
     def _get_channels(self):
-        return list(map(lambda x: x[1], filter(lambda x: x[0] == self.nick, registries[self.netid].mappings)))
+        registry = registries[self.netid]
+        return [registry.channels[c].channel if c in registry.channels else c
+                for c in registry.channels_of(self.nick)]
 
     def __repr__(self):
         return "User {}!{}@{}".format(self.nick, self.user, self.host)
@@ -38,6 +413,8 @@ class User:
     channels = property(_get_channels)
 
 class Channel:
+    __slots__ = ("channel", "available", "mode", "topic", "netid", "state", "synced")
+
     def __init__(self, channel, netid=None):
         self.channel = channel
         self.available = False
@@ -45,29 +422,229 @@ class Channel:
         self.topic = ""
         self.netid = netid
         self.state = set()
-        self.flags = defaultdict(set)
+        # when we last had a complete WHO reply for the channel
+        self.synced = 0.0
+
+    def _display_nick(self, registry, nick):
+        return registry.users[nick].nick if nick in registry.users else nick
 
     def _get_users(self):
-        return list(map(lambda x: x[0], filter(lambda x: x[1] == self.channel, registries[self.netid].mappings)))
+        registry = registries[self.netid]
+        return [self._display_nick(registry, n) for n in registry.users_in(self.channel)]
+
+    def _get_members(self):
+        return registries[self.netid].users_in(self.channel)
+
+    def _get_flags(self):
+        """
+        Nicks holding each prefix, as a dict of symbol -> set of nicks.
+        """
+        registry = registries[self.netid]
+        flags = defaultdict(set)
+        for nick, mask in self._get_members().items():
+            for symbol, bit in registry.symbol_bits.items():
+                if mask & bit:
+                    flags[symbol].add(self._display_nick(registry, nick))
+        return flags
+
+    def prefix(self, nick):
+        """
+        The highest prefix symbol nick has in this channel, or "".
+        """
+        registry = registries[self.netid]
+        return registry.highest_prefix(self._get_members().get(registry.fold(nick), 0))
+
+    def users_with(self, mode):
+        """
+        The nicks in this channel holding the prefix mode (o, v, ...).
+        """
+        registry = registries[self.netid]
+        bit = registry.mode_bits.get(mode, 0)
+        return [self._display_nick(registry, n) for n, mask in self._get_members().items() if mask & bit]
+
+    def _get_ops(self):
+        """
+        The nicks in this channel with op or any higher ranked prefix.
+        """
+        registry = registries[self.netid]
+        mask = registry.op_mask
+        return [self._display_nick(registry, n) for n, bits in self._get_members().items() if bits & mask]
 
     def __repr__(self):
         return "Channel {}".format(self.channel)
 
     users = property(_get_users)
+    members = property(_get_members)
+    flags = property(_get_flags)
+    ops = property(_get_ops)
+
+class SyncScheduler:
+    """
+    Sends the WHO and MODE queries that sync the channels we join. Only
+    max_in_flight WHOs wait on a reply at any one time, and if the server's
+    TARGMAX allows it, several channels share one WHO. Channels that see
+    traffic while they wait are moved to the front of the line.
+    """
+    # WHO queries allowed to be waiting on a reply
+    max_in_flight = 2
+    # most channels to put in one WHO, even if TARGMAX allows more
+    max_who_targets = 8
+    max_who_length = 400
+    # seconds without a reply before a WHO stops counting as in flight
+    who_timeout = 60
+    # times a channel's WHO is sent again after timing out, before giving up
+    who_retries = 1
+
+    def __init__(self, client, clock=time.monotonic):
+        self.client = client
+        self.clock = clock
+        # folded channel name -> channel name, in the order to sync them
+        self.pending = OrderedDict()
+        # folded WHO target -> (channels, time sent)
+        self.in_flight = {}
+        # folded channel name -> time its sync was requested
+        self.requested = {}
+        # folded channel name -> WHOs for it that timed out
+        self.retries = {}
+        self.total = 0
+        self.done = 0
+        self._timeout_handle = None
+
+    def fold(self, name):
+        return self.client.tracking_registry.fold(name)
+
+    def who_targets(self):
+        """
+        How many channels we can put in one WHO, according to TARGMAX.
+        """
+        targmax = self.client.server_supports.get("TARGMAX") or ""
+        for entry in targmax.split(","):
+            command, _, limit = entry.partition(":")
+            if command == "WHO":
+                return min(int(limit), self.max_who_targets) if limit else self.max_who_targets
+        return 1
+
+    def expect(self, channel):
+        """
+        Start timing channel's sync without sending anything for it.
+        """
+        key = self.fold(channel)
+        if key not in self.requested:
+            self.requested[key] = self.clock()
+            self.total += 1
+        return key
+
+    def add(self, channel):
+        self.pending[self.expect(channel)] = channel
+        self.pump()
+
+    def prioritize(self, channel):
+        """
+        Sync channel next, if it's still waiting.
+        """
+        key = self.fold(channel)
+        if key in self.pending:
+            self.pending.move_to_end(key, last=False)
+
+    def pump(self):
+        """
+        Send WHOs for waiting channels until max_in_flight are in flight.
+        """
+        now = self.clock()
+        for target, (channels, sent) in list(self.in_flight.items()):
+            if now - sent >= self.who_timeout:
+                logger.warning("No reply to WHO {} after {} seconds".format(target, self.who_timeout))
+                del self.in_flight[target]
+                self.who_timed_out(channels)
+
+        per_who = self.who_targets()
+        while self.pending and len(self.in_flight) < self.max_in_flight:
+            channels = []
+            length = 0
+            while self.pending and len(channels) < per_who:
+                channel = next(iter(self.pending.values()))
+                if channels and length + len(channel) + 1 > self.max_who_length:
+                    break
+                self.pending.popitem(last=False)
+                channels.append(channel)
+                length += len(channel) + 1
+            self.send_who(channels, now)
+        self.schedule_timeout(now)
+
+    def who_timed_out(self, channels):
+        """
+        Put the channels of a WHO that got no reply back at the front of the
+        line, or give up on the ones that have used up their retries and
+        send sync-failed for them.
+        """
+        for channel in reversed(channels):
+            key = self.fold(channel)
+            tries = self.retries.get(key, 0)
+            if tries < self.who_retries:
+                self.retries[key] = tries + 1
+                self.pending[key] = channel
+                self.pending.move_to_end(key, last=False)
+            else:
+                progress, _ = self.complete(channel)
+                dispatcher.send("sync-failed", self.client, channel=channel, progress=progress)
+
+    def schedule_timeout(self, now):
+        """
+        Make sure pump runs again when the oldest WHO in flight times out, so
+        a lost reply can't hold up the channels still waiting.
+        """
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+        if self.in_flight:
+            oldest = min(sent for _, sent in self.in_flight.values())
+            delay = max(0, oldest + self.who_timeout - now)
+            self._timeout_handle = asyncio.get_event_loop().call_later(delay, self.pump)
+
+    def stop(self):
+        if self._timeout_handle is not None:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+
+    def send_who(self, channels, now):
+        target = ",".join(channels)
+        self.in_flight[self.fold(target)] = (channels, now)
+        if self.client.server_supports["WHOX"]:
+            self.client.writeln(RFC1459Message.from_data("WHO", [target, "%cnuha"]), BULK)
+        else:
+            self.client.writeln(RFC1459Message.from_data("WHO", [target]), BULK)
+        for channel in channels:
+            self.client.writeln(RFC1459Message.from_data("MODE", [channel]), BULK)
+
+    def who_done(self, target):
+        """
+        Called at the end of a WHO reply. Returns the channels it covered.
+        """
+        channels, _ = self.in_flight.pop(self.fold(target), (target.split(","), None))
+        self.pump()
+        return channels
+
+    def complete(self, channel):
+        """
+        Record that channel is synced. Returns (progress, latency), where
+        progress is a (synced, requested) tuple counting the syncs since we
+        were last idle, and latency is how many seconds the sync took, or
+        None if we weren't timing it.
+        """
+        key = self.fold(channel)
+        self.retries.pop(key, None)
+        requested = self.requested.pop(key, None)
+        latency = None
+        if requested is not None:
+            self.done += 1
+            latency = self.clock() - requested
+        progress = (self.done, self.total)
+        if not self.requested:
+            self.done = self.total = 0
+        return progress, latency
 
 ## utility functions
 
-def parse_prefixes(server): # -> {'v': '+', ...}
-    keys, values = server.server_supports['PREFIX'][1:].split(")")
-    return {keys[i]: values[i] for i in range(len(keys))}
-
-def parse_hostmask(hostmask):
-    if "!" in hostmask and "@" in hostmask:
-        nick, userhost = hostmask.split("!", maxsplit=1)
-        user, host = userhost.split("@", maxsplit=1)
-        return nick, user, host
-    return hostmask, None, None
-
 def get_user(netid_or_message, hostmask=None):
     if isinstance(netid_or_message, RFC1459Message):
         netid = netid_or_message.client.netid
@@ -81,15 +658,16 @@ def get_user(netid_or_message, hostmask=None):
 
     registry = registries[netid]
     nick, user, host = parse_hostmask(hostmask)
-    if nick in registry.users:
+    key = registry.fold(nick)
+    if key in registry.users:
         if user is not None and host is not None:
-            registry.users[nick].user = user
-            registry.users[nick].host = host
-        return registry.users[nick]
+            registry.users[key].user = _intern(user)
+            registry.users[key].host = _intern(host)
+        return registry.users[key]
 
     if user is not None and host is not None:
-        registry.users[nick] = User(nick, user, host, netid)
-        return registry.users[nick]
+        registry.users[key] = User(nick, user, host, netid)
+        return registry.users[key]
 
     if "." in nick: # it's probably a server
         return User(nick, nick, nick, netid)
@@ -98,8 +676,8 @@ def get_user(netid_or_message, hostmask=None):
     # This will be updated when get_user is called again with the same nick
     # and a full hostmask. This should be really rare.
     # FIXME it would probably be a good idea to /whois here
-    registry.users[nick] = User(nick, None, None, netid)
-    return registry.users[nick]
+    registry.users[key] = User(nick, None, None, netid)
+    return registry.users[key]
 
 def get_channel(netid_or_message, x):
     if isinstance(netid_or_message, RFC1459Message):
@@ -108,9 +686,10 @@ def get_channel(netid_or_message, x):
         netid = netid_or_message
 
     registry = registries[netid]
-    if x not in registry.channels:
-        registry.channels[x] = Channel(x, netid)
-    return registry.channels[x]
+    key = registry.fold(x)
+    if key not in registry.channels:
+        registry.channels[key] = Channel(x, netid)
+    return registry.channels[key]
 
 ## signal definitions
 
@@ -131,18 +710,16 @@ names_response = signal("irc-353")
 names_done = signal("irc-366")
 mode_set = signal("+mode")
 mode_unset = signal("-mode")
+privmsg = signal("irc-privmsg")
 
 def sync_channel(client, channel):
-    if client.server_supports["WHOX"]:
-        client.writeln("WHO {} %cnuha".format(channel))
-    else:
-        client.writeln("WHO {}".format(channel))
-    client.writeln("MODE {}".format(channel))
+    client.sync_scheduler.add(channel)
 
 sync_complete_set = {"mode", "who", "names"}
 def check_sync_done(message, channel):
     if get_channel(message, channel).state == sync_complete_set:
-        signal("sync-done").send(message, channel=channel)
+        progress, latency = message.client.sync_scheduler.complete(channel)
+        dispatcher.send("sync-done", message, channel=channel, progress=progress, latency=latency)
 
 ## event handlers
 
@@ -155,13 +732,13 @@ def handle_topic_set(message):
 def handle_topic_changed(message):
     channel, topic = message.params
     get_channel(message, channel).topic = topic
-    signal("topic-changed").send(message, user=get_user(message), channel=channel, topic=topic)
+    dispatcher.send("topic-changed", message, user=get_user(message), channel=channel, topic=topic)
 
 @extwho_response.connect
 def handle_extwho_response(message):
     channel, ident, host, nick, account = message.params[1:]
     user = get_user(message, "{}!{}@{}".format(nick, ident, host))
-    user.account = account if account != "0" else None
+    user.account = _intern(account) if account != "0" else None
     handle_join(message, user, channel, real=False)
 
 @who_response.connect
@@ -173,20 +750,28 @@ def handle_who_response(message):
 @names_response.connect
 def handle_names_response(message):
     dummy, channel, names = message.params[1:]
-    prefixes = parse_prefixes(message.client)
+    registry = message.client.tracking_registry
+    symbol_bits = registry.symbol_bits
+    seen = registry.names_seen.setdefault(registry.fold(channel), set())
     for name in names.split():
-        name_list = list(name)
-        applicable_prefixes = []
-
-        while name_list[0] in prefixes.values():  # multi-prefix support
-            applicable_prefixes.append(name_list.pop(0))
-
-        for prefix in applicable_prefixes:
-            get_channel(message, channel).flags[prefix].add("".join(name_list))
+        mask = 0
+        i = 0
+        while i < len(name) and name[i] in symbol_bits:  # multi-prefix support
+            mask |= symbol_bits[name[i]]
+            i += 1
+        user = get_user(message, name[i:])  # userhost-in-names gives full hostmasks
+        registry.set_membership(user.nick, channel, mask)
+        seen.add(registry.fold(user.nick))
 
 @names_done.connect
 def handle_names_done(message):
     channel, dummy = message.params[1:]
+    registry = message.client.tracking_registry
+    seen = registry.names_seen.pop(registry.fold(channel), None)
+    if seen is not None:
+        # anyone NAMES didn't list isn't in the channel any more
+        for nick in [n for n in registry.users_in(channel) if n not in seen]:
+            registry.remove_membership(nick, channel)
     channel_obj = get_channel(message, channel)
     channel_obj.state = channel_obj.state | {"names"}
     check_sync_done(message, channel)
@@ -201,76 +786,86 @@ def handle_received_mode(message):
 
 @who_done.connect
 def handle_who_done(message):
-    channel = message.params[1]
-    channel_obj = get_channel(message, channel)
-    channel_obj.state = channel_obj.state | {"who"}
-    check_sync_done(message, channel)
+    for channel in message.client.sync_scheduler.who_done(message.params[1]):
+        channel_obj = get_channel(message, channel)
+        channel_obj.state = channel_obj.state | {"who"}
+        channel_obj.synced = time.time()
+        check_sync_done(message, channel)
 
 @join.connect
 def handle_join(message, user, channel, real=True):
+    registry = message.client.tracking_registry
     get_channel(message, channel)
 
-    if user.nick == message.client.nickname and real:
-        sync_channel(message.client, channel)
-        get_channel(message, channel).available = True
-    message.client.tracking_registry.mappings.add((user.nick, channel))
+    if real:
+        get_user(message)
+        if registry.fold(user.nick) == registry.fold(message.client.nickname):
+            channel_obj = get_channel(message, channel)
+            if snapshot_directory is not None and time.time() - channel_obj.synced < snapshot_max_age:
+                # restored from a recent snapshot; the NAMES reply will finish the sync
+                channel_obj.state = {"who", "mode"}
+                message.client.sync_scheduler.expect(channel)
+            else:
+                channel_obj.state = set()
+                sync_channel(message.client, channel)
+            channel_obj.available = True
+    registry.add_membership(user.nick, channel)
+
+@privmsg.connect
+def handle_channel_activity(message):
+    scheduler = getattr(message.client, "sync_scheduler", None)
+    if scheduler is not None and scheduler.pending:
+        scheduler.prioritize(message.params[0])
 
 @extjoin.connect
 def handle_extjoin(message):
     if "extended-join" not in message.client.caps:
         return
     account = message.params[1]
-    get_user(message).account = account if account != "*" else None
+    get_user(message).account = _intern(account) if account != "*" else None
 
 @account.connect
 def account_notify(message):
     account = message.params[0]
-    get_user(message).account = account if account != "*" else None
+    get_user(message).account = _intern(account) if account != "*" else None
 
 @part.connect
 def handle_part(message, user, channel, reason):
-    user = get_user(message, user.nick)
-    if user == message.client.nickname:
+    registry = message.client.tracking_registry
+    if registry.fold(user.nick) == registry.fold(message.client.nickname):
         get_channel(message, channel).available = False
-    message.client.tracking_registry.mappings.discard((user.nick, channel))
+    registry.remove_membership(user.nick, channel)
 
 @quit_.connect
 def handle_quit(message, user, reason):
-    user = get_user(message, user.nick)
-    del message.client.tracking_registry.users[user.nick]
-    for channel in set(user.channels):
-        message.client.tracking_registry.mappings.remove((user.nick, channel))
+    registry = message.client.tracking_registry
+    registry.users.pop(registry.fold(user.nick), None)
+    registry.remove_user(user.nick)
 
 @kick.connect
 def handle_kick(message, kicker, kickee, channel, reason):
-    message.client.tracking_registry.mappings.discard((kickee, channel))
+    message.client.tracking_registry.remove_membership(kickee, channel)
 
 @nick.connect
 def handle_nick(message, user, new_nick):
     user = get_user(message)
     old_nick = user.nick
-    user.previous_nicks.append(old_nick)
-    user.nick = new_nick
-    del message.client.tracking_registry.users[old_nick]
-    message.client.tracking_registry.users[new_nick] = user
-
-    mappings = set(message.client.tracking_registry.mappings)
-    original_mappings = message.client.tracking_registry.mappings
-    for i in mappings:
-        if i[0] == old_nick:
-            original_mappings.discard(i)
-            original_mappings.add((new_nick, i[1]))
+    user.rename(new_nick)
+    registry = message.client.tracking_registry
+    del registry.users[registry.fold(old_nick)]
+    registry.users[registry.fold(new_nick)] = user
+    registry.rename_user(old_nick, new_nick)
 
 @mode_set.connect
 def handle_mode_set(message, mode, arg, user, channel):
-    prefixes = parse_prefixes(message.client)
-    if mode in prefixes:
-        get_channel(message, channel).flags[prefixes[mode]].add(arg)
+    registry = message.client.tracking_registry
+    if mode in registry.mode_bits:
+        registry.add_membership(arg, channel, registry.mode_bits[mode])
 
 @mode_unset.connect
 def handle_mode_unset(message, mode, arg, user, channel):
-    prefixes = parse_prefixes(message.client)
-    if mode in prefixes:
-        get_channel(message, channel).flags[prefixes[mode]].discard(arg)
+    registry = message.client.tracking_registry
+    if mode in registry.mode_bits:
+        registry.remove_prefix(arg, channel, registry.mode_bits[mode])
 
-signal("plugin-registered").send("asyncirc.plugins.tracking")
+dispatcher.send("plugin-registered", "asyncirc.plugins.tracking")
@@ -0,0 +1,214 @@
+"""
+Finding the signal receivers that hold up the event loop.
+
+While profiling is enabled, the dispatcher's send is replaced with one that
+times every receiver call, and the timings are added up by the receiver's
+qualified name. A receiver's own time leaves out the receivers of signals it
+sent itself, so the core plugin's redispatching doesn't get the blame for
+the plugins it calls.
+
+A watchdog thread looks at the receiver that's running every quarter of the
+threshold. Once one has been running for longer than the threshold, it takes
+a sample of the stack, and the sample is logged with the timing when the
+call returns. That shows where a slow receiver was spending its time, not
+just that it was slow.
+
+Disabling profiling puts the dispatcher's own send back, so when profiling
+is off the dispatch path is exactly what it always was. Coroutine receivers
+are only timed up to the point where they're scheduled.
+"""
+import inspect
+import logging
+import sys
+import threading
+import time
+import traceback
+from asyncirc.dispatch import dispatcher
+
+logger = logging.getLogger("asyncirc.profiler")
+
+def receiver_name(receiver):
+    module = getattr(receiver, "__module__", None)
+    qualname = getattr(receiver, "__qualname__", None) or repr(receiver)
+    return "{}.{}".format(module, qualname) if module else qualname
+
+class ReceiverTimings:
+    """
+    Everything we know about the calls to one receiver.
+    """
+    __slots__ = ("name", "signals", "calls", "total", "own", "max", "slow", "sample")
+
+    def __init__(self, name):
+        self.name = name
+        self.signals = set()
+        self.calls = 0
+        self.total = 0.0
+        self.own = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.sample = None
+
+    def stats(self):
+        return {
+            "receiver": self.name,
+            "signals": sorted(self.signals),
+            "calls": self.calls,
+            "total": self.total,
+            "own": self.own,
+            "max": self.max,
+            "mean": self.own / self.calls if self.calls else 0.0,
+            "slow": self.slow,
+            "sample": self.sample,
+        }
+
+class Profiler:
+    """
+    Times the receivers dispatcher calls. Calls whose own time is over
+    threshold seconds are logged, with a sample of the stack if the
+    watchdog caught one.
+    """
+    def __init__(self, dispatcher=dispatcher, threshold=0.1):
+        self.dispatcher = dispatcher
+        self.threshold = threshold
+        self.timings = {}
+        # receivers being called right now, innermost last:
+        # [receiver, signal, start, time spent in nested receivers, stack sample]
+        self.calls = []
+        self.thread_id = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+
+    @property
+    def enabled(self):
+        return self.dispatcher.__dict__.get("send") == self.send
+
+    def enable(self):
+        """
+        Start timing receivers. Must be called from the thread that runs the
+        event loop.
+        """
+        if self.enabled:
+            return self
+        self.thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.watchdog = threading.Thread(target=self.watch, name="asyncirc-profiler", daemon=True)
+        self.watchdog.start()
+        self.dispatcher.send = self.send
+        return self
+
+    def disable(self):
+        if self.enabled:
+            del self.dispatcher.send
+        self.stopped.set()
+        if self.watchdog is not None:
+            self.watchdog.join()
+            self.watchdog = None
+
+    def watch(self):
+        while not self.stopped.wait(self.threshold / 4):
+            now = time.perf_counter()
+            for call in reversed(list(self.calls)):
+                if now - call[2] <= self.threshold:
+                    continue
+                if call[4] is None:
+                    frame = sys._current_frames().get(self.thread_id)
+                    if frame is not None:
+                        call[4] = "".join(traceback.format_stack(frame))
+                break
+
+    def send(self, name, sender, **kwargs):
+        """
+        Dispatcher.send, timing each receiver.
+        """
+        dispatcher = self.dispatcher
+        try:
+            refs, stats = dispatcher.receivers[name]
+        except KeyError:
+            refs, stats = dispatcher._resolve(name)
+        stats[0] += 1
+        start = time.perf_counter()
+        if refs is None:
+            receivers = [(receiver, inspect.iscoroutinefunction(receiver))
+                         for receiver in dispatcher.signals[name].receivers_for(sender)]
+        else:
+            receivers = [(ref(), is_coroutine) for ref, is_coroutine in refs]
+        for receiver, is_coroutine in receivers:
+            if receiver is None:
+                continue
+            if is_coroutine:
+                dispatcher.tasks_for(sender).spawn(name, receiver, sender, kwargs)
+            else:
+                self.call(name, receiver, sender, kwargs)
+        stats[1] += 1
+        stats[2] += time.perf_counter() - start
+
+    def call(self, name, receiver, sender, kwargs):
+        call = [receiver, name, time.perf_counter(), 0.0, None]
+        self.calls.append(call)
+        try:
+            receiver(sender, **kwargs)
+        finally:
+            self.calls.pop()
+            elapsed = time.perf_counter() - call[2]
+            if self.calls:
+                self.calls[-1][3] += elapsed
+            self.record(name, receiver, elapsed, elapsed - call[3], call[4])
+
+    def record(self, name, receiver, elapsed, own, sample):
+        qualname = receiver_name(receiver)
+        try:
+            timings = self.timings[qualname]
+        except KeyError:
+            timings = self.timings[qualname] = ReceiverTimings(qualname)
+        timings.signals.add(name)
+        timings.calls += 1
+        timings.total += elapsed
+        timings.own += own
+        if own > timings.max:
+            timings.max = own
+        if own > self.threshold:
+            timings.slow += 1
+            if sample is not None:
+                timings.sample = sample
+            logger.warning("{} took {:.1f} ms handling {}{}".format(
+                qualname, own * 1000, name, ", in:\n" + sample if sample else ""))
+
+    def top(self, limit=10, key="own"):
+        """
+        The receivers with the most time spent in them, as a list of dicts.
+        key is what they're sorted by: own, total, max, mean, calls or slow.
+        """
+        stats = [timings.stats() for timings in self.timings.values()]
+        stats.sort(key=lambda s: s[key], reverse=True)
+        return stats[:limit]
+
+    def reset(self):
+        self.timings.clear()
+
+profiler = None
+
+def enable(threshold=0.1):
+    """
+    Start profiling the global dispatcher, logging receiver calls that take
+    longer than threshold seconds. Returns the Profiler.
+    """
+    global profiler
+    if profiler is None:
+        profiler = Profiler(threshold=threshold)
+    profiler.threshold = threshold
+    return profiler.enable()
+
+def disable():
+    """
+    Stop profiling. The timings so far are kept for dump_profile.
+    """
+    if profiler is not None:
+        profiler.disable()
+
+def dump_profile(limit=10, key="own"):
+    """
+    The top offenders among the receivers timed so far (see Profiler.top).
+    """
+    if profiler is None:
+        return []
+    return profiler.top(limit, key)
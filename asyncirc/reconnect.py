@@ -0,0 +1,245 @@
+"""
+Getting back onto a server after we lose the connection.
+
+Each connection has a ReconnectSupervisor that keeps trying with exponential
+backoff and full jitter, so a hundred bots dropped by the same netsplit don't
+all come back in the same second. Every connection to a server also shares
+a CircuitBreaker: once enough attempts in a row have failed, nobody tries
+that server for a while, and then only one connection gets to find out
+whether it's back.
+"""
+import asyncio
+import logging
+import random
+import time
+from asyncirc.dispatch import dispatcher
+
+logger = logging.getLogger("asyncirc.reconnect")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: the delay before attempt n
+    (counting from 0) is picked uniformly between 0 and
+    min(cap, base * factor ** n) seconds.
+    """
+    def __init__(self, base=1.0, factor=2.0, cap=300.0, rng=random):
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.rng = rng
+
+    def ceiling(self, attempt):
+        return min(self.cap, self.base * self.factor ** min(attempt, 64))
+
+    def delay(self, attempt):
+        return self.rng.uniform(0, self.ceiling(attempt))
+
+class CircuitBreaker:
+    """
+    Shared by every connection to one server. After `threshold` failed
+    attempts in a row the breaker opens, and nobody connects for
+    `reset_timeout` seconds. Then it's half-open: one connection gets to
+    try, and the breaker closes if that works or opens again if it doesn't.
+    """
+    # how often connections waiting on a half-open probe check back
+    probe_poll = 5.0
+
+    def __init__(self, threshold=5, reset_timeout=60.0, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+
+    def retry_after(self):
+        """
+        How many seconds to wait before trying to connect, or 0 to go ahead.
+        When the breaker is half-open, the first caller to get 0 is the probe.
+        """
+        if self.state == OPEN:
+            remaining = self.opened_at + self.reset_timeout - self.clock()
+            if remaining > 0:
+                return remaining
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN:
+            if self.probing:
+                return self.probe_poll
+            self.probing = True
+        return 0
+
+    def success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or self.failures >= self.threshold:
+            if self.state != OPEN:
+                self.trips += 1
+            self.state = OPEN
+            self.opened_at = self.clock()
+
+breakers = {}
+
+def breaker_for(server):
+    """
+    The CircuitBreaker shared by connections to server (a hostname).
+    """
+    if server not in breakers:
+        breakers[server] = CircuitBreaker()
+    return breakers[server]
+
+class ReconnectSupervisor:
+    """
+    Reconnects one connection after it's lost. The IRCProtocolWrapper stays
+    the same, so handlers holding on to it keep working, and lines that were
+    still waiting in the old send queue are sent once we're registered again
+    (control traffic like PONGs is dropped).
+
+    Gives up after max_attempts failed attempts in a row (None means never),
+    sending reconnect-gave-up. Each attempt sends reconnect-attempt and either
+    reconnect-failed or reconnected. An attempt only counts as a success once
+    the server has welcomed us (001): a server that takes the connection and
+    then drops us, like a K-line does, counts as a failure, so the backoff
+    keeps growing and the circuit breaker can open.
+    """
+    def __init__(self, client_wrapper, backoff=None, max_attempts=None, timeout=30.0, breaker=None):
+        self.client_wrapper = client_wrapper
+        self.backoff = backoff or Backoff()
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.breaker = breaker
+        self.state = "connected"
+        self.task = None
+        # attempts since the connection was lost
+        self.attempts = 0
+        self.total_attempts = 0
+        self.failures = 0
+        self.reconnects = 0
+        self.last_error = None
+        self.disconnected_at = None
+        self.downtime = 0.0
+        # the breaker of the connection we're waiting to see a 001 on
+        self.unconfirmed = None
+
+    def start(self):
+        """
+        Start reconnecting, unless we already are.
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        old = self.client_wrapper.protocol
+        host = old.server_info["host"]
+        breaker = self.breaker or breaker_for(host)
+        if self.unconfirmed is not None:
+            # the last attempt connected, but was dropped before registering
+            self.unconfirmed = None
+            self.failures += 1
+            self.last_error = ConnectionError("disconnected before registering")
+            breaker.failure()
+            logger.warning("Lost {} before registering (attempt {})".format(host, self.attempts))
+            dispatcher.send("reconnect-failed", self.client_wrapper, attempt=self.attempts,
+                            exception=self.last_error)
+        else:
+            self.disconnected_at = time.monotonic()
+            self.attempts = 0
+        while self.max_attempts is None or self.attempts < self.max_attempts:
+            self.state = "waiting"
+            wait = breaker.retry_after()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            await asyncio.sleep(self.backoff.delay(self.attempts))
+
+            self.state = "connecting"
+            self.attempts += 1
+            self.total_attempts += 1
+            dispatcher.send("reconnect-attempt", self.client_wrapper, attempt=self.attempts)
+            def create_protocol():
+                return type(old)(netid=old.netid, server_info=old.server_info)
+            connector = asyncio.get_event_loop().create_connection(create_protocol, **old.server_info)
+            try:
+                _, protocol = await asyncio.wait_for(connector, self.timeout)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = e
+                breaker.failure()
+                logger.warning("Reconnecting to {} failed (attempt {}): {!r}".format(host, self.attempts, e))
+                dispatcher.send("reconnect-failed", self.client_wrapper, attempt=self.attempts, exception=e)
+                continue
+
+            self.unconfirmed = breaker
+            self.resume(old, protocol)
+            return protocol
+
+        self.state = "gave-up"
+        logger.critical("Giving up on {} after {} attempts".format(host, self.attempts))
+        dispatcher.send("reconnect-gave-up", self.client_wrapper, attempts=self.attempts)
+
+    def resume(self, old, protocol):
+        """
+        Hand the wrapper, registration details and queued lines of the old
+        protocol over to the new one.
+        """
+        client_wrapper = self.client_wrapper
+        if hasattr(old, "nick"):
+            protocol.register(old.nick, old.user, old.realname, old.mode, old.password)
+        protocol.channels_to_join = old.channels_to_join
+        protocol.server_info = old.server_info
+        protocol.netid = old.netid
+        protocol.wrapper = client_wrapper
+        if old.backlog is not None:
+            # old never registered, so the lines it inherited are still waiting
+            old.backlog.transfer(old.queue)
+            protocol.backlog = old.backlog
+        else:
+            protocol.backlog = old.queue
+        client_wrapper.protocol = protocol
+        dispatcher.send("netid-available", protocol)
+
+        downtime = time.monotonic() - self.disconnected_at
+        self.downtime += downtime
+        self.reconnects += 1
+        self.state = "connected"
+        logger.critical("Reconnected to {} after {} attempts".format(protocol.netid, self.attempts))
+        dispatcher.send("reconnected", client_wrapper, attempts=self.attempts, downtime=downtime)
+
+    def registered(self):
+        """
+        Called when the server welcomes us. This is when a reconnect counts
+        as a success.
+        """
+        if self.unconfirmed is not None:
+            self.unconfirmed.success()
+            self.unconfirmed = None
+
+    def stats(self):
+        """
+        Reconnect metrics for this connection, as a dict.
+        """
+        breaker = self.breaker or breakers.get(self.client_wrapper.server_info["host"])
+        return {
+            "state": self.state,
+            "breaker": breaker.state if breaker is not None else CLOSED,
+            "attempts": self.attempts,
+            "total_attempts": self.total_attempts,
+            "failures": self.failures,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+            "downtime": self.downtime,
+        }
@@ -0,0 +1,122 @@
+"""
+Recording what a server sends us, so it can be replayed later.
+
+A recording is a gzipped text file. The first line is a header with the
+format version, the time the recording started and the netid it was made
+on; every other line is the offset in seconds from the start, a space, and
+a raw line exactly as it came off the wire (after decoding).
+
+Lines are buffered on the event loop and handed to a writer thread in
+batches, so compressing and writing them never blocks the loop.
+"""
+import asyncio
+import concurrent.futures
+import gzip
+import time
+from blinker import signal
+
+HEADER = "#asyncirc-recording"
+VERSION = 1
+
+def _open(path):
+    return gzip.open(path, "wt", encoding="utf-8", errors="surrogateescape", newline="\n")
+
+def _header(started, netid):
+    return "{} {} {:.6f} {}\n".format(HEADER, VERSION, started, netid)
+
+def read_recording(path):
+    """
+    Read a recording back. Returns (header, lines): header is a dict with
+    the version, started and netid, and lines a generator of (offset, line)
+    pairs that streams the file as it goes.
+    """
+    f = gzip.open(path, "rt", encoding="utf-8", errors="surrogateescape", newline="\n")
+    magic, version, started, netid = f.readline().rstrip("\n").split(" ", 3)
+    if magic != HEADER or int(version) != VERSION:
+        f.close()
+        raise ValueError("{} isn't a version {} recording".format(path, VERSION))
+
+    def lines():
+        with f:
+            for record in f:
+                offset, _, line = record.rstrip("\n").partition(" ")
+                yield float(offset), line
+    return {"version": int(version), "started": float(started), "netid": netid}, lines()
+
+def write_recording(path, lines, netid="synthetic", rate=None, started=None):
+    """
+    Write lines to a recording in one go, without a connection. lines can
+    be (offset, line) pairs, or just lines, spaced 1/rate seconds apart (or
+    all at offset 0 if rate is None). Handy for turning synthetic traffic
+    into something replay can use.
+    """
+    with _open(path) as f:
+        f.write(_header(time.time() if started is None else started, netid))
+        for i, line in enumerate(lines):
+            if isinstance(line, tuple):
+                offset, line = line
+            else:
+                offset = i / rate if rate else 0.0
+            f.write("{:.6f} {}\n".format(offset, line))
+
+class Recorder:
+    """
+    Records every line received on the connection with client's netid (so
+    it carries on across reconnects) to path. Lines are written out every
+    flush_interval seconds, or as soon as max_buffer of them are waiting.
+    """
+    def __init__(self, client, path, flush_interval=1.0, max_buffer=1000):
+        self.netid = client.netid
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.lines = 0
+        self.started = None
+        self._origin = None
+        self.file = None
+        self.executor = None
+        self.loop = None
+        self._flush_handle = None
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.started = time.time()
+        self._origin = self.loop.time()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.file = _open(self.path)
+        self.file.write(_header(self.started, self.netid))
+        signal("raw").connect(self.record)
+        return self
+
+    def record(self, client, text):
+        if getattr(client, "netid", None) != self.netid:
+            return
+        self.buffer.append("{:.6f} {}\n".format(self.loop.time() - self._origin, text))
+        self.lines += 1
+        if len(self.buffer) >= self.max_buffer:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """
+        Hand the buffered lines to the writer thread. Returns a future that's
+        done once they've been written.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self.buffer = self.buffer, []
+        return self.loop.run_in_executor(self.executor, self.file.writelines, batch)
+
+    def stop(self):
+        """
+        Stop recording. Returns a future that's done once everything has
+        been written and the file is closed.
+        """
+        signal("raw").disconnect(self.record)
+        self.flush()
+        closed = self.loop.run_in_executor(self.executor, self.file.close)
+        self.executor.shutdown(wait=False)
+        return closed
@@ -0,0 +1,113 @@
+"""
+Replaying recorded (or synthetic) traffic into an IRCProtocol that isn't
+connected to anything, to reproduce production load in tests and
+benchmarks.
+"""
+import asyncio
+import time
+from asyncirc import irc
+from asyncirc.dispatch import dispatcher
+from asyncirc.recorder import read_recording
+
+class MockTransport:
+    """
+    A transport that keeps whatever is written to it, if keep is set, and
+    otherwise just counts it.
+    """
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.written = []
+        self.bytes_written = 0
+        self.closed = False
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if self.keep:
+            self.written.append(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def close(self):
+        self.closed = True
+
+    abort = close
+
+def mock_protocol(netid="replay", nick="bot", keep_writes=False):
+    """
+    An IRCProtocol on a MockTransport, registered as nick, that plugins
+    treat like any other connection.
+    """
+    protocol = irc.IRCProtocol()
+    protocol.connection_made(MockTransport(keep_writes))
+    protocol.wrapper = irc.IRCProtocolWrapper(protocol)
+    protocol.server_info = {"host": "replay.invalid", "port": 0, "ssl": False}
+    protocol.netid = netid
+    protocol.autoreconnect = False
+    protocol.register(nick, nick, nick)
+    protocol.nickname = nick
+    dispatcher.send("netid-available", protocol)
+    return protocol
+
+class ReplayStats:
+    def __init__(self):
+        self.lines = 0
+        self.elapsed = 0.0
+        # seconds each line took to handle
+        self.latencies = []
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def stats(self):
+        """
+        lines_per_second only counts the time spent handling the lines, not
+        reading the recording or waiting between lines.
+        """
+        busy = sum(self.latencies)
+        return {
+            "lines": self.lines,
+            "elapsed": self.elapsed,
+            "busy": busy,
+            "lines_per_second": self.lines / busy if busy else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+async def replay(source, protocol=None, speed=None, yield_every=256):
+    """
+    Feed lines into protocol (a fresh mock_protocol by default) through
+    data_received, one line at a time. source is the path of a recording,
+    or an iterable of (offset, line) pairs.
+
+    With speed=None the lines go in as fast as they can be handled, giving
+    the event loop a turn every yield_every lines; otherwise the recorded
+    gaps between lines are kept, divided by speed (2 plays back twice as
+    fast). Returns a ReplayStats.
+    """
+    if isinstance(source, str):
+        _, source = read_recording(source)
+    if protocol is None:
+        protocol = mock_protocol()
+    loop = asyncio.get_event_loop()
+    stats = ReplayStats()
+    latencies = stats.latencies
+    origin = loop.time()
+    start = time.perf_counter()
+    for offset, line in source:
+        if speed is not None:
+            delay = origin + offset / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif stats.lines % yield_every == 0:
+            await asyncio.sleep(0)
+        data = line.encode("utf-8", "surrogateescape") + b"\r\n"
+        line_start = time.perf_counter()
+        protocol.data_received(data)
+        latencies.append(time.perf_counter() - line_start)
+        stats.lines += 1
+    stats.elapsed = time.perf_counter() - start
+    return stats
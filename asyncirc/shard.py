@@ -0,0 +1,280 @@
+"""
+Running networks in several worker processes.
+
+A ShardSupervisor spreads a list of networks over a number of worker
+processes. Each worker has its own event loop, plugins and connections, so a
+busy network only slows down the networks that share its worker. Workers
+forward a chosen set of events to the supervisor over a Unix socket, where
+they are sent again on the supervisor's dispatcher. The message's client is
+a RemoteClient there: calling say(), join() or writeln() on it sends the call
+back to the worker that owns the connection.
+
+Frames on the socket are a 4-byte big-endian length followed by a pickle.
+"""
+import asyncio
+import importlib
+import logging
+import os
+import pickle
+import struct
+import sys
+import tempfile
+from blinker import signal
+from asyncirc import irc
+from asyncirc.dispatch import dispatcher, connection_of
+from asyncirc.parser import RFC1459Message
+
+logger = logging.getLogger("asyncirc.shard")
+
+frame_header = struct.Struct("!I")
+
+# events workers forward to the supervisor unless told otherwise
+forwarded_events = ("public-message", "private-message", "public-notice", "private-notice",
+                    "join", "part", "quit", "kick", "nick", "sync-done")
+
+def encode_frame(obj):
+    payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    return frame_header.pack(len(payload)) + payload
+
+async def read_frame(reader):
+    """
+    Read one frame from a StreamReader. Returns None at end of stream.
+    """
+    try:
+        header = await reader.readexactly(frame_header.size)
+        payload = await reader.readexactly(frame_header.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+    return pickle.loads(payload)
+
+def assign_shards(networks, workers):
+    """
+    Split networks into `workers` lists, round robin.
+    """
+    return [networks[i::workers] for i in range(workers)]
+
+def network_spec(network):
+    """
+    Networks are given as a dict with the arguments to irc.connect (server,
+    port, use_ssl) and optionally nick, user, realname and a list of
+    channels; or as a plain (server, port, use_ssl) tuple.
+    """
+    if isinstance(network, dict):
+        return network
+    return dict(zip(("server", "port", "use_ssl"), network))
+
+def load_callable(path):
+    """
+    Find a function given as "package.module:function".
+    """
+    module, _, name = path.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+class RemoteClient:
+    """
+    Stands in for a connection that lives in a worker process. Method calls
+    are sent to the worker and made on the connection's IRCProtocolWrapper
+    there.
+    """
+    def __init__(self, supervisor, netid, shard):
+        self.supervisor = supervisor
+        self.netid = netid
+        self.shard = shard
+
+    def call(self, method, *args, **kwargs):
+        self.supervisor.send(self.shard, ("call", self.netid, method, args, kwargs))
+        return self
+
+    def writeln(self, line, priority=None):
+        return self.call("writeln", line, priority)
+
+    def say(self, target_str, message, priority=None):
+        return self.call("say", target_str, message, priority)
+
+    def join(self, channels):
+        return self.call("join", channels)
+
+    def part(self, channels):
+        return self.call("part", channels)
+
+    def __repr__(self):
+        return "RemoteClient {} (shard {})".format(self.netid, self.shard)
+
+class ShardSupervisor:
+    """
+    Starts `workers` processes, hands each of them a share of networks, and
+    sends the events they forward on our own dispatcher.
+
+    plugins is a list of module names every worker imports before
+    connecting, and setup an optional "module:function" called with each
+    connection once it's made. Both are imported by name, since the workers
+    are fresh interpreters (python -m asyncirc.shard) that get their share
+    of the networks over the bus.
+    """
+    def __init__(self, networks, workers=None, plugins=(), setup=None, forward=forwarded_events, socket_path=None):
+        self.networks = [network_spec(network) for network in networks]
+        self.workers = min(workers or os.cpu_count() or 1, len(self.networks)) or 1
+        self.plugins = list(plugins)
+        self.setup = setup
+        self.forward = list(forward)
+        # the directory we made for the socket, if we weren't given a path
+        self.socket_dir = None if socket_path else tempfile.mkdtemp(prefix="asyncirc-")
+        self.socket_path = socket_path or os.path.join(self.socket_dir, "bus")
+        self.processes = []
+        self.shares = assign_shards(self.networks, self.workers)
+        self.writers = {}
+        self.clients = {}
+        self.server = None
+        self.shard_ready = None
+        self.stopping = False
+
+    async def start(self):
+        """
+        Listen on the bus and start the workers. Returns once every worker
+        has connected to the bus; its networks may still be connecting.
+        """
+        self.shard_ready = {shard: asyncio.Event() for shard in range(self.workers)}
+        self.server = await asyncio.start_unix_server(self.handle_worker, path=self.socket_path)
+        for shard in range(self.workers):
+            process = await asyncio.create_subprocess_exec(sys.executable, "-m", "asyncirc.shard",
+                                                           self.socket_path, str(shard))
+            self.processes.append(process)
+        await asyncio.gather(*[event.wait() for event in self.shard_ready.values()])
+
+    def send(self, shard, frame):
+        if shard not in self.writers:
+            logger.warning("Dropping {} for shard {}, which isn't connected".format(frame[0], shard))
+            return
+        self.writers[shard].write(encode_frame(frame))
+
+    def client(self, netid):
+        return self.clients[netid]
+
+    async def handle_worker(self, reader, writer):
+        hello = await read_frame(reader)
+        if not hello or hello[0] != "hello":
+            writer.close()
+            return
+        shard = hello[1]
+        self.writers[shard] = writer
+        self.send(shard, ("configure", self.shares[shard], self.plugins, self.setup, self.forward))
+        self.shard_ready[shard].set()
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                break
+            try:
+                self.handle_frame(shard, frame)
+            except Exception:
+                logger.exception("Error handling {} from shard {}".format(frame[0], shard))
+        del self.writers[shard]
+        if not self.stopping:
+            logger.warning("Shard {} disconnected from the bus".format(shard))
+        dispatcher.send("shard-exited", self, shard=shard)
+
+    def handle_frame(self, shard, frame):
+        kind = frame[0]
+        if kind == "connected":
+            _, netid = frame
+            self.clients[netid] = RemoteClient(self, netid, shard)
+            dispatcher.send("shard-connected", self.clients[netid])
+        elif kind == "event":
+            _, netid, name, sender, kwargs = frame
+            client = self.clients.get(netid) or RemoteClient(self, netid, shard)
+            if isinstance(sender, RFC1459Message):
+                sender.client = client
+            else:
+                sender = client
+            dispatcher.send(name, sender, **kwargs)
+
+    async def stop(self, message="Shutting down"):
+        """
+        Tell every worker to QUIT its networks and exit, and wait for them.
+        """
+        self.stopping = True
+        for shard in list(self.writers):
+            self.send(shard, ("stop", message))
+        for process in self.processes:
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                process.kill()
+        self.server.close()
+        os.unlink(self.socket_path)
+        if self.socket_dir is not None:
+            os.rmdir(self.socket_dir)
+
+## worker side
+
+def _forwarder(writer, name):
+    def forward(sender, **kwargs):
+        client = connection_of(sender)
+        netid = getattr(client, "netid", None)
+        if netid is None:
+            return
+        if isinstance(sender, RFC1459Message):
+            sender = sender.snapshot()
+        else:
+            sender = None
+        try:
+            writer.write(encode_frame(("event", netid, name, sender, kwargs)))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.warning("Can't forward {} from {}: {}".format(name, netid, e))
+    return forward
+
+def _call(frame):
+    _, netid, method, args, kwargs = frame
+    client = irc.connections.get(netid)
+    if client is None:
+        logger.warning("Dropping {} for {}, which isn't connected here".format(method, netid))
+        return
+    try:
+        getattr(client, method)(*args, **kwargs)
+    except Exception:
+        logger.exception("{} on {} failed".format(method, netid))
+
+async def _worker(socket_path, shard):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(encode_frame(("hello", shard)))
+    _, networks, plugins, setup, forward = await read_frame(reader)
+    for plugin in plugins:
+        importlib.import_module(plugin)
+    setup = load_callable(setup) if setup else None
+    for name in forward:
+        signal(name).connect(_forwarder(writer, name), weak=False)
+
+    async def connect(network):
+        conn = await irc.connect_async(network["server"], network.get("port", 6697),
+                                       network.get("use_ssl", True), network.get("timeout", 30))
+        if "nick" in network:
+            conn.register(network["nick"], network.get("user", network["nick"]),
+                          network.get("realname", network["nick"]))
+        if network.get("channels"):
+            conn.join(network["channels"])
+        if setup is not None:
+            setup(conn)
+        writer.write(encode_frame(("connected", conn.netid)))
+
+    for network, result in zip(networks, await asyncio.gather(*map(connect, networks), return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error("Shard {} couldn't connect to {}: {!r}".format(shard, network["server"], result))
+
+    while True:
+        frame = await read_frame(reader)
+        if frame is None or frame[0] == "stop":
+            break
+        if frame[0] == "call":
+            _call(frame)
+    irc.connections.shutdown(frame[1] if frame else "Shutting down")
+    writer.close()
+    # give the QUITs a moment to go out
+    await asyncio.sleep(0.1)
+
+def run_worker(socket_path, shard):
+    """
+    Entry point of a worker process.
+    """
+    irc.loop.run_until_complete(_worker(socket_path, shard))
+
+if __name__ == '__main__':
+    run_worker(sys.argv[1], int(sys.argv[2]))
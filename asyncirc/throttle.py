@@ -0,0 +1,209 @@
+"""
+Flood control for lines we send to the server.
+"""
+import collections
+import time
+
+class TokenBucket:
+    """
+    A token bucket modelled on the usual ircd flood rules: a client can send
+    `burst` lines in one go, and earns another line every `interval` seconds
+    after that. If bytes_per_token is set, each line costs one token per that
+    many bytes (and never less than one), for servers that count bytes rather
+    than lines.
+    """
+    def __init__(self, burst=5, interval=1.5, bytes_per_token=None, clock=time.monotonic):
+        self.burst = burst
+        self.interval = interval
+        self.bytes_per_token = bytes_per_token
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def cost(self, size):
+        """
+        How many tokens a line of `size` bytes costs.
+        """
+        if not self.bytes_per_token:
+            return 1.0
+        # anything bigger than the whole bucket could never be sent
+        return min(max(1.0, size / self.bytes_per_token), self.burst)
+
+    def refill(self):
+        now = self.clock()
+        if self.interval > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+        else:
+            self.tokens = self.burst
+        self.updated = now
+
+    def delay(self, cost=1.0):
+        """
+        Return how many seconds to wait before `cost` tokens are available,
+        or 0 if they are available right now.
+        """
+        self.refill()
+        if self.tokens >= cost:
+            return 0
+        return (cost - self.tokens) * self.interval
+
+    def consume(self, cost=1.0):
+        self.tokens -= cost
+
+# priority classes for outgoing lines, most urgent first
+CONTROL, INTERACTIVE, BULK = range(3)
+
+CONTROL_VERBS = {"PING", "PONG", "CAP", "AUTHENTICATE", "PASS", "NICK", "USER"}
+# verbs whose lines only need to stay in order for the same target
+FAIR_VERBS = {"PRIVMSG", "NOTICE", "TAGMSG"}
+
+def line_info(line):
+    """
+    Return the (verb, target) of an outgoing line, which can be an
+    RFC1459Message, a str or bytes. target is None for lines that have to
+    keep their place in the queue (everything but messages).
+    """
+    params = getattr(line, "params", None)
+    if params is not None:
+        verb = line.verb.upper()
+    else:
+        if isinstance(line, (bytes, bytearray)):
+            line = line.decode("latin-1")
+        params = line.split(" ", 3)
+        if params[0].startswith("@"):
+            params = params[1:]
+        verb = params[0].upper()
+        params = params[1:]
+    if verb in FAIR_VERBS and params:
+        return verb, params[0]
+    return verb, None
+
+def line_priority(verb):
+    """
+    The default priority for a line with the given verb.
+    """
+    return CONTROL if verb in CONTROL_VERBS else INTERACTIVE
+
+class SendQueue:
+    """
+    Lines waiting to be sent to the server, keeping track of how long each
+    line had to wait.
+
+    Lines are split into priority lanes (CONTROL, INTERACTIVE, BULK) and a lane
+    is only drained once every more urgent lane is empty. Inside a lane,
+    messages (PRIVMSG, NOTICE, TAGMSG) queued one after the other are grouped
+    by target and the targets take turns, so one busy channel can't hold up
+    replies to everyone else. Every other line (JOIN, QUIT, MODE, ...) is a
+    barrier: it goes out after everything queued before it, and nothing
+    queued after it overtakes it.
+
+    Each lane is a deque of segments: an OrderedDict of target -> lines for
+    a run of messages, or a single (line, time queued) entry for a barrier.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.lanes = [collections.deque() for _ in (CONTROL, INTERACTIVE, BULK)]
+        self.lane_depth = [0, 0, 0]
+        self.clock = clock
+        self.depth = 0
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return self.depth
+
+    def push(self, line, priority=None):
+        """
+        Queue a line. If no priority is given, control traffic (PING, PONG,
+        CAP, ...) goes into the CONTROL lane and everything else is
+        INTERACTIVE.
+        """
+        verb, target = line_info(line)
+        if priority is None:
+            priority = line_priority(verb)
+        lane = self.lanes[priority]
+        entry = (line, self.clock())
+        if target is None:
+            lane.append(entry)
+        else:
+            if not lane or not isinstance(lane[-1], collections.OrderedDict):
+                lane.append(collections.OrderedDict())
+            group = lane[-1]
+            if target in group:
+                group[target].append(entry)
+            else:
+                group[target] = collections.deque([entry])
+        self.lane_depth[priority] += 1
+        self.depth += 1
+
+    def transfer(self, other, priorities=(INTERACTIVE, BULK)):
+        """
+        Move the lines waiting in other's lanes for the given priorities to
+        the back of ours. They keep the time they were first queued.
+        """
+        for priority in priorities:
+            self.lanes[priority].extend(other.lanes[priority])
+            other.lanes[priority].clear()
+            moved = other.lane_depth[priority]
+            self.lane_depth[priority] += moved
+            self.depth += moved
+            other.lane_depth[priority] = 0
+            other.depth -= moved
+
+    def _next(self):
+        for priority, lane in enumerate(self.lanes):
+            if lane:
+                return priority, lane[0]
+        raise IndexError("pop from an empty SendQueue")
+
+    def peek(self):
+        _, segment = self._next()
+        if isinstance(segment, collections.OrderedDict):
+            return next(iter(segment.values()))[0][0]
+        return segment[0]
+
+    def pop(self):
+        priority, segment = self._next()
+        lane = self.lanes[priority]
+        if isinstance(segment, collections.OrderedDict):
+            target = next(iter(segment))
+            lines = segment[target]
+            line, queued = lines.popleft()
+            if lines:
+                segment.move_to_end(target)
+            else:
+                del segment[target]
+                if not segment:
+                    lane.popleft()
+        else:
+            line, queued = lane.popleft()
+        self.lane_depth[priority] -= 1
+        self.depth -= 1
+
+        wait = self.clock() - queued
+        self.sent += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+        return line
+
+    def stats(self):
+        """
+        Return a dict with the current queue depth (overall and per priority
+        lane) and wait time statistics for the lines sent so far.
+        """
+        heads = []
+        for lane in self.lanes:
+            # the oldest line in a lane is always in its first segment
+            if lane and isinstance(lane[0], collections.OrderedDict):
+                heads.extend(lines[0][1] for lines in lane[0].values())
+            elif lane:
+                heads.append(lane[0][1])
+        return {
+            "depth": self.depth,
+            "depth_by_priority": list(self.lane_depth),
+            "sent": self.sent,
+            "wait_avg": self.total_wait / self.sent if self.sent else 0.0,
+            "wait_max": self.max_wait,
+            "wait_oldest": self.clock() - min(heads) if heads else 0.0,
+        }
@@ -0,0 +1,160 @@
+"""
+Synthetic IRC traffic used by the benchmarks. The shapes are taken from
+recorded sessions on large networks: a join into a big channel produces a
+NAMES burst followed by a WHO burst, and busy channels are mostly PRIVMSGs.
+"""
+import random
+
+SERVER = "irc.example.com"
+
+def nicks(count, seed=0):
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyz[]_-^"
+    return ["{}{}".format("".join(rng.choice(alphabet) for _ in range(rng.randint(3, 12))), i)
+            for i in range(count)]
+
+def hostmask(nick):
+    return "{0}!~{0}@user/{0}".format(nick)
+
+def names_burst(channel, members, per_line=20):
+    lines = []
+    for i in range(0, len(members), per_line):
+        names = " ".join(("@" if j % 50 == 0 else "+" if j % 7 == 0 else "") + n
+                         for j, n in enumerate(members[i:i + per_line], i))
+        lines.append(":{} 353 bot = {} :{}".format(SERVER, channel, names))
+    lines.append(":{} 366 bot {} :End of /NAMES list.".format(SERVER, channel))
+    return lines
+
+def who_burst(channel, members):
+    lines = [":{0} 352 bot {1} ~{2} user/{2} {0} {2} H :0 {2}".format(SERVER, channel, n)
+             for n in members]
+    lines.append(":{} 315 bot {} :End of /WHO list.".format(SERVER, channel))
+    return lines
+
+def join_burst(channel, count, seed=0):
+    """
+    Everything the server sends after we join a channel with count users.
+    """
+    members = nicks(count, seed)
+    return names_burst(channel, members) + who_burst(channel, members)
+
+def chatter(channels, members, count, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        lines.append(":{} PRIVMSG {} :{}".format(
+            hostmask(rng.choice(members)), rng.choice(channels),
+            " ".join("word{}".format(rng.randint(0, 999)) for _ in range(rng.randint(1, 15)))))
+    return lines
+
+def encode(lines):
+    return "".join(line + "\r\n" for line in lines).encode("utf-8")
+
+def chunked(data, size=4096):
+    """
+    Split a byte stream into chunks the size of a typical socket read.
+    """
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def tagged(lines, seed=0):
+    """
+    Add the IRCv3 tags a server-time/account-tag/message-tags capable server
+    attaches to most lines.
+    """
+    rng = random.Random(seed)
+    return ["@time=2016-02-{:02d}T12:{:02d}:{:02d}.{:03d}Z;account=acct{};msgid=Xy\\:{}\\s{} {}".format(
+                rng.randint(1, 28), rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 999),
+                rng.randint(0, 99), rng.randint(0, 1 << 30), rng.randint(0, 99), line)
+            for line in lines]
+
+def traffic(count=20000, seed=0):
+    """
+    A mix resembling a day in a few busy channels: mostly chatter, some of it
+    tagged, plus joins, parts, quits and nick changes.
+    """
+    rng = random.Random(seed)
+    channels = ["#chan{}".format(i) for i in range(10)]
+    members = nicks(500, seed)
+    lines = chatter(channels, members, count, seed)
+    lines[::3] = tagged(lines[::3], seed)
+    for i in range(0, count, 10):
+        nick = rng.choice(members)
+        lines[i] = rng.choice([
+            ":{} JOIN {}".format(hostmask(nick), rng.choice(channels)),
+            ":{} PART {} :bye".format(hostmask(nick), rng.choice(channels)),
+            ":{} QUIT :Ping timeout: 240 seconds".format(hostmask(nick)),
+            ":{} NICK {}_".format(hostmask(nick), nick),
+            ":{} MODE {} +o {}".format(hostmask(nick), rng.choice(channels), nick),
+            "PING :{}".format(SERVER),
+        ])
+    return lines
+
+def own_join(channel, nick="bot"):
+    return ":{0}!{0}@bot.example.com JOIN {1}".format(nick, channel)
+
+def populated(channels, population, size, rng):
+    """
+    Join channels and get a NAMES reply for each, with size members picked
+    from population. Returns the lines and who ended up where.
+    """
+    lines = []
+    membership = {}
+    for channel in channels:
+        members = rng.sample(population, size)
+        membership[channel] = members
+        lines.append(own_join(channel))
+        lines += names_burst(channel, members)
+    return lines, membership
+
+def names_flood(channels=50, size=1000, seed=0):
+    """
+    Joining a lot of big channels at once, like after a reconnect: a JOIN,
+    NAMES burst and WHO burst for each of them.
+    """
+    rng = random.Random(seed)
+    population = nicks(size * 3, seed)
+    lines = []
+    for i in range(channels):
+        channel = "#flood{}".format(i)
+        members = rng.sample(population, size)
+        lines.append(own_join(channel))
+        lines += names_burst(channel, members) + who_burst(channel, members)
+    return lines
+
+def netsplit(channels=20, size=500, split=0.5, seed=0):
+    """
+    A netsplit and the netjoin after it: a share of the users QUIT with the
+    names of the two servers as the reason, then JOIN every channel they
+    were in again, and get their modes back.
+    """
+    rng = random.Random(seed)
+    population = nicks(size * 4, seed)
+    names = ["#split{}".format(i) for i in range(channels)]
+    lines, membership = populated(names, population, size, rng)
+    present = set(n for members in membership.values() for n in members)
+    gone = rng.sample(sorted(present), int(len(present) * split))
+    lines += [":{} QUIT :*.net *.split".format(hostmask(nick)) for nick in gone]
+    gone = set(gone)
+    for channel, members in membership.items():
+        rejoined = [nick for nick in members if nick in gone]
+        lines += [":{} JOIN {}".format(hostmask(nick), channel) for nick in rejoined]
+        for i in range(0, len(rejoined), 4):
+            batch = rejoined[i:i + 4]
+            lines.append(":{} MODE {} +{} {}".format(SERVER, channel, "v" * len(batch), " ".join(batch)))
+    return lines
+
+def nick_storm(count=20000, channels=10, size=500, seed=0):
+    """
+    Lots of users changing nick over and over, like a flood of clones or a
+    bouncer reconnecting everyone with a changed nick.
+    """
+    rng = random.Random(seed)
+    population = nicks(size * 2, seed)
+    lines, membership = populated(["#storm{}".format(i) for i in range(channels)], population, size, rng)
+    current = sorted(set(n for members in membership.values() for n in members))
+    for i in range(count):
+        j = rng.randrange(len(current))
+        new = "{}|{}".format(current[j].partition("|")[0], i)
+        lines.append(":{} NICK {}".format(hostmask(current[j]), new))
+        current[j] = new
+    return lines
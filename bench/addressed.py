@@ -0,0 +1,51 @@
+import time
+from asyncirc.dispatch import dispatcher
+from asyncirc.plugins import addressed
+from blinker import signal
+
+class Client:
+    nickname = "bot"
+
+class Message:
+    client = Client()
+
+def legacy_handle_public_messages(message, user, target, text):
+    prefix = message.client.nickname
+    triggers = [i.format(prefix) for i in ["{}: ", "{}, ", "{} "] + addressed.command_character_registry]
+    for trigger in triggers:
+        if text.startswith(trigger):
+            text = text[len(trigger):]
+            dispatcher.send("addressed", message, user=user, target=target, text=text)
+            return
+
+def lines_per_second(lines, handle, rounds=5):
+    message = Message()
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for text in lines:
+            handle(message, None, "#bench", text)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+def run():
+    for c in ["!", ".", ";;"]:
+        addressed.register_command_character(c)
+    # mostly chatter, which is what every public message has to be checked against
+    lines = ["just some chatter, line {}".format(i) for i in range(9000)]
+    lines += ["bot: roll {}d6".format(i % 10) for i in range(500)] + ["!ro {}".format(i % 10) for i in range(500)]
+
+    @addressed.command("roll")
+    def on_roll(message, user, target, args):
+        pass
+
+    print("{} public messages, 10% addressed".format(len(lines)))
+    signal("addressed").disconnect(addressed.router.route)
+    print("legacy triggers:             {:12,.0f} lines/s".format(lines_per_second(lines, legacy_handle_public_messages)))
+    print("compiled triggers:           {:12,.0f} lines/s".format(lines_per_second(lines, addressed.handle_public_messages)))
+    signal("addressed").connect(addressed.router.route)
+    print("  and the command router:    {:12,.0f} lines/s".format(lines_per_second(lines, addressed.handle_public_messages)))
+    addressed.router.unregister("roll")
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,65 @@
+import time
+from asyncirc.dispatch import dispatcher
+from asyncirc.irc import get_user
+from asyncirc.parser import RFC1459Message
+from asyncirc.plugins import core
+from blinker import signal
+from _corpus import chatter, nicks
+
+class Client:
+    nickname = "bot"
+    netid = "bench"
+
+received = []
+
+def public_message(message, user, target, text):
+    received.append(text)
+
+# the chain as it was before the dispatcher: every hop looks its signal up by
+# name and formats the name of the next one
+def legacy_raw(client, text):
+    message = RFC1459Message.from_message(text)
+    message.client = client
+    signal("legacy-irc").send(message)
+
+def legacy_irc(message):
+    signal("legacy-irc-{}".format(message.verb.lower())).send(message)
+
+def legacy_privmsg(message):
+    target, text = message.params[0], message.params[1]
+    user = get_user(message.source)
+    signal("legacy-message").send(message, user=user, target=target, text=text)
+    if target == message.client.nickname:
+        signal("legacy-private-{}".format("message")).send(message, user=user, target=target, text=text)
+    else:
+        signal("legacy-public-{}".format("message")).send(message, user=user, target=target, text=text)
+
+signal("legacy-raw").connect(legacy_raw)
+signal("legacy-irc").connect(legacy_irc)
+signal("legacy-irc-privmsg").connect(legacy_privmsg)
+signal("legacy-public-message").connect(public_message)
+
+def messages_per_second(send, lines, rounds=5):
+    client = Client()
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for line in lines:
+            send(client, line)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+def run():
+    lines = chatter(["#chan{}".format(i) for i in range(10)], nicks(500), 20000)
+    signal("public-message").connect(public_message)
+
+    legacy = messages_per_second(lambda client, line: signal("legacy-raw").send(client, text=line), lines)
+    current = messages_per_second(lambda client, line: dispatcher.send("raw", client, text=line), lines)
+    assert len(received) == 10 * len(lines), "messages went missing"
+
+    print("{} PRIVMSGs, raw -> public-message".format(len(lines)))
+    print("blinker signal() lookups:    {:12,.0f} msg/s".format(legacy))
+    print("Dispatcher:                  {:12,.0f} msg/s ({:.2f}x)".format(current, current / legacy))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,50 @@
+import time
+from asyncirc import irc
+from blinker import signal
+from _corpus import join_burst, encode, chunked
+
+class Transport:
+    def write(self, data):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+def lines_per_second(lines, feed, rounds=5):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        feed()
+        best = min(best, time.perf_counter() - start)
+    return lines / best
+
+def run():
+    lines = join_burst("#bench", 2000)
+    chunks = chunked(encode(lines))
+
+    def feed_linebuffer():
+        buf = irc.LineBuffer()
+        for chunk in chunks:
+            buf.feed(chunk)
+
+    protocol = irc.IRCProtocol()
+    protocol.connection_made(Transport())
+    protocol.netid = "bench"
+    def feed_protocol():
+        for chunk in chunks:
+            protocol.data_received(chunk)
+
+    received = []
+    def count_raw(client, text):
+        received.append(text)
+    signal("raw").connect(count_raw)
+    feed_protocol()
+    signal("raw").disconnect(count_raw)
+    assert len(received) == len(lines), "framing lost lines"
+
+    print("{} lines in {} chunks".format(len(lines), len(chunks)))
+    print("LineBuffer.feed:             {:12,.0f} lines/s".format(lines_per_second(len(lines), feed_linebuffer)))
+    print("IRCProtocol.data_received:   {:12,.0f} lines/s".format(lines_per_second(len(lines), feed_protocol)))
+
+if __name__ == '__main__':
+    run()
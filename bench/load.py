@@ -0,0 +1,59 @@
+"""
+Connects a few hundred clients to a MockServer on this machine, has them
+join the same busy channels, and measures how long registering and syncing
+takes and how fast the simulated chatter gets handled once they're in.
+"""
+import asyncio
+import time
+from asyncirc import irc
+from asyncirc.mockserver import MockServer
+import asyncirc.plugins.tracking
+
+clients = [100, 300]
+
+async def wait_for(condition, timeout=60):
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+async def load(count):
+    server = MockServer(seed=count)
+    channels = server.populate(users=5000, channels=50, members=200)
+    await server.start()
+    start = time.perf_counter()
+    conns = await irc.connect_many([("127.0.0.1", server.port, False)] * count, timeout=30)
+    for i, conn in enumerate(conns):
+        conn.throttle.interval = 0
+        conn.register("load{}".format(i), "load", "Load test")
+    await wait_for(lambda: all(conn.registration_complete for conn in conns))
+    registered = time.perf_counter() - start
+
+    for i, conn in enumerate(conns):
+        conn.join(channels[i % 5])
+    await wait_for(lambda: all(len(server.channels[name].connections) == count // 5 for name in channels[:5]))
+    joined = time.perf_counter() - start - registered
+
+    received = sum(conn.lines_received for conn in conns)
+    chatter_start = time.perf_counter()
+    server.chatter(2000)
+    await wait_for(lambda: sum(conn.lines_received for conn in conns) - received >= 2000 * count // 5)
+    lines = sum(conn.lines_received for conn in conns) - received
+    elapsed = time.perf_counter() - chatter_start
+
+    for conn in conns:
+        conn.close()
+    await wait_for(lambda: not server.connections)
+    server.close()
+    print("{:4} clients  registered in {:5.2f} s  joined in {:5.2f} s  {:9,.0f} lines/s received".format(
+        count, registered, joined, lines / elapsed))
+
+def run():
+    loop = asyncio.get_event_loop()
+    for count in clients:
+        loop.run_until_complete(load(count))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,98 @@
+import gc
+import random
+import time
+import tracemalloc
+from asyncirc.plugins import tracking
+from _corpus import nicks
+
+class Client:
+    nickname = "bot"
+    netid = "bench-memory"
+
+class LegacyUser:
+    """
+    A tracked user as the tracking plugin used to store it: a dict-backed
+    object holding its own copy of every string.
+    """
+    def __init__(self, nick, user, host, netid=None):
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.account = None
+        self.netid = netid
+        self.previous_nicks = []
+
+def hostmasks(members, rng):
+    """
+    Most users on a big network come from a few hundred bouncers, web
+    gateways and ISPs, so idents and hosts repeat a lot. Each hostmask is
+    built separately, like it would be when parsed off the wire.
+    """
+    shared_hosts = ["gateway{}.example.net".format(i) for i in range(500)]
+    for nick in members:
+        if rng.random() < 0.6:
+            yield "{}!{}@{}".format(nick, rng.choice(["~znc", "~quassel", "~user", "sid"]), rng.choice(shared_hosts))
+        else:
+            yield "{0}!~{0}@user/{0}".format(nick)
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used, kept
+
+def run():
+    rng = random.Random(0)
+    members = nicks(100000)
+    masks = list(hostmasks(members, rng))
+    channels = ["#chan{}".format(i) for i in range(2000)]
+    joins = [(nick, channel) for nick in members for channel in rng.sample(channels, 3)]
+    # separate copies of the same 20000 account names
+    accounts = ["account{}".format(i % 20000) for i in range(len(members))]
+
+    client = Client()
+    tracking.create_registry(client)
+    registry = client.tracking_registry
+
+    def legacy_users():
+        users = {}
+        for mask, account in zip(masks, accounts):
+            nick, rest = mask.split("!", 1)
+            user, host = rest.split("@", 1)
+            users[nick.lower()] = LegacyUser(nick, user, host, client.netid)
+            users[nick.lower()].account = account
+        return users
+
+    def users():
+        for mask, account in zip(masks, accounts):
+            tracking.get_user(client.netid, mask).account = tracking._intern(account)
+        return registry.users
+
+    def memberships():
+        for nick, channel in joins:
+            registry.add_membership(nick, channel)
+        return registry.channel_users
+
+    print("{} users, {} channels, {} memberships".format(len(members), len(channels), len(joins)))
+    used, kept = measure(legacy_users)
+    print("dict-backed users:  {:8,.0f} bytes/user".format(used / len(members)))
+    del kept
+    used, kept = measure(users)
+    print("tracked users:      {:8,.0f} bytes/user".format(used / len(members)))
+    used, kept = measure(memberships)
+    print("memberships:        {:8,.0f} bytes/membership".format(used / len(joins)))
+
+    start = time.perf_counter()
+    snapshot = registry.dump()
+    dumped = time.perf_counter() - start
+    start = time.perf_counter()
+    tracking.Registry.load(snapshot)
+    loaded = time.perf_counter() - start
+    print("registry snapshot: {:,} bytes, dumped in {:.2f}s, loaded in {:.2f}s".format(len(snapshot), dumped, loaded))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,79 @@
+import time
+from asyncirc.parser import RFC1459Message
+from _corpus import traffic
+
+class LegacyRFC1459Message(object):
+    """
+    The parser asyncirc shipped before the single-pass rewrite, kept here as a
+    baseline.
+    """
+    @classmethod
+    def from_data(cls, verb, params=None, source=None, tags=None):
+        o = cls()
+        o.verb = verb
+        o.tags = dict()
+        o.source = None
+        o.params = list()
+        if params:
+            o.params = params
+        if source:
+            o.source = source
+        if tags:
+            o.tags.update(**tags)
+        return o
+
+    @classmethod
+    def from_message(cls, message):
+        if isinstance(message, bytes):
+            message = message.decode('UTF-8', 'replace')
+        s = message.split(' ')
+        tags = None
+        if s[0].startswith('@'):
+            tag_str = s[0][1:].split(';')
+            s = s[1:]
+            tags = {}
+            for tag in tag_str:
+                k, v = tag.split('=', 1)
+                tags[k] = v
+        source = None
+        if s[0].startswith(':'):
+            source = s[0][1:]
+            s = s[1:]
+        verb = s[0].upper()
+        params = s[1:]
+        for param in params:
+            if param.startswith(':'):
+                idx = params.index(param)
+                arg = ' '.join(params[idx:])
+                arg = arg[1:]
+                params = params[:idx]
+                params.append(arg)
+                break
+        return cls.from_data(verb, params, source, tags)
+
+def messages_per_second(parse, lines, rounds=5):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+def run():
+    lines = traffic()
+    encoded = [line.encode("utf-8") for line in lines]
+
+    legacy = messages_per_second(LegacyRFC1459Message.from_message, lines)
+    current = messages_per_second(RFC1459Message.from_message, lines)
+    current_bytes = messages_per_second(RFC1459Message.from_message, encoded)
+    with_tags = messages_per_second(lambda line: RFC1459Message.from_message(line).tags, lines)
+
+    print("{} lines".format(len(lines)))
+    print("legacy from_message:          {:12,.0f} msg/s".format(legacy))
+    print("from_message (str):           {:12,.0f} msg/s ({:.2f}x)".format(current, current / legacy))
+    print("from_message (bytes):         {:12,.0f} msg/s".format(current_bytes))
+    print("from_message + tags access:   {:12,.0f} msg/s".format(with_tags))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,73 @@
+"""
+Replays synthetic traffic from recordings, through the parser alone, the
+core plugin, and the core and tracking plugins. Each stage runs in its own
+interpreter, so the core stage isn't slowed down by the tracking plugin's
+receivers and the memory figures don't include the other stages.
+"""
+import asyncio
+import gc
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from asyncirc.parser import RFC1459Message
+from asyncirc.recorder import read_recording, write_recording
+from asyncirc.replay import ReplayStats, mock_protocol, replay
+from _corpus import traffic, names_flood, netsplit, nick_storm
+
+stages = ["parser", "core", "tracking"]
+scenarios = [
+    ("traffic", traffic),
+    ("names flood", names_flood),
+    ("netsplit", netsplit),
+    ("nick storm", nick_storm),
+]
+
+def parse(path):
+    stats = ReplayStats()
+    start = time.perf_counter()
+    for _, line in read_recording(path)[1]:
+        line_start = time.perf_counter()
+        RFC1459Message.from_message(line)
+        stats.latencies.append(time.perf_counter() - line_start)
+        stats.lines += 1
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+def play(stage, path, netid):
+    if stage == "parser":
+        return parse(path)
+    return asyncio.get_event_loop().run_until_complete(replay(path, mock_protocol(netid)))
+
+def run_stage(stage):
+    if stage == "tracking":
+        import asyncirc.plugins.tracking
+    with tempfile.TemporaryDirectory() as directory:
+        for name, generate in scenarios:
+            path = os.path.join(directory, name.replace(" ", "-") + ".gz")
+            write_recording(path, generate())
+            stats = play(stage, path, name).stats()
+
+            gc.collect()
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            play(stage, path, name + " (memory)")
+            gc.collect()
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("{:9} {:12} {:7} lines {:10,.0f} lines/s  p99 {:7.1f} us  peak {:7,.0f} KiB  retained {:7,.0f} KiB".format(
+                stage, name, stats["lines"], stats["lines_per_second"], stats["p99"] * 1e6,
+                (peak - before) / 1024, (retained - before) / 1024))
+
+def run():
+    for stage in stages:
+        sys.stdout.flush()
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), stage])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_stage(sys.argv[1])
+    else:
+        run()
@@ -0,0 +1,7 @@
+import importlib
+benchmarks = ["framing", "parser", "dispatch", "tracking", "memory", "replay", "addressed", "load"]
+
+for benchmark in benchmarks:
+    print("Running benchmark {}...".format(benchmark))
+    importlib.import_module(benchmark).run()
+    print()
@@ -0,0 +1,100 @@
+import random
+import time
+from asyncirc.dispatch import dispatcher
+from asyncirc.plugins import tracking
+from _corpus import nicks, hostmask, names_burst, SERVER
+
+class Client:
+    nickname = "bot"
+    netid = "bench-tracking"
+    caps = set()
+
+    def __init__(self):
+        self.server_supports = {"PREFIX": "(ov)@+"}
+
+    def writeln(self, line, priority=None):
+        pass
+
+class LegacyRegistry:
+    """
+    Channel membership as the tracking plugin used to store it: one flat set
+    of (nick, channel) tuples.
+    """
+    def __init__(self):
+        self.mappings = set()
+
+    def rename_user(self, old_nick, new_nick):
+        for i in set(self.mappings):
+            if i[0] == old_nick:
+                self.mappings.discard(i)
+                self.mappings.add((new_nick, i[1]))
+
+    def remove_user(self, nick):
+        for channel in [c for n, c in self.mappings if n == nick]:
+            self.mappings.remove((nick, channel))
+
+def populate(registry, members, channels, rng):
+    for nick in members:
+        for channel in rng.sample(channels, 3):
+            if isinstance(registry, LegacyRegistry):
+                registry.mappings.add((nick, channel))
+            else:
+                registry.add_membership(nick, channel)
+
+def churn(registry, members, count):
+    start = time.perf_counter()
+    for nick in members[:count]:
+        registry.rename_user(nick, nick + "_")
+    for nick in members[:count]:
+        registry.remove_user(nick + "_")
+    return 2 * count / (time.perf_counter() - start)
+
+def churn_lines(members, channels, count, rng):
+    lines = []
+    for i in range(count):
+        nick = members[i]
+        lines.append(":{} NICK {}_".format(hostmask(nick), nick))
+        lines.append(":{}_!~{}@user/{} PART {} :bye".format(nick, nick, nick, rng.choice(channels)))
+        lines.append(":{}_!~{}@user/{} QUIT :Quit: bye".format(nick, nick, nick))
+        lines.append(":{} JOIN {}".format(hostmask(nick), rng.choice(channels)))
+    return lines
+
+def run():
+    rng = random.Random(0)
+    members = nicks(50000)
+    channels = ["#chan{}".format(i) for i in range(300)]
+
+    legacy = LegacyRegistry()
+    populate(legacy, members, channels, random.Random(1))
+    indexed = tracking.Registry()
+    populate(indexed, members, channels, random.Random(1))
+    print("{} users, {} channels, {} memberships".format(len(members), len(channels), len(legacy.mappings)))
+    print("flat set:   nick change/quit {:12,.0f} ops/s".format(churn(legacy, members, 50)))
+    print("indexed:    nick change/quit {:12,.0f} ops/s".format(churn(indexed, members, 20000)))
+
+    client = Client()
+    tracking.create_registry(client)
+    for channel in channels:
+        for nick in rng.sample(members, 500):
+            dispatcher.send("raw", client, text=":{} JOIN {}".format(hostmask(nick), channel))
+    lines = churn_lines(members, channels, 20000, rng)
+    start = time.perf_counter()
+    for line in lines:
+        dispatcher.send("raw", client, text=line)
+    elapsed = time.perf_counter() - start
+    print("raw NICK/PART/QUIT/JOIN through the tracking plugin: {:,.0f} lines/s".format(len(lines) / elapsed))
+
+    lines = [line for i in range(50)
+             for line in names_burst("#names{}".format(i), rng.sample(members, 1000))]
+    start = time.perf_counter()
+    for line in lines:
+        dispatcher.send("raw", client, text=line)
+    elapsed = time.perf_counter() - start
+    print("NAMES bursts through the tracking plugin: {:,.0f} names/s".format(50000 / elapsed))
+    start = time.perf_counter()
+    for i in range(50):
+        tracking.get_channel(client.netid, "#names{}".format(i)).ops
+    print("Channel.ops on 1000-member channels: {:,.0f} queries/s".format(50 / (time.perf_counter() - start)))
+
+if __name__ == '__main__':
+    run()
@@ -8,5 +8,6 @@ setup(
         author_email="fwilson@fwilson.me",
         url="https://github.com/watchtower/asyncirc",
         install_requires=["blinker"],
+        python_requires=">=3.5",
         packages=["asyncirc", "asyncirc.plugins"]
 )
@@ -0,0 +1,105 @@
+from asynctest import test, TestManager
+from asyncirc.plugins import core, addressed
+from blinker import signal
+from _mocks import Client
+
+client = Client()
+
+class Received(list):
+    pass
+
+def say(text, sender="example!example@example.com"):
+    signal("raw").send(client, text=":{} PRIVMSG #example :{}".format(sender, text))
+
+def collect(name, *fields):
+    received = Received()
+    def receiver(message, **kwargs):
+        received.append(tuple(kwargs[field] for field in fields))
+    signal(name).connect(receiver)
+    received.receiver = receiver
+    return received
+
+@test("should recognize every trigger, and compile them only when they change")
+def test_triggers():
+    received = collect("addressed", "text")
+    addressed.register_command_character(";;")
+    for text in ["bot: one", "bot, two", "bot three", ";;four", "robot: five", "five bot: six"]:
+        say(text)
+    pattern = addressed.triggers_for("bot")
+    same = addressed.triggers_for("bot") is pattern
+    client.nickname = "bot2"
+    say("bot2: seven")
+    say("bot: eight")
+    client.nickname = "bot"
+    addressed.register_command_character("!")
+    say("!nine")
+    signal("addressed").disconnect(received.receiver)
+    test_triggers.succeed_if(
+        [text for text, in received] == ["one", "two", "three", "four", "seven", "nine"] and
+        same and addressed.triggers_for("bot") is not pattern
+    )
+
+@test("should route commands by name, ignoring case, with parsed arguments")
+def test_router():
+    router = addressed.CommandRouter()
+    received = collect("command-roll", "args")
+    router.register("roll")
+    router.route(None, user=None, target="#example", text="ROLL 2d6  +3")
+    router.route(None, user=None, target="#example", text="roll")
+    router.route(None, user=None, target="#example", text="rollover 2d6")
+    signal("command-roll").disconnect(received.receiver)
+    test_router.succeed_if(received == [(("2d6", "+3"),), ((),)])
+
+@test("should resolve unique abbreviations and report ambiguous ones")
+def test_abbreviations():
+    router = addressed.CommandRouter()
+    for name in ["help", "hello", "roll", "rollover"]:
+        router.register(name)
+    ambiguous = collect("command-ambiguous", "command", "candidates")
+    router.route(None, user=None, target="#example", text="hel there")
+    signal("command-ambiguous").disconnect(ambiguous.receiver)
+    router.unregister("hello")
+    strict = addressed.CommandRouter(abbreviations=False)
+    strict.register("help")
+    test_abbreviations.succeed_if(
+        router.resolve("rollo").name == "rollover" and router.resolve("roll").name == "roll" and
+        router.resolve("hel").name == "help" and router.resolve("x") is None and
+        ambiguous == [("hel", ["hello", "help"])] and strict.resolve("hel") is None
+    )
+
+@test("should ignore addressed messages without a command name")
+def test_empty_command():
+    router = addressed.CommandRouter()
+    router.register("roll")
+    received = collect("command-roll", "args")
+    ambiguous = collect("command-ambiguous", "command")
+    router.route(None, user=None, target="#example", text="")
+    router.route(None, user=None, target="#example", text="  roll 2d6")
+    router.register("rollover")
+    router.route(None, user=None, target="#example", text=" ")
+    signal("command-roll").disconnect(received.receiver)
+    signal("command-ambiguous").disconnect(ambiguous.receiver)
+    test_empty_command.succeed_if(received == [(("2d6",),)] and ambiguous == [] and router.resolve("") is None)
+
+@test("should parse each argument string once per command")
+def test_parse_cache():
+    calls = []
+    def parse(text):
+        calls.append(text)
+        return tuple(int(i) for i in text.split())
+    received = collect("command-add", "args")
+
+    @addressed.command("add", parser=parse)
+    def on_add(message, user, target, args):
+        pass
+
+    for text in ["bot: add 1 2", "bot: add 1 2", "bot: a 1 2", "bot: add 3"]:
+        say(text)
+    signal("command-add").disconnect(received.receiver)
+    addressed.router.unregister("add")
+    test_parse_cache.succeed_if(calls == ["1 2", "3"] and received == [((1, 2),)] * 3 + [((3,),)])
+
+manager = TestManager([test_triggers, test_router, test_abbreviations, test_empty_command, test_parse_cache])
+
+if __name__ == '__main__':
+    manager.run_all()
@@ -0,0 +1,47 @@
+import asyncio
+from asynctest import test, TestManager
+from asyncirc import irc
+
+loop = asyncio.get_event_loop()
+received = []
+
+async def handle_client(reader, writer):
+    received.append(await reader.readline())
+    writer.close()
+
+server = loop.run_until_complete(asyncio.start_server(handle_client, "127.0.0.1", 0))
+port = server.sockets[0].getsockname()[1]
+
+@test("should connect to several servers at once from inside the event loop")
+def test_connect_many():
+    async def connect():
+        return await irc.connect_many([("127.0.0.1", port, False), ("127.0.0.1", port, False),
+                                       ("127.0.0.1", 1, False)], timeout=5)
+    global results
+    results = loop.run_until_complete(connect())
+    test_connect_many.succeed_if(
+        isinstance(results[0], irc.IRCProtocolWrapper) and isinstance(results[1], irc.IRCProtocolWrapper) and
+        isinstance(results[2], OSError) and results[0].netid != results[1].netid
+    )
+
+@test("should look connections up by netid and by server")
+def test_connection_lookup():
+    test_connection_lookup.succeed_if(
+        irc.connections[results[0].netid] is results[0] and results[1].netid in irc.connections and
+        irc.connections.find("127.0.0.1") == results[:2] and list(irc.connections) == results[:2]
+    )
+
+@test("should QUIT and forget every connection on shutdown")
+def test_shutdown():
+    irc.connections.shutdown("Bye")
+    loop.run_until_complete(asyncio.sleep(0.1))
+    test_shutdown.succeed_if(
+        len(irc.connections) == 0 and received == [b"QUIT Bye\r\n"] * 2 and
+        not results[0].autoreconnect
+    )
+    server.close()
+
+manager = TestManager([test_connect_many, test_connection_lookup, test_shutdown])
+
+if __name__ == '__main__':
+    manager.run_all()
@@ -1,10 +1,12 @@
 from asynctest import test, TestManager
-from asyncirc.plugins import core
+from asyncirc.dispatch import dispatcher
+from asyncirc.plugins import core, cap
+from asyncirc.irc import LineBuffer, parse_hostmask
 from blinker import signal
 from _mocks import Client
 
 def receive_pong(line):
-    test_ping.succeed_if(line == "PONG irc.example.com")
+    test_ping.succeed_if(bytes(line) == b"PONG irc.example.com")
 
 def check_example_user(u):
     return u.nick == "example" and u.user == "example" and u.host == "example.com"
@@ -127,12 +129,50 @@ def test_mode_set():
 def test_mode_unset():
     signal("raw").send(client, text=":irc.example.com MODE #channel -u")
 
+@test("should frame lines split across reads, with or without carriage returns")
+def test_line_framing():
+    buf = LineBuffer()
+    lines = buf.feed(b"PING :one\r\nPING :t") + buf.feed(b"wo\nPING :thr") + buf.feed(b"ee\r\n")
+    test_line_framing.succeed_if(lines == ["PING :one", "PING :two", "PING :three"] and not buf.buf)
+
+@test("should fall back to latin-1 per line rather than per read")
+def test_line_decoding():
+    lines = LineBuffer().feed("PRIVMSG #a :caf\u00e9\r\n".encode("utf-8") + b"PRIVMSG #a :caf\xe9\r\n")
+    test_line_decoding.succeed_if(lines == ["PRIVMSG #a :caf\u00e9", "PRIVMSG #a :caf\u00e9"])
+
+@test("should drop lines longer than the maximum line length")
+def test_line_length_cap():
+    buf = LineBuffer(max_line_length=16)
+    lines = buf.feed(b"PRIVMSG #a :" + b"x" * 32) + buf.feed(b"xxxx\r\nPING :ok\r\n")
+    test_line_length_cap.succeed_if(lines == ["PING :ok"] and buf.dropped == 1 and len(buf.buf) == 0)
+
+@test("should split hostmasks, and leave anything else as just a nick")
+def test_parse_hostmask():
+    test_parse_hostmask.succeed_if(
+        parse_hostmask("nick!~user@host.example.com") == ("nick", "~user", "host.example.com") and
+        parse_hostmask("irc.example.com") == ("irc.example.com", None, None) and
+        parse_hostmask("odd@host!name") == ("odd@host!name", None, None)
+    )
+
+@test("should negotiate caps when the server's CAP LS comes before netid-available")
+def test_cap_ls_first():
+    sent = []
+    early = Client(writeln=lambda line: sent.append(bytes(line).decode()))
+    early.netid = "mock with an early CAP LS"
+    cap.request_capability(early.netid, "multi-prefix")
+    signal("raw").send(early, text=":irc.example.com CAP * LS :multi-prefix sasl")
+    dispatcher.send("netid-available", early)
+    dispatcher.send("registration-complete", early)
+    signal("raw").send(early, text=":irc.example.com CAP * ACK :multi-prefix")
+    test_cap_ls_first.succeed_if(sent == ["CAP LS", "CAP REQ multi-prefix", "CAP END"] and "multi-prefix" in early.caps)
+
 manager = TestManager([
     test_ping, test_public_message_dispatch, test_private_message_dispatch,
     test_public_notice_dispatch, test_private_notice_dispatch, test_join_dispatch,
     test_part_dispatch_reason, test_part_dispatch_no_reason, test_quit_dispatch,
     test_kick_dispatch, test_nick_dispatch, test_isupport, test_mode_set,
-    test_mode_unset
+    test_mode_unset, test_line_framing, test_line_decoding, test_line_length_cap,
+    test_parse_hostmask, test_cap_ls_first
 ])
 
 if __name__ == '__main__':
@@ -0,0 +1,156 @@
+import asyncio
+import concurrent.futures
+import gc
+import pickle
+import threading
+from asynctest import test, TestManager
+from asyncirc.dispatch import Dispatcher, offload
+from asyncirc.parser import RFC1459Message
+from blinker import signal
+
+dispatcher = Dispatcher()
+
+@test("should pick up receivers connected after the first send")
+def test_dispatch_connect():
+    received = []
+    def receiver(sender, **kwargs):
+        received.append(kwargs["value"])
+    dispatcher.send("test-dispatch-connect", None, value=1)
+    signal("test-dispatch-connect").connect(receiver)
+    dispatcher.send("test-dispatch-connect", None, value=2)
+    test_dispatch_connect.succeed_if(received == [2])
+
+@test("should stop calling receivers once they disconnect")
+def test_dispatch_disconnect():
+    received = []
+    def receiver(sender):
+        received.append(sender)
+    signal("test-dispatch-disconnect").connect(receiver)
+    dispatcher.send("test-dispatch-disconnect", 1)
+    signal("test-dispatch-disconnect").disconnect(receiver)
+    dispatcher.send("test-dispatch-disconnect", 2)
+    test_dispatch_disconnect.succeed_if(received == [1] and not dispatcher.has_receivers("test-dispatch-disconnect"))
+
+@test("should not keep weakly connected receivers alive")
+def test_dispatch_weak():
+    received = []
+    def receiver(sender):
+        received.append(sender)
+    signal("test-dispatch-weak").connect(receiver)
+    dispatcher.send("test-dispatch-weak", 1)
+    del receiver
+    gc.collect()
+    dispatcher.send("test-dispatch-weak", 2)
+    test_dispatch_weak.succeed_if(received == [1])
+
+@test("should respect receivers connected to a specific sender")
+def test_dispatch_sender():
+    received = []
+    def receiver(sender):
+        received.append(sender)
+    sender = object()
+    signal("test-dispatch-sender").connect(receiver, sender=sender)
+    dispatcher.send("test-dispatch-sender", object())
+    dispatcher.send("test-dispatch-sender", sender)
+    test_dispatch_sender.succeed_if(received == [sender])
+
+class Connection:
+    pass
+
+def run_pending():
+    loop = asyncio.get_event_loop()
+    for _ in range(5):
+        loop.run_until_complete(asyncio.sleep(0))
+
+@test("should run coroutine receivers as tasks, a limited number at a time")
+def test_dispatch_coroutines():
+    dispatcher.event_task_limit = 2
+    connection = Connection()
+    running, finished = [], []
+    release = asyncio.Event()
+    async def receiver(sender, value):
+        running.append(value)
+        await release.wait()
+        finished.append(value)
+    signal("test-dispatch-coroutines").connect(receiver)
+    for i in range(5):
+        dispatcher.send("test-dispatch-coroutines", connection, value=i)
+    run_pending()
+    started = list(running)
+    in_flight = dispatcher.tasks_for(connection).stats()["in_flight"]
+    release.set()
+    run_pending()
+    test_dispatch_coroutines.succeed_if(
+        started == [0, 1] and in_flight == 5 and sorted(finished) == [0, 1, 2, 3, 4]
+    )
+
+@test("should cancel a connection's coroutine receivers")
+def test_dispatch_cancel():
+    connection = Connection()
+    finished = []
+    async def receiver(sender):
+        await asyncio.sleep(60)
+        finished.append(sender)
+    signal("test-dispatch-cancel").connect(receiver)
+    dispatcher.send("test-dispatch-cancel", connection)
+    run_pending()
+    dispatcher.cancel_tasks(connection)
+    run_pending()
+    test_dispatch_cancel.succeed_if(not finished and not dispatcher.tasks_for(connection).tasks)
+
+@test("should report exceptions raised by coroutine receivers")
+def test_dispatch_coroutine_errors():
+    connection = Connection()
+    errors = []
+    async def receiver(sender):
+        raise ValueError("oops")
+    def on_error(sender, event, receiver, exception):
+        errors.append((sender, event, exception))
+    signal("test-dispatch-errors").connect(receiver)
+    signal("handler-error").connect(on_error)
+    dispatcher.send("test-dispatch-errors", connection)
+    run_pending()
+    test_dispatch_coroutine_errors.succeed_if(
+        len(errors) == 1 and errors[0][:2] == (connection, "test-dispatch-errors") and
+        dispatcher.tasks_for(connection).stats()["failed"] == 1
+    )
+
+pool = concurrent.futures.ThreadPoolExecutor(1)
+
+@offload(pool)
+def offloaded_handler(message, text):
+    return ["PRIVMSG {} :{}".format(message.params[0], text.upper()), threading.current_thread().name]
+
+@test("should run offloaded receivers in the executor and write back what they return")
+def test_offload():
+    written = []
+    connection = Connection()
+    connection.writeln = written.append
+    message = RFC1459Message.from_message("PRIVMSG #a :hi")
+    message.client = connection
+    offloaded_handler(message, text="hi")
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(loop.run_in_executor(pool, lambda: None))
+    run_pending()
+    test_offload.succeed_if(
+        len(written) == 2 and written[0] == "PRIVMSG #a :HI" and written[1] != threading.current_thread().name
+    )
+
+@test("should snapshot messages so they can be pickled")
+def test_snapshot():
+    message = RFC1459Message.from_message("@a=b :nick!user@host PRIVMSG #a :hi")
+    message.client = threading.Lock()
+    copy = pickle.loads(pickle.dumps(message.snapshot()))
+    test_snapshot.succeed_if(
+        copy.client is None and copy.tags == {"a": "b"} and copy.params == ["#a", "hi"] and
+        copy.source == "nick!user@host"
+    )
+
+manager = TestManager([
+    test_dispatch_connect, test_dispatch_disconnect, test_dispatch_weak, test_dispatch_sender,
+    test_dispatch_coroutines, test_dispatch_cancel, test_dispatch_coroutine_errors, test_offload,
+    test_snapshot
+])
+
+if __name__ == '__main__':
+    manager.run_all()
@@ -0,0 +1,90 @@
+import asyncio
+from asynctest import test, TestManager
+from asyncirc.keepalive import Keepalive, LagHistogram
+
+loop = asyncio.get_event_loop()
+
+class Transport:
+    def __init__(self):
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+class Client:
+    def __init__(self):
+        self.loop = loop
+        self.transport = Transport()
+        self.sent = []
+
+    def writeln(self, message):
+        self.sent.append(message)
+
+@test("should track lag percentiles and cumulative buckets")
+def test_histogram():
+    histogram = LagHistogram(window=4)
+    for lag in [0.01, 0.2, 0.3, 3.0, 0.04]:
+        histogram.add(lag)
+    cumulative = dict(histogram.cumulative())
+    test_histogram.succeed_if(
+        len(histogram) == 4 and histogram.percentile(50) == 0.3 and histogram.percentile(99) == 3.0 and
+        cumulative[0.05] == 2 and cumulative[0.25] == 3 and cumulative[float("inf")] == 5 and
+        histogram.stats()["count"] == 5
+    )
+
+@test("should match PONGs to their PINGs by token")
+def test_pong_tokens():
+    client = Client()
+    keepalive = Keepalive(client, interval=3600)
+    keepalive.ping()
+    keepalive.ping()
+    first, second = [message.params[0] for message in client.sent]
+    unknown = keepalive.pong("GNIP")
+    lag = keepalive.pong(second)
+    late = keepalive.pong(first)
+    keepalive.stop()
+    test_pong_tokens.succeed_if(
+        first != second and unknown is None and lag is not None and lag >= 0 and late is None and
+        not keepalive.pending and len(keepalive.histogram) == 1
+    )
+
+@test("should adapt the PONG timeout to the server's lag")
+def test_adaptive_timeout():
+    keepalive = Keepalive(Client(), min_timeout=15, max_timeout=240, multiplier=10)
+    unmeasured = keepalive.timeout()
+    keepalive.histogram.add(0.1)
+    fast = keepalive.timeout()
+    keepalive.histogram.add(5.0)
+    slow = keepalive.timeout()
+    keepalive.histogram.add(60.0)
+    test_adaptive_timeout.succeed_if(
+        unmeasured == 240 and fast == 15 and slow == 50 and keepalive.timeout() == 240
+    )
+
+@test("should drop the connection when a PING goes unanswered")
+def test_expire():
+    client = Client()
+    keepalive = Keepalive(client, interval=3600, max_timeout=0.05)
+    keepalive.start()
+    loop.run_until_complete(asyncio.sleep(0.2))
+    test_expire.succeed_if(
+        client.transport.aborted and keepalive.timeouts == 1 and not keepalive.running and
+        len(client.sent) == 1
+    )
+
+@test("should cancel its timers when stopped")
+def test_stop():
+    client = Client()
+    keepalive = Keepalive(client, interval=0.05, max_timeout=0.05)
+    keepalive.start()
+    loop.run_until_complete(asyncio.sleep(0.01))
+    keepalive.stop()
+    loop.run_until_complete(asyncio.sleep(0.2))
+    test_stop.succeed_if(
+        len(client.sent) == 1 and not client.transport.aborted and not keepalive.running
+    )
+
+manager = TestManager([test_histogram, test_pong_tokens, test_adaptive_timeout, test_expire, test_stop])
+
+if __name__ == '__main__':
+    manager.run_all()
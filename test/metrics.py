@@ -0,0 +1,82 @@
+import asyncio
+from asynctest import test, TestManager
+from asyncirc import irc, metrics
+from asyncirc.dispatch import Dispatcher
+from blinker import signal
+
+loop = asyncio.get_event_loop()
+
+@test("should keep cumulative histogram buckets")
+def test_histogram():
+    histogram = metrics.Histogram([0.1, 1])
+    for value in [0.05, 0.1, 0.5, 5]:
+        histogram.observe(value)
+    test_histogram.succeed_if(
+        histogram.cumulative() == [(0.1, 2), (1, 3), (float("inf"), 4)] and
+        histogram.count == 4 and histogram.sum == 5.65
+    )
+
+@test("should count every signal sent and time a sample of them")
+def test_signal_stats():
+    dispatcher = Dispatcher()
+    signal("test-metrics-signal").connect(lambda sender: None, weak=False)
+    for _ in range(32):
+        dispatcher.send("test-metrics-signal", None)
+    count, timed, seconds = dispatcher.signal_stats["test-metrics-signal"]
+    test_signal_stats.succeed_if(count == 32 and timed == 2 and seconds > 0)
+
+@test("should render the Prometheus text format, escaping label values")
+def test_render():
+    exposition = metrics.Exposition()
+    exposition.add("test_total", "counter", "A test.", 3, {"netid": 'a"b\\c\nd'})
+    exposition.histogram("test_seconds", "Some times.", metrics.Histogram([0.5]))
+    test_render.succeed_if(exposition.render() == "\n".join([
+        "# HELP test_total A test.",
+        "# TYPE test_total counter",
+        'test_total{netid="a\\"b\\\\c\\nd"} 3',
+        "# HELP test_seconds Some times.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.5"} 0',
+        'test_seconds_bucket{le="+Inf"} 0',
+        "test_seconds_sum 0.0",
+        "test_seconds_count 0",
+    ]) + "\n")
+
+async def handle_client(reader, writer):
+    writer.write(b":irc.example.com NOTICE * :hello\r\n:irc.example.com NOTICE * :there\r\n")
+    await reader.read()
+
+async def scrape(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode("ascii"))
+    response = await reader.read()
+    writer.close()
+    return response.decode("utf-8")
+
+@test("should serve per-connection metrics over HTTP")
+def test_serve():
+    server = loop.run_until_complete(asyncio.start_server(handle_client, "127.0.0.1", 0))
+    conn = irc.connect("127.0.0.1", server.sockets[0].getsockname()[1], use_ssl=False)
+    conn.writeln("NICK bot")
+    loop.run_until_complete(asyncio.sleep(0.1))
+    http = metrics.serve(0)
+    http_port = http.sockets[0].getsockname()[1]
+    page = loop.run_until_complete(scrape(http_port, "/metrics"))
+    missing = loop.run_until_complete(scrape(http_port, "/other"))
+    conn.close()
+    http.close()
+    server.close()
+    labels = '{{netid="{}"}}'.format(conn.netid)
+    test_serve.succeed_if(
+        page.startswith("HTTP/1.0 200 OK\r\n") and "Content-Type: {}\r\n".format(metrics.CONTENT_TYPE) in page and
+        "asyncirc_received_lines_total{} 2\n".format(labels) in page and
+        "asyncirc_sent_bytes_total{} 10\n".format(labels) in page and
+        "asyncirc_reconnects_total{} 0\n".format(labels) in page and
+        'asyncirc_signals_total{signal="raw"}' in page and
+        missing.startswith("HTTP/1.0 404 Not Found\r\n")
+    )
+
+manager = TestManager([test_histogram, test_signal_stats, test_render, test_serve])
+
+if __name__ == '__main__':
+    manager.run_all()
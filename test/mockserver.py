@@ -0,0 +1,152 @@
+import asyncio
+from asynctest import test, TestManager
+from asyncirc import irc
+from asyncirc.mockserver import MockServer
+from asyncirc.plugins import cap, sasl, tracking
+from asyncirc.reconnect import Backoff
+from blinker import signal
+
+loop = asyncio.get_event_loop()
+
+server = MockServer(accounts={"bot": "hunter2"}, seed=0)
+channels = server.populate(users=2000, channels=20, members=300)
+loop.run_until_complete(server.start())
+
+def unthrottled(conn):
+    conn.throttle.interval = 0
+    return conn
+
+def wait_for(condition, timeout=10):
+    async def poll():
+        for _ in range(int(timeout / 0.05)):
+            if condition():
+                return True
+            await asyncio.sleep(0.05)
+        return False
+    return loop.run_until_complete(poll())
+
+@test("should register with CAP and SASL PLAIN against the mock server")
+def test_mock_registration():
+    global conn
+    authenticated = []
+    def on_sasl(message):
+        authenticated.append(message.client.netid)
+    signal("sasl-auth-complete").connect(on_sasl)
+    conn = unthrottled(irc.connect("127.0.0.1", server.port, use_ssl=False))
+    conn.register("bot", "bot", "Bot")
+    sasl.auth(conn, "bot", "hunter2")
+    registered = wait_for(lambda: conn.registration_complete)
+    signal("sasl-auth-complete").disconnect(on_sasl)
+    mock = server.users["bot"].connection
+    test_mock_registration.succeed_if(
+        registered and authenticated == [conn.netid] and "sasl" in conn.caps and
+        mock.account == "bot" and mock.caps >= {"sasl"} and conn.server_supports["WHOX"] is not None
+    )
+
+@test("should join a simulated channel and sync it with NAMES and WHOX")
+def test_mock_join():
+    synced = []
+    def on_sync_done(message, channel, progress, latency):
+        synced.append(channel)
+    signal("sync-done").connect(on_sync_done)
+    conn.join(channels[:2])
+    done = wait_for(lambda: len(synced) == 2)
+    signal("sync-done").disconnect(on_sync_done)
+    channel = tracking.get_channel(conn.netid, channels[0])
+    members = [user for user, prefix in server.channels[channels[0]].members.values()]
+    test_mock_join.succeed_if(
+        done and len(channel.users) == 301 and "bot" in channel.users and len(channel.ops) == 12 and
+        all(tracking.get_user(conn.netid, user.nick).account == user.account for user in members[:20])
+    )
+
+@test("should hear simulated users talking in joined channels")
+def test_mock_chatter():
+    heard = []
+    def on_public_message(message, user, target, text):
+        if message.client.netid == conn.netid:
+            heard.append(target)
+    signal("public-message").connect(on_public_message)
+    server.chatter(50)
+    wait_for(lambda: len(heard) == 50, 2)
+    signal("public-message").disconnect(on_public_message)
+    test_mock_chatter.succeed_if(len(heard) == 50 and set(heard) <= set(channels[:2]))
+
+@test("should delay replies by the server's latency and lose dropped lines")
+def test_mock_latency():
+    pongs = conn.lag_stats()["count"]
+    server.latency = 0.2
+    conn.keepalive.ping()
+    slow = wait_for(lambda: conn.lag_stats()["count"] == pongs + 1, 2)
+    server.latency = 0
+    server.drop_rate = 1.0
+    conn.keepalive.ping()
+    lost = not wait_for(lambda: conn.lag_stats()["count"] == pongs + 2, 0.5)
+    server.drop_rate = 0
+    test_mock_latency.succeed_if(slow and conn.lag >= 0.2 and lost and server.users["bot"].connection.dropped >= 1)
+
+@test("should disconnect clients for excess flood, and let them reconnect with SASL")
+def test_mock_excess_flood():
+    errors = []
+    def on_error(message):
+        errors.append(message.params[0])
+    signal("irc-error").connect(on_error)
+    conn.supervisor.backoff = Backoff(base=0.01)
+    old = conn.protocol
+    for i in range(100):
+        conn.say(channels[0], "flood {}".format(i))
+    back = wait_for(lambda: conn.protocol is not old and conn.registration_complete)
+    signal("irc-error").disconnect(on_error)
+    test_mock_excess_flood.succeed_if(
+        back and errors and "Excess Flood" in errors[0] and server.users["bot"].connection.account == "bot"
+    )
+    conn.close()
+
+@test("should register even when register() is called after we're connected")
+def test_mock_late_register():
+    late = unthrottled(irc.connect("127.0.0.1", server.port, use_ssl=False))
+    wait_for(lambda: late.registration_due, 2)
+    late.register("late", "late", "Late")
+    registered = wait_for(lambda: late.registration_complete)
+    late.close()
+    test_mock_late_register.succeed_if(registered and "late" in server.users)
+
+@test("should finish registering when the server ACKs other caps but not SASL")
+def test_mock_no_sasl():
+    plain = MockServer(name="irc.plain.invalid", caps=("multi-prefix",), seed=1)
+    loop.run_until_complete(plain.start())
+    sent = []
+    def on_send(line):
+        sent.append(getattr(line, "verb", None))
+    signal("irc-send").connect(on_send)
+    client = unthrottled(irc.connect("127.0.0.1", plain.port, use_ssl=False))
+    cap.request_capability(client.netid, "multi-prefix")
+    client.register("nosasl", "nosasl", "No SASL")
+    sasl.auth(client, "nosasl", "secret")
+    registered = wait_for(lambda: client.registration_complete)
+    signal("irc-send").disconnect(on_send)
+    client.close()
+    plain.close()
+    test_mock_no_sasl.succeed_if(registered and "AUTHENTICATE" not in sent and "multi-prefix" in client.caps)
+
+@test("should handle a hundred concurrent connections")
+def test_mock_many():
+    async def connect():
+        return await irc.connect_many([("127.0.0.1", server.port, False)] * 100, timeout=5)
+    conns = loop.run_until_complete(connect())
+    for i, client in enumerate(conns):
+        unthrottled(client).register("load{}".format(i), "load", "Load test")
+        client.join(channels[5])
+    done = wait_for(lambda: all(client.registration_complete for client in conns) and
+                    len(server.channels["#chan5"].connections) == 100)
+    for client in conns:
+        client.close()
+    wait_for(lambda: not server.connections, 2)
+    test_mock_many.succeed_if(done and len(server.channels["#chan5"].members) == 300)
+    server.close()
+
+manager = TestManager([test_mock_registration, test_mock_join, test_mock_chatter, test_mock_latency,
+                       test_mock_excess_flood, test_mock_late_register, test_mock_no_sasl,
+                       test_mock_many])
+
+if __name__ == '__main__':
+    manager.run_all()
@@ -0,0 +1,64 @@
+from asynctest import test, TestManager
+from asyncirc.parser import RFC1459Message
+
+@test("should parse source, verb and trailing parameter")
+def test_parse_privmsg():
+    m = RFC1459Message.from_message(":nick!user@host PRIVMSG #channel :hello  there :)")
+    test_parse_privmsg.succeed_if(
+        m.source == "nick!user@host" and m.verb == "PRIVMSG" and
+        m.params == ["#channel", "hello  there :)"]
+    )
+
+@test("should parse messages without a source or trailing parameter")
+def test_parse_bare():
+    m = RFC1459Message.from_message("mode #channel +o  nick")
+    test_parse_bare.succeed_if(m.source is None and m.verb == "MODE" and m.params == ["#channel", "+o", "nick"])
+
+@test("should accept bytes")
+def test_parse_bytes():
+    m = RFC1459Message.from_message(b":irc.example.com 001 bot :Welcome \xe9")
+    test_parse_bytes.succeed_if(m.verb == "001" and m.params == ["bot", "Welcome é"])
+
+@test("should unescape tag values and accept valueless tags")
+def test_parse_tags():
+    m = RFC1459Message.from_message(r"@a=x\:y\sz\\;b;c=;d=\q\ :nick!user@host TAGMSG #channel")
+    test_parse_tags.succeed_if(
+        m.tags == {"a": "x;y z\\", "b": "", "c": "", "d": "q"} and
+        m.source == "nick!user@host" and m.params == ["#channel"]
+    )
+
+@test("should serialize messages, escaping tags and marking the trailing parameter")
+def test_serialize():
+    m = RFC1459Message.from_data("PRIVMSG", ["#channel", ":) hi"], tags={"a": "x; y", "b": ""})
+    bare = RFC1459Message.from_data("MODE", ["#channel", "+o", "nick"])
+    test_serialize.succeed_if(
+        bytes(m) == b"@a=x\\:\\sy;b PRIVMSG #channel ::) hi" and
+        bare.to_message() == "MODE #channel +o nick"
+    )
+
+@test("should refuse to serialize line breaks")
+def test_serialize_line_breaks():
+    try:
+        RFC1459Message.from_data("PRIVMSG", ["#channel", "hi\r\nQUIT"]).to_bytes()
+    except ValueError:
+        test_serialize_line_breaks.success()
+    else:
+        test_serialize_line_breaks.failure()
+
+@test("should only split parameters on spaces")
+def test_parse_spaces_only():
+    italic = RFC1459Message.from_message(":n!u@h PRIVMSG #chan \x1dhi\x1d")
+    underline = RFC1459Message.from_message(":n!u@h PRIVMSG  #chan  a\x1fb")
+    nbsp = RFC1459Message.from_message("MODE #caf\xa0e x")
+    test_parse_spaces_only.succeed_if(
+        italic.params == ["#chan", "\x1dhi\x1d"] and underline.params == ["#chan", "a\x1fb"] and
+        nbsp.params == ["#caf\xa0e", "x"]
+    )
+
+manager = TestManager([
+    test_parse_privmsg, test_parse_bare, test_parse_bytes, test_parse_tags, test_serialize,
+    test_serialize_line_breaks, test_parse_spaces_only
+])
+
+if __name__ == '__main__':
+    manager.run_all()
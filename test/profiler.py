@@ -0,0 +1,46 @@
+import time
+from asynctest import test, TestManager
+from asyncirc.dispatch import Dispatcher
+from asyncirc.profiler import Profiler
+from blinker import signal
+
+dispatcher = Dispatcher()
+
+def slow_receiver(sender):
+    time.sleep(0.08)
+
+def redispatching_receiver(sender):
+    dispatcher.send("test-profiler-inner", sender)
+
+signal("test-profiler-outer").connect(redispatching_receiver)
+signal("test-profiler-inner").connect(slow_receiver)
+
+@test("should blame slow receivers for their own time and sample their stack")
+def test_profile_slow_receiver():
+    profiler = Profiler(dispatcher, threshold=0.02).enable()
+    dispatcher.send("test-profiler-outer", None)
+    dispatcher.send("test-profiler-outer", None)
+    profiler.disable()
+    slow, outer = profiler.top(2)
+    test_profile_slow_receiver.succeed_if(
+        slow["receiver"] == "profiler.slow_receiver" and slow["calls"] == 2 and slow["slow"] == 2 and
+        slow["signals"] == ["test-profiler-inner"] and "time.sleep(0.08)" in slow["sample"] and
+        outer["receiver"] == "profiler.redispatching_receiver" and outer["own"] < 0.02 and
+        outer["total"] >= 0.16 and outer["slow"] == 0
+    )
+
+@test("should put the dispatcher's own send back when disabled")
+def test_profile_disable():
+    profiler = Profiler(dispatcher, threshold=1).enable()
+    enabled = dispatcher.send == profiler.send
+    profiler.disable()
+    dispatcher.send("test-profiler-outer", None)
+    test_profile_disable.succeed_if(
+        enabled and "send" not in vars(dispatcher) and dispatcher.send.__func__ is Dispatcher.send and
+        not profiler.timings and profiler.watchdog is None
+    )
+
+manager = TestManager([test_profile_slow_receiver, test_profile_disable])
+
+if __name__ == '__main__':
+    manager.run_all()
@@ -0,0 +1,100 @@
+import asyncio
+from asynctest import test, TestManager
+from blinker import signal
+from asyncirc.dispatch import dispatcher
+from asyncirc.irc import connections
+from asyncirc.replay import mock_protocol
+
+loop = asyncio.get_event_loop()
+
+def connection(netid):
+    protocol = mock_protocol(netid, keep_writes=True)
+    protocol.registration_complete = True
+    protocol.throttle.interval = 0
+    loop.run_until_complete(asyncio.sleep(0))
+    protocol.transport.written.clear()
+    return protocol
+
+def written(protocol):
+    loop.run_until_complete(asyncio.sleep(0.01))
+    return b"".join(protocol.transport.written).decode().splitlines()
+
+@test("should send channel keys as their own parameter, keyed channels first")
+def test_join_keys():
+    protocol = connection("test-join-keys")
+    protocol.join("#secret hunter2")
+    protocol.join(["#open", "#locked key1", "#other"], keys=[None, None, "key2"])
+    test_join_keys.succeed_if(written(protocol) == ["JOIN #secret hunter2", "JOIN #locked,#other,#open key1,key2"])
+
+@test("should drop lines that can't be sent without holding up the rest of the queue")
+def test_unsendable_line():
+    protocol = connection("test-unsendable-line")
+    protocol.say("#ok", "ok1")
+    protocol.say("#bad target", "dropped")
+    protocol.say("#ok", "ok2")
+    first = written(protocol)
+    protocol.say("#ok", "ok3")
+    test_unsendable_line.succeed_if(
+        first == ["PRIVMSG #ok ok1", "PRIVMSG #ok ok2"] and written(protocol)[-1] == "PRIVMSG #ok ok3" and
+        not protocol.queue
+    )
+
+@test("should coalesce the lines queued in one go into a single write")
+def test_coalesced_write():
+    protocol = connection("test-coalesced-write")
+    writes = protocol.writes
+    for i in range(5):
+        protocol.say("#chan", "line {}".format(i))
+    lines = written(protocol)
+    stats = protocol.send_stats()
+    test_coalesced_write.succeed_if(
+        len(protocol.transport.written) == 1 and stats["writes"] == writes + 1 and
+        lines == ["PRIVMSG #chan :line {}".format(i) for i in range(5)] and
+        stats["bytes_sent"] >= len(protocol.transport.written[0])
+    )
+
+@test("should hold the queue while the transport is paused and drain it on resume")
+def test_flow_control():
+    protocol = connection("test-flow-control")
+    protocol.pause_writing()
+    protocol.say("#chan", "one")
+    protocol.say("#chan", "two")
+    held = written(protocol) == [] and len(protocol.queue) == 2 and protocol.send_stats()["paused"]
+    protocol.resume_writing()
+    lines = written(protocol)
+    stats = protocol.send_stats()
+    test_flow_control.succeed_if(
+        held and lines == ["PRIVMSG #chan one", "PRIVMSG #chan two"] and len(protocol.transport.written) == 1 and
+        not protocol.queue and not stats["paused"] and stats["pauses"] == 1
+    )
+
+@test("should cancel running coroutine handlers and forget the connection when closed")
+def test_close():
+    protocol = connection("test-close")
+    connections.add(protocol.wrapper)
+    started = asyncio.Event()
+    cancelled = []
+
+    async def handler(sender):
+        started.set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(sender)
+            raise
+
+    signal("test-close-handler").connect(handler)
+    dispatcher.send("test-close-handler", protocol.wrapper)
+    loop.run_until_complete(started.wait())
+    protocol.close("bye")
+    lines = written(protocol)
+    signal("test-close-handler").disconnect(handler)
+    test_close.succeed_if(
+        cancelled == [protocol.wrapper] and lines == ["QUIT bye"] and protocol.transport.closed and
+        not protocol.work and connections.get("test-close") is None
+    )
+
+manager = TestManager([test_join_keys, test_unsendable_line, test_coalesced_write, test_flow_control, test_close])
+
+if __name__ == '__main__':
+    manager.run_all()
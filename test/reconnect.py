@@ -0,0 +1,161 @@
+import asyncio
+import random
+from asynctest import test, TestManager
+from asyncirc import irc
+from asyncirc.reconnect import Backoff, CircuitBreaker, ReconnectSupervisor, CLOSED, OPEN, HALF_OPEN
+from blinker import signal
+
+loop = asyncio.get_event_loop()
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@test("should pick backoff delays with full jitter under an exponential ceiling")
+def test_backoff():
+    backoff = Backoff(base=1, factor=2, cap=30, rng=random.Random(0))
+    delays = [backoff.delay(attempt) for attempt in range(10)]
+    test_backoff.succeed_if(
+        all(0 <= d <= min(30, 2 ** n) for n, d in enumerate(delays)) and
+        backoff.ceiling(1000) == 30 and len(set(delays)) == len(delays)
+    )
+
+@test("should open the circuit breaker after repeated failures and let one probe through")
+def test_circuit_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60, clock=clock)
+    for _ in range(3):
+        breaker.failure()
+    opened = breaker.state == OPEN and breaker.retry_after() == 60
+    clock.now = 61
+    probe, others = breaker.retry_after(), breaker.retry_after()
+    half_open = breaker.state == HALF_OPEN
+    breaker.failure()
+    reopened = breaker.state == OPEN and breaker.trips == 2
+    clock.now = 200
+    breaker.retry_after()
+    breaker.success()
+    test_circuit_breaker.succeed_if(
+        opened and probe == 0 and others == breaker.probe_poll and half_open and reopened and
+        breaker.state == CLOSED and breaker.failures == 0
+    )
+
+received = []
+server_writers = []
+
+async def handle_client(reader, writer):
+    server_writers.append(writer)
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        received.append(line)
+
+server = loop.run_until_complete(asyncio.start_server(handle_client, "127.0.0.1", 0))
+port = server.sockets[0].getsockname()[1]
+
+@test("should reconnect with the same wrapper and send lines queued before the drop")
+def test_reconnect_resume():
+    events = []
+    def on_reconnected(client_wrapper, attempts, downtime):
+        events.append((client_wrapper, attempts))
+    signal("reconnected").connect(on_reconnected)
+
+    conn = irc.connect("127.0.0.1", port, use_ssl=False)
+    conn.register("bot", "bot", "bot")
+    conn.supervisor.backoff = Backoff(base=0.01)
+    old = conn.protocol
+    loop.run_until_complete(asyncio.sleep(0.1))
+    old.pause_writing()
+    conn.say("#example", "still there?")
+    server_writers[0].close()
+    loop.run_until_complete(asyncio.sleep(0.5))
+
+    new = conn.protocol
+    signal("raw").send(new, text=":irc.example.com 001 bot :Welcome")
+    loop.run_until_complete(asyncio.sleep(0.1))
+    signal("reconnected").disconnect(on_reconnected)
+    test_reconnect_resume.succeed_if(
+        events == [(conn, 1)] and new is not old and new.wrapper is conn and
+        irc.connections[conn.netid] is conn and b"PRIVMSG #example :still there?\r\n" in received and
+        conn.supervisor.stats()["reconnects"] == 1
+    )
+    new.close()
+
+@test("should give up after max_attempts failed reconnects")
+def test_reconnect_give_up():
+    gave_up = []
+    def on_gave_up(client_wrapper, attempts):
+        gave_up.append(attempts)
+    signal("reconnect-gave-up").connect(on_gave_up)
+
+    conn = irc.connect("127.0.0.1", port, use_ssl=False)
+    conn.register("bot", "bot", "bot")
+    conn.supervisor = ReconnectSupervisor(conn, backoff=Backoff(base=0.01), max_attempts=2,
+                                          breaker=CircuitBreaker(threshold=5))
+    conn.server_info["port"] = 1
+    loop.run_until_complete(asyncio.sleep(0.1))
+    server_writers[-1].close()
+    loop.run_until_complete(asyncio.sleep(0.5))
+    signal("reconnect-gave-up").disconnect(on_gave_up)
+    stats = conn.supervisor.stats()
+    test_reconnect_give_up.succeed_if(
+        gave_up == [2] and stats["state"] == "gave-up" and stats["failures"] == 2 and
+        isinstance(stats["last_error"], OSError)
+    )
+    server.close()
+
+@test("should count a connection dropped before 001 as a failed attempt")
+def test_reconnect_dropped_before_registering():
+    async def refuse(reader, writer):
+        await asyncio.sleep(0.05)
+        writer.close()
+    refusing = loop.run_until_complete(asyncio.start_server(refuse, "127.0.0.1", 0))
+    conn = irc.connect("127.0.0.1", refusing.sockets[0].getsockname()[1], use_ssl=False)
+    conn.register("bot", "bot", "bot")
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+    conn.supervisor = ReconnectSupervisor(conn, backoff=Backoff(base=0.01), breaker=breaker)
+    loop.run_until_complete(asyncio.sleep(0.5))
+    stats = conn.supervisor.stats()
+    conn.supervisor.cancel()
+    conn.protocol.autoreconnect = False
+    refusing.close()
+    test_reconnect_dropped_before_registering.succeed_if(
+        breaker.state == OPEN and stats["failures"] == 3 and stats["attempts"] == 3 and
+        isinstance(stats["last_error"], ConnectionError)
+    )
+
+@test("should keep queued lines across reconnects that drop before registering")
+def test_reconnect_chained_backlog():
+    conn = irc.connect("127.0.0.1", port, use_ssl=False)
+    conn.register("bot", "bot", "bot")
+    conn.supervisor = ReconnectSupervisor(conn, backoff=Backoff(base=0.01), breaker=CircuitBreaker(threshold=5))
+    loop.run_until_complete(asyncio.sleep(0.1))
+    conn.protocol.pause_writing()
+    conn.say("#example", "first")
+    for i in range(2):
+        server_writers[-1].close()
+        loop.run_until_complete(asyncio.sleep(0.3))
+        if i == 0:
+            # lines queued on a connection that never registered
+            conn.protocol.pause_writing()
+            conn.say("#example", "second")
+    new = conn.protocol
+    signal("raw").send(new, text=":irc.example.com 001 bot :Welcome")
+    loop.run_until_complete(asyncio.sleep(0.1))
+    stats = conn.supervisor.stats()
+    new.close()
+    test_reconnect_chained_backlog.succeed_if(
+        b"PRIVMSG #example first\r\n" in received and b"PRIVMSG #example second\r\n" in received and
+        received.index(b"PRIVMSG #example first\r\n") < received.index(b"PRIVMSG #example second\r\n") and
+        stats["reconnects"] == 2 and stats["failures"] == 1
+    )
+
+manager = TestManager([test_backoff, test_circuit_breaker, test_reconnect_resume, test_reconnect_chained_backlog,
+                       test_reconnect_give_up, test_reconnect_dropped_before_registering])
+
+if __name__ == '__main__':
+    manager.run_all()
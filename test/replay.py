@@ -0,0 +1,62 @@
+import asyncio
+import os
+import tempfile
+import time
+from asynctest import test, TestManager
+from asyncirc.recorder import Recorder, read_recording, write_recording
+from asyncirc.replay import mock_protocol, replay
+from blinker import signal
+from _mocks import Client
+
+loop = asyncio.get_event_loop()
+directory = tempfile.mkdtemp()
+
+@test("should record lines received on one connection, with their offsets")
+def test_record():
+    path = os.path.join(directory, "recorded.gz")
+    client, other = Client(netid="test-recorder"), Client(netid="test-recorder-other")
+    recorder = Recorder(client, path, flush_interval=0.05, max_buffer=2).start()
+    signal("raw").send(client, text=":irc.example.com NOTICE * :one")
+    signal("raw").send(other, text=":irc.example.com NOTICE * :elsewhere")
+    signal("raw").send(client, text=":irc.example.com NOTICE * :caf\xe9")
+    loop.run_until_complete(asyncio.sleep(0.1))
+    signal("raw").send(client, text=":irc.example.com NOTICE * :three")
+    loop.run_until_complete(recorder.stop())
+    header, lines = read_recording(path)
+    lines = list(lines)
+    test_record.succeed_if(
+        header["netid"] == "test-recorder" and header["version"] == 1 and
+        [line for _, line in lines] == [":irc.example.com NOTICE * :one", ":irc.example.com NOTICE * :caf\xe9",
+                                          ":irc.example.com NOTICE * :three"] and
+        lines[0][0] <= lines[1][0] < 0.1 <= lines[2][0] and recorder.lines == 3
+    )
+
+@test("should replay a recording into a mock protocol as fast as possible")
+def test_replay_fast():
+    path = os.path.join(directory, "fast.gz")
+    write_recording(path, [":nick!user@host PRIVMSG #chan :line {}".format(i) for i in range(1000)], rate=10)
+    received = []
+    def on_public_message(message, user, target, text):
+        if message.client.netid == "test-replay-fast":
+            received.append(text)
+    signal("public-message").connect(on_public_message)
+    protocol = mock_protocol("test-replay-fast", keep_writes=True)
+    start = time.perf_counter()
+    stats = loop.run_until_complete(replay(path, protocol))
+    elapsed = time.perf_counter() - start
+    signal("public-message").disconnect(on_public_message)
+    test_replay_fast.succeed_if(
+        len(received) == 1000 and received[-1] == "line 999" and stats.lines == 1000 and
+        elapsed < 10 and stats.stats()["p99"] is not None and protocol.lines_received == 1000
+    )
+
+@test("should keep the recorded gaps between lines when replaying at a given speed")
+def test_replay_speed():
+    protocol = mock_protocol("test-replay-speed")
+    stats = loop.run_until_complete(replay([(0.0, "PING :a"), (0.2, "PING :b"), (0.4, "PING :c")], protocol, speed=2))
+    test_replay_speed.succeed_if(0.2 <= stats.elapsed < 0.4 and protocol.lines_received == 3)
+
+manager = TestManager([test_record, test_replay_fast, test_replay_speed])
+
+if __name__ == '__main__':
+    manager.run_all()
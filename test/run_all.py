@@ -1,5 +1,5 @@
 import importlib
-test_suites = ["core", "tracking"]
+test_suites = ["parser", "throttle", "dispatch", "connections", "reconnect", "keepalive", "metrics", "profiler", "replay", "shard", "core", "tracking", "addressed", "protocol", "mockserver"]
 
 failures = 0
 
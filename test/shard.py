@@ -0,0 +1,74 @@
+import asyncio
+import os
+from asynctest import test, TestManager
+from asyncirc.parser import RFC1459Message
+from asyncirc.shard import ShardSupervisor, RemoteClient, assign_shards, encode_frame, read_frame
+from blinker import signal
+
+loop = asyncio.get_event_loop()
+
+@test("should frame pickled messages on the bus")
+def test_framing():
+    async def round_trip():
+        reader = asyncio.StreamReader()
+        message = RFC1459Message.from_message(":nick!user@host PRIVMSG #channel :hello")
+        reader.feed_data(encode_frame(("event", "netid", "public-message", message.snapshot(), {"text": "hello"})))
+        reader.feed_eof()
+        return await read_frame(reader), await read_frame(reader)
+    frame, end = loop.run_until_complete(round_trip())
+    test_framing.succeed_if(
+        frame[:3] == ("event", "netid", "public-message") and frame[3].params == ["#channel", "hello"] and
+        frame[4] == {"text": "hello"} and end is None
+    )
+
+@test("should spread networks over the workers round robin")
+def test_assign_shards():
+    test_assign_shards.succeed_if(assign_shards(list("abcde"), 2) == [["a", "c", "e"], ["b", "d"]])
+
+received = []
+
+async def handle_client(reader, writer):
+    # straight away, before the client could possibly have registered
+    writer.write(b":someone!someone@example.com PRIVMSG #channel :hello\r\n")
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if line.startswith(b"PRIVMSG"):
+            received.append(line)
+
+@test("should forward events from worker processes and route replies back")
+def test_sharded_networks():
+    server = loop.run_until_complete(asyncio.start_server(handle_client, "127.0.0.1", 0))
+    port = server.sockets[0].getsockname()[1]
+    replied = []
+    def on_public_message(message, user, target, text):
+        replied.append((message.client.shard, user.nick, text))
+        message.client.say(target, "hi {}".format(user.nick))
+    signal("public-message").connect(on_public_message)
+
+    async def run():
+        network = {"server": "127.0.0.1", "port": port, "use_ssl": False, "nick": "bot"}
+        supervisor = ShardSupervisor([network] * 2, workers=2, forward=["public-message"])
+        await supervisor.start()
+        for _ in range(100):
+            if len(received) == 2:
+                break
+            await asyncio.sleep(0.1)
+        await supervisor.stop("Bye")
+        return supervisor
+
+    supervisor = loop.run_until_complete(run())
+    signal("public-message").disconnect(on_public_message)
+    server.close()
+    test_sharded_networks.succeed_if(
+        sorted(replied) == [(0, "someone", "hello"), (1, "someone", "hello")] and
+        received == [b"PRIVMSG #channel :hi someone\r\n"] * 2 and
+        all(isinstance(client, RemoteClient) for client in supervisor.clients.values()) and
+        len(supervisor.clients) == 2 and not os.path.exists(supervisor.socket_dir)
+    )
+
+manager = TestManager([test_framing, test_assign_shards, test_sharded_networks])
+
+if __name__ == '__main__':
+    manager.run_all()
@@ -0,0 +1,123 @@
+from asynctest import test, TestManager
+from asyncirc.parser import RFC1459Message
+from asyncirc.throttle import SendQueue, TokenBucket, BULK
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def drain(bucket, count, cost=1.0):
+    sent = 0
+    while sent < count and not bucket.delay(cost):
+        bucket.consume(cost)
+        sent += 1
+    return sent
+
+@test("should allow a burst of lines and then one line per interval")
+def test_token_bucket_burst():
+    clock = Clock()
+    bucket = TokenBucket(burst=5, interval=2, clock=clock)
+    burst = drain(bucket, 20)
+    wait = bucket.delay()
+    clock.now += wait
+    test_token_bucket_burst.succeed_if(burst == 5 and wait == 2 and drain(bucket, 20) == 1)
+
+@test("should never refill past the burst size")
+def test_token_bucket_refill_cap():
+    clock = Clock()
+    bucket = TokenBucket(burst=3, interval=1, clock=clock)
+    drain(bucket, 3)
+    clock.now += 100
+    test_token_bucket_refill_cap.succeed_if(drain(bucket, 20) == 3)
+
+@test("should charge long lines more when weighting by bytes")
+def test_token_bucket_bytes():
+    bucket = TokenBucket(burst=4, interval=1, bytes_per_token=100, clock=Clock())
+    test_token_bucket_bytes.succeed_if(
+        bucket.cost(20) == 1 and bucket.cost(250) == 2.5 and bucket.cost(10000) == 4 and
+        drain(bucket, 20, bucket.cost(200)) == 2
+    )
+
+@test("should report queue depth and wait times")
+def test_send_queue_stats():
+    clock = Clock()
+    queue = SendQueue(clock=clock)
+    queue.push("PRIVMSG #a :one")
+    queue.push("PRIVMSG #a :two")
+    clock.now += 3
+    queue.pop()
+    clock.now += 1
+    stats = queue.stats()
+    test_send_queue_stats.succeed_if(
+        stats["depth"] == 1 and stats["sent"] == 1 and stats["wait_max"] == 3 and stats["wait_oldest"] == 4
+    )
+
+def pop_all(queue):
+    lines = []
+    while queue:
+        lines.append(queue.pop())
+    return lines
+
+@test("should send control traffic ahead of queued messages")
+def test_send_queue_control_first():
+    queue = SendQueue(clock=Clock())
+    for i in range(3):
+        queue.push("PRIVMSG #a :{}".format(i))
+    queue.push(b"WHO #a", BULK)
+    pong = RFC1459Message.from_data("PONG", ["irc.example.com"])
+    queue.push(pong)
+    test_send_queue_control_first.succeed_if(pop_all(queue) == [
+        pong, "PRIVMSG #a :0", "PRIVMSG #a :1", "PRIVMSG #a :2", b"WHO #a"])
+
+@test("should take turns between targets in the same lane")
+def test_send_queue_fairness():
+    queue = SendQueue(clock=Clock())
+    for i in range(3):
+        queue.push("PRIVMSG #busy :{}".format(i))
+    queue.push("PRIVMSG #quiet :hi")
+    queue.push("NOTICE someone :hi")
+    test_send_queue_fairness.succeed_if(pop_all(queue) == [
+        "PRIVMSG #busy :0", "PRIVMSG #quiet :hi", "NOTICE someone :hi",
+        "PRIVMSG #busy :1", "PRIVMSG #busy :2"])
+
+@test("should keep lines to a channel behind the JOIN that gets us in")
+def test_send_queue_join_order():
+    queue = SendQueue(clock=Clock())
+    queue.push("PART #old")
+    queue.push("JOIN #new")
+    queue.push("PRIVMSG #new :hi")
+    first = pop_all(queue)
+    queue.push(RFC1459Message.from_data("JOIN", ["#a,#b", "key"]))
+    queue.push("PRIVMSG #b :hi")
+    queue.push("PRIVMSG #c :hi")
+    second = pop_all(queue)
+    queue.push("PRIVMSG #b :again")
+    test_send_queue_join_order.succeed_if(
+        first == ["PART #old", "JOIN #new", "PRIVMSG #new :hi"] and
+        [getattr(line, "verb", line) for line in second] == ["JOIN", "PRIVMSG #b :hi", "PRIVMSG #c :hi"] and
+        queue.stats()["depth_by_priority"] == [0, 1, 0]
+    )
+
+@test("should never let a line overtake a QUIT queued after it, or the other way round")
+def test_send_queue_barrier():
+    queue = SendQueue(clock=Clock())
+    for i in range(3):
+        queue.push("PRIVMSG #a :chunk {}".format(i))
+    queue.push("PRIVMSG #b :hi")
+    queue.push("QUIT :bye")
+    queue.push("PRIVMSG #b :after")
+    test_send_queue_barrier.succeed_if(pop_all(queue) == [
+        "PRIVMSG #a :chunk 0", "PRIVMSG #b :hi", "PRIVMSG #a :chunk 1", "PRIVMSG #a :chunk 2",
+        "QUIT :bye", "PRIVMSG #b :after"])
+
+manager = TestManager([
+    test_token_bucket_burst, test_token_bucket_refill_cap, test_token_bucket_bytes, test_send_queue_stats,
+    test_send_queue_control_first, test_send_queue_fairness, test_send_queue_join_order,
+    test_send_queue_barrier
+])
+
+if __name__ == '__main__':
+    manager.run_all()
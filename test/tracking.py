@@ -1,3 +1,5 @@
+import asyncio
+import tempfile
 from asynctest import test, Test, TestManager
 from asyncirc.plugins import tracking
 from blinker import signal
@@ -127,11 +129,41 @@ def test_nickname_track():
 def check_nickname_track():
     test_nickname_track.succeed_if("ex2" in client.tracking_registry.users["ex4"].previous_nicks)
 
+@test("should move channel memberships over on nickname changes")
+def test_nickname_membership():
+    users = client.tracking_registry.channels["#example"].users
+    test_nickname_membership.succeed_if(
+        "ex4" in users and "ex2" not in users and "#example" in client.tracking_registry.users["ex4"].channels
+    )
+
+@test("should only remember the last few nicknames a user had")
+def test_nickname_history():
+    signal("raw").send(client, text=":hist!hist@example.net JOIN #example * :History")
+    nick = "hist"
+    for i in range(1, 11):
+        signal("raw").send(client, text=":{}!hist@example.net NICK hist{}".format(nick, i))
+        nick = "hist{}".format(i)
+    user = client.tracking_registry.users["hist10"]
+    test_nickname_history.succeed_if(
+        user.previous_nicks == tuple("hist{}".format(i) for i in range(2, 10)) and
+        "#example" in user.channels
+    )
+
 @test("should parse PREFIXES from server 005")
 def test_005_prefixes():
     signal("raw").send(client, text=":irc.example.com 005 bot PREFIX=(ov)@+ :Are supported by this server")
-    prefixes = tracking.parse_prefixes(client)
-    test_005_prefixes.succeed_if(prefixes['v'] == '+' and prefixes['o'] == '@')
+    registry = client.tracking_registry
+    test_005_prefixes.succeed_if(registry.mode_bits == {"o": 1, "v": 2} and registry.symbol_bits == {"@": 1, "+": 2})
+
+@test("should count owners and admins as ops")
+def test_ops_ranks():
+    ranked = Client()
+    ranked.netid = "mock with more prefixes"
+    tracking.create_registry(ranked)
+    signal("raw").send(ranked, text=":irc.example.com 005 bot PREFIX=(qaohv)~&@%+ :Are supported by this server")
+    signal("raw").send(ranked, text=":irc.example.com 353 bot @ #ranks :bot ~owner &admin @op %half +voice")
+    channel = tracking.get_channel(ranked.netid, "#ranks")
+    test_ops_ranks.succeed_if(sorted(channel.ops) == ["admin", "op", "owner"] and channel.prefix("admin") == "&")
 
 @test("should parse NAMES responses and handle prefixes")
 def test_names_responses():
@@ -139,12 +171,188 @@ def test_names_responses():
     signal("raw").send(client, text=":irc.example.com 366 bot #example :End of NAMES list.")
     test_names_responses.succeed_if("otheruser" in tracking.get_channel(client.netid, "#example").flags['+'])
 
+@test("should track op and voice through MODE changes")
+def test_prefix_modes():
+    signal("raw").send(client, text=":bot!bot@example.com MODE #example +o-v otheruser otheruser")
+    channel = tracking.get_channel(client.netid, "#example")
+    test_prefix_modes.succeed_if(
+        channel.prefix("otheruser") == "@" and channel.ops == ["otheruser"] and
+        "otheruser" not in channel.flags['+']
+    )
+
+@test("should take the highest of several NAMES prefixes")
+def test_names_multi_prefix():
+    signal("raw").send(client, text=":irc.example.com 353 bot @ #example :@+voiced!v@example.com")
+    channel = tracking.get_channel(client.netid, "#example")
+    test_names_multi_prefix.succeed_if(
+        channel.prefix("VOICED") == "@" and "voiced" in channel.users_with("v") and
+        client.tracking_registry.users["voiced"].host == "example.com"
+    )
+
+@test("should fold nicks and channels using the rfc1459 casemapping by default")
+def test_casemapping_default():
+    signal("raw").send(client, text=":Case[Man]!case@example.com JOIN #Case * :Case man")
+    registry = client.tracking_registry
+    test_casemapping_default.succeed_if(
+        tracking.get_user(client.netid, "case{man}") is registry.users["case{man}"] and
+        tracking.get_channel(client.netid, "#CASE") is registry.channels["#case"] and
+        "Case[Man]" in registry.channels["#case"].users and
+        "#Case" in registry.users["case{man}"].channels
+    )
+
+@test("should refold everything when the server advertises another CASEMAPPING")
+def test_casemapping_switch():
+    signal("raw").send(client, text=":irc.example.com 005 bot CASEMAPPING=ascii :are supported by this server")
+    registry = client.tracking_registry
+    test_casemapping_switch.succeed_if(
+        registry.casemapping == "ascii" and "case[man]" in registry.users and
+        "case{man}" not in registry.users and "Case[Man]" in registry.channels["#case"].users
+    )
+
+@test("should keep a NAMES reply that spans a CASEMAPPING change")
+def test_casemapping_names():
+    listing = Client()
+    listing.netid = "mock listing names"
+    tracking.create_registry(listing)
+    signal("raw").send(listing, text=":someone!someone@example.com JOIN #Names[1] * :Someone")
+    signal("raw").send(listing, text=":irc.example.com 353 bot @ #Names[1] :bot Nick[A]")
+    signal("raw").send(listing, text=":irc.example.com 005 bot CASEMAPPING=ascii :are supported by this server")
+    signal("raw").send(listing, text=":irc.example.com 366 bot #Names[1] :End of /NAMES list.")
+    registry = listing.tracking_registry
+    test_casemapping_names.succeed_if(
+        not registry.names_seen and sorted(registry.users_in("#names[1]")) == ["bot", "nick[a]"]
+    )
+
+@test("should restore the registry from a snapshot")
+def test_snapshot_round_trip():
+    registry = client.tracking_registry
+    restored = tracking.Registry.load(registry.dump(), client.netid)
+    test_snapshot_round_trip.succeed_if(
+        restored.casemapping == registry.casemapping and
+        restored.channel_users == registry.channel_users and
+        restored.user_channels == registry.user_channels and
+        restored.users["example"].account == registry.users["example"].account and
+        restored.channels["#case"].channel == "#Case"
+    )
+
+@test("should rejoin recently synced channels from a snapshot without a WHO")
+def test_snapshot_warm_restart():
+    sent, synced = [], []
+    def connect(netid):
+        warm = Client(writeln=lambda line, priority=None: sent.append(line.verb))
+        warm.netid = netid
+        warm.server_info = {"host": "irc.example.com", "port": 6697}
+        warm.server_supports["WHOX"] = None
+        tracking.create_registry(warm)
+        signal("raw").send(warm, text=":bot!bot@example.com JOIN #warm * :bot")
+        return warm
+
+    def on_sync_done(message, channel, progress, latency):
+        synced.append(channel)
+
+    tracking.enable_snapshots(tempfile.mkdtemp())
+    warm = connect("before restart")
+    signal("raw").send(warm, text=":gone!gone@example.com JOIN #warm * :Leaves while we're away")
+    signal("raw").send(warm, text=":irc.example.com 315 bot #warm :End of /WHO list.")
+    tracking.save_snapshot(warm)
+    del sent[:]
+
+    signal("sync-done").connect(on_sync_done)
+    warm = connect("after restart")
+    signal("raw").send(warm, text=":irc.example.com 353 bot @ #warm :@bot")
+    signal("raw").send(warm, text=":irc.example.com 366 bot #warm :End of NAMES list.")
+    signal("sync-done").disconnect(on_sync_done)
+    tracking.enable_snapshots(None)
+    test_snapshot_warm_restart.succeed_if(
+        "WHO" not in sent and synced == ["#warm"] and
+        "gone" in warm.tracking_registry.users and
+        tracking.get_channel(warm.netid, "#warm").users == ["bot"]
+    )
+
+@test("should keep a bounded number of batched WHOs in flight")
+def test_sync_scheduler():
+    sent = []
+    syncing = Client(writeln=lambda line, priority=None: sent.append(line.params[0]) if line.verb == "WHO" else None)
+    syncing.netid = "sync scheduler"
+    syncing.server_info = {"host": "irc.example.com", "port": 6697}
+    syncing.server_supports.update({"WHOX": None, "TARGMAX": "PRIVMSG:4,WHO:3"})
+    tracking.create_registry(syncing)
+    for i in range(10):
+        signal("raw").send(syncing, text=":bot!bot@example.com JOIN #c{} * :bot".format(i))
+    in_flight = list(sent)
+    signal("raw").send(syncing, text=":someone!someone@example.com PRIVMSG #c9 :is anyone here?")
+    signal("raw").send(syncing, text=":irc.example.com 315 bot #c0 :End of /WHO list.")
+    signal("raw").send(syncing, text=":irc.example.com 315 bot #c1 :End of /WHO list.")
+    test_sync_scheduler.succeed_if(
+        in_flight == ["#c0", "#c1"] and sent[2:] == ["#c9,#c2,#c3", "#c4,#c5,#c6"]
+    )
+
+@test("should give up on a WHO that never gets a reply and sync the next channel")
+def test_sync_timeout():
+    sent = []
+    syncing = Client(writeln=lambda line, priority=None: sent.append(line.params[0]) if line.verb == "WHO" else None)
+    syncing.netid = "sync timeout"
+    syncing.server_info = {"host": "irc.example.com", "port": 6697}
+    syncing.server_supports["WHOX"] = None
+    tracking.create_registry(syncing)
+    syncing.sync_scheduler.who_timeout = 0.05
+    syncing.sync_scheduler.who_retries = 0
+    for i in range(3):
+        signal("raw").send(syncing, text=":bot!bot@example.com JOIN #t{} * :bot".format(i))
+    stalled = list(sent)
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.15))
+    test_sync_timeout.succeed_if(stalled == ["#t0", "#t1"] and sent == ["#t0", "#t1", "#t2"])
+
+@test("should retry a timed out WHO once and then give up on the channel")
+def test_sync_retry():
+    sent = []
+    failed = []
+    syncing = Client(writeln=lambda line, priority=None: sent.append(line.params[0]) if line.verb == "WHO" else None)
+    syncing.netid = "sync retry"
+    syncing.server_info = {"host": "irc.example.com", "port": 6697}
+    syncing.server_supports["WHOX"] = None
+    tracking.create_registry(syncing)
+    def on_sync_failed(client, channel, progress):
+        if client is syncing:
+            failed.append((channel, progress))
+    signal("sync-failed").connect(on_sync_failed)
+    scheduler = syncing.sync_scheduler
+    scheduler.who_timeout = 0.05
+    signal("raw").send(syncing, text=":bot!bot@example.com JOIN #lost * :bot")
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.2))
+    signal("sync-failed").disconnect(on_sync_failed)
+    test_sync_retry.succeed_if(
+        sent == ["#lost", "#lost"] and failed == [("#lost", (1, 1))] and
+        not scheduler.requested and not scheduler.retries and not scheduler.in_flight and scheduler.total == 0
+    )
+
+@test("should report sync progress and latency with sync-done")
+def test_sync_progress():
+    syncing = Client(writeln=lambda line, priority=None: None)
+    syncing.netid = "sync progress"
+    syncing.server_info = {"host": "irc.example.com", "port": 6697}
+    syncing.server_supports["WHOX"] = None
+    tracking.create_registry(syncing)
+    def on_sync_done(message, channel, progress, latency):
+        test_sync_progress.succeed_if(channel == "#p1" and progress == (1, 2) and latency >= 0)
+    signal("sync-done").connect(on_sync_done)
+    for channel in ("#p1", "#p2"):
+        signal("raw").send(syncing, text=":bot!bot@example.com JOIN {} * :bot".format(channel))
+    signal("raw").send(syncing, text=":irc.example.com 353 bot @ #p1 :@bot")
+    signal("raw").send(syncing, text=":irc.example.com 366 bot #p1 :End of NAMES list.")
+    signal("raw").send(syncing, text=":irc.example.com 324 bot #p1 +nt")
+    signal("raw").send(syncing, text=":irc.example.com 315 bot #p1 :End of /WHO list.")
+    signal("sync-done").disconnect(on_sync_done)
+
 manager = TestManager([
     test_add_objects_to_database, test_account_recording_on_extjoin, test_host_recording,
     test_channel_membership_join_tracking, test_channel_membership_part_tracking, test_quit,
     test_kick, test_user_return_after_quit, test_topic_332, test_topic_changed,
     test_channel_has_users_property, test_whox, test_standard_who, test_initial_mode,
-    test_end_who, test_nickname_track, test_005_prefixes, test_names_responses
+    test_end_who, test_nickname_track, test_nickname_membership, test_nickname_history,
+    test_005_prefixes, test_ops_ranks, test_names_responses, test_prefix_modes, test_names_multi_prefix,
+    test_casemapping_default, test_casemapping_switch, test_casemapping_names, test_snapshot_round_trip, test_snapshot_warm_restart,
+    test_sync_scheduler, test_sync_timeout, test_sync_retry, test_sync_progress
 ])
 
 if __name__ == '__main__':